@@ -4,10 +4,28 @@ import asyncio
 from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
-from config import ADMIN_ID, DB_PATH
-import aiosqlite
-from datetime import datetime, timedelta
+from config import ADMIN_ID
+import db_pool
+import subscription_cache
+import links
+from interaction_buffer import get_buffer
+from config_pool import get_refiller, pool_levels
+from vpn_nodes import all_nodes, sync_nodes
+from extend_coalescer import get_coalescer
+from vpn_client import get_client
+from circuit_breaker import all_breakers
+from provisioning_outbox import get_worker, outbox_levels
+from expiry_scheduler import get_scheduler
+from reconciliation import get_reconciler
+import pending_payments
+from payment import reuse_stats
+from webhooks import get_server as get_webhook_server
+from yookassa_gateway import get_gateway
+from datetime import datetime
+from timestamps import now_ts, format_ts
+from stats_counters import read_dashboard
 from database import (
+    UserStats,
     get_user_stats, 
     get_payment_stats, 
     get_users_by_status, 
@@ -18,7 +36,9 @@ from database import (
     unblock_user,
     give_user_subscription,
     deactivate_user_subscription,
-    activate_user_subscription
+    activate_user_subscription,
+    compensate_active_users,
+    rebuild_stats
 )
 
 # Список ID администраторов
@@ -52,50 +72,10 @@ def get_admin_main_keyboard():
     ])
 
 async def get_admin_stats():
-    """Получает базовую статистику для админ панели"""
+    """Получает базовую статистику для админ панели из счётчиков и дневных сводок"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Всего пользователей бота (кто запускал /start)
-            cursor = await conn.execute("SELECT COUNT(*) FROM bot_users")
-            result = await cursor.fetchone()
-            total_users = result[0] if result else 0
-            
-            # Получаем всех пользователей с подписками
-            cursor = await conn.execute(
-                "SELECT user_id, subscribed, expiry_date FROM users"
-            )
-            all_vpn_users = await cursor.fetchall()
-            
-            active_subs = 0
-            
-            # Программно проверяем активные подписки
-            if all_vpn_users:
-                for user_id, subscribed, expiry_date in all_vpn_users:
-                    if subscribed and expiry_date and is_subscription_active_check(expiry_date):
-                        active_subs += 1
-            
-            # Новые за сегодня (кто запустил бота)
-            today = datetime.now().strftime('%d.%m.%Y')
-            cursor = await conn.execute(
-                "SELECT COUNT(*) FROM bot_users WHERE first_interaction LIKE ?",
-                (f"{today}%",)
-            )
-            result = await cursor.fetchone()
-            new_today = result[0] if result else 0
-            
-            # Доход за месяц
-            try:
-                payment_stats = await get_payment_stats()
-                monthly_revenue = payment_stats.get('revenue_month', 0)
-            except:
-                monthly_revenue = 0
-        
-        return {
-            'total_users': total_users,
-            'active_subs': active_subs,
-            'monthly_revenue': monthly_revenue,
-            'new_today': new_today
-        }
+        async with db_pool.reader() as conn:
+            return await read_dashboard(conn)
     except Exception as e:
         logging.error(f"Ошибка получения статистики: {e}")
         return {
@@ -105,130 +85,173 @@ async def get_admin_stats():
             'new_today': 0
         }
 
+async def build_metrics_text() -> str:
+    """Текст экрана метрик: буфер взаимодействий, кэш подписок и пул конфигов"""
+    buffer = get_buffer().stats()
+    cache = subscription_cache.stats()
+    link_cache = links.stats()
+    refiller = get_refiller()
+    async with db_pool.reader() as conn:
+        levels = await pool_levels(conn)
+        outbox = await outbox_levels(conn)
+        payments_pending = await pending_payments.pending_count(conn)
+    pool_lines = '\n'.join(
+        f"• {node.node_id}: <code>{levels.get(node.node_id, 0)}</code> "
+        f"(пользователей {node.user_count}/{node.capacity}{'' if node.available else ', недоступен'})"
+        for node in all_nodes() if node.enabled
+    ) or '• нет узлов'
+    refill = refiller.stats()
+    jobs = get_worker().stats()
+    expiry = get_scheduler().stats()
+    next_event = format_ts(expiry['next_ts']) if expiry['next_ts'] else '—'
+    extends = get_coalescer().stats()
+    client = await get_client()
+    breaker_lines = '\n'.join(
+        f"• {name}: <code>{b['state']}</code>, срабатываний <code>{b['trips']}</code>, "
+        f"отклонено <code>{b['rejected']}</code>, ошибок <code>{b['total_failures']}</code>"
+        for name, b in ((name, breaker.stats()) for name, breaker in all_breakers().items())
+    ) or '• запросов ещё не было'
+    yookassa = (await get_gateway()).stats()
+    poller = pending_payments.get_poller().stats()
+    reuse = reuse_stats()
+    webhook_server = get_webhook_server()
+    if webhook_server is not None:
+        hooks = webhook_server.stats()
+        webhook_line = (f"• Уведомлений: <code>{hooks['received']}</code>, зачислено <code>{hooks['activated']}</code>, "
+                        f"отменено <code>{hooks['canceled']}</code>, отклонено <code>{hooks['rejected']}</code>, "
+                        f"ошибок <code>{hooks['errors']}</code>")
+    else:
+        webhook_line = "• Уведомления не принимаются, только опрос"
+    return f"""
+<b>📈 Метрики</b>
+
+<b>📝 Буфер взаимодействий:</b>
+• В очереди: <code>{buffer['pending']}</code>
+• Сбросов: <code>{buffer['flushes']}</code> (ошибок: <code>{buffer['errors']}</code>)
+• Записей: <code>{buffer['records_flushed']}</code>, новых: <code>{buffer['new_users']}</code>
+• Размер пачки: <code>{buffer['last_flush_size']}</code> (средний <code>{buffer['avg_flush_size']}</code>)
+• Время сброса: <code>{buffer['last_flush_ms']}</code> мс (среднее <code>{buffer['avg_flush_ms']}</code>, макс. <code>{buffer['max_flush_ms']}</code>)
+
+<b>⚡ Кэш подписок:</b>
+• Записей: <code>{cache['size']}</code>
+• Попаданий: <code>{cache['hits']}</code>, промахов: <code>{cache['misses']}</code>
+
+<b>🔗 Кэш ссылок:</b>
+• Записей: <code>{link_cache['size']}</code>, шаблонов узлов: <code>{link_cache['templates']}</code>
+• Попаданий: <code>{link_cache['hits']}</code>, промахов: <code>{link_cache['misses']}</code>
+
+<b>📦 Пул конфигов</b> (отметки {refiller.low}..{refiller.high}):
+{pool_lines}
+• Выдано сервером: <code>{refill['provisioned']}</code>, ошибок: <code>{refill['failed']}</code>, устарело: <code>{refill['expired']}</code>
+
+<b>⏩ Продления конфигов:</b>
+• Запрошено: <code>{extends['requested']}</code>, отправлено запросов: <code>{extends['sent']}</code>
+• Пакетов: <code>{extends['batches']}</code>, ошибок: <code>{extends['failed']}</code>
+
+<b>📮 Задания VPN (outbox):</b>
+• Ожидают: <code>{outbox.get('pending', 0)}</code>, выполнено: <code>{outbox.get('done', 0)}</code>, провалено: <code>{outbox.get('failed', 0)}</code>
+• С запуска: выполнено <code>{jobs['completed']}</code>, повторов <code>{jobs['retried']}</code>, провалено <code>{jobs['failed']}</code>
+
+<b>⏳ Окончание подписок:</b>
+• В расписании: <code>{expiry['scheduled']}</code>, ближайшее: <code>{next_event}</code>
+• Напоминаний: <code>{expiry['reminders']}</code>, отзывов: <code>{expiry['revoked']}</code>, устаревших событий: <code>{expiry['skipped']}</code>
+
+<b>🛡 VPN API:</b>
+{breaker_lines}
+• Повторов: <code>{client.retried}</code>, дублирующих запросов: <code>{client.hedged}</code>
+
+<b>💳 Платежи ЮKassa:</b>
+{webhook_line}
+• Ожидают оплаты: <code>{payments_pending}</code>
+• Опрос: проверено <code>{poller['checked']}</code>, запросов <code>{poller['api_calls']}</code>, завершено <code>{poller['resolved']}</code>, брошено <code>{poller['expired']}</code>, оплачено без зачисления <code>{poller['stuck']}</code>
+• Повторный выбор тарифа: ссылка из кэша <code>{reuse['hits']}</code>, новых платежей <code>{reuse['misses']}</code>
+• Запросов к API: <code>{yookassa['requests']}</code>, повторов <code>{yookassa['retried']}</code>, ошибок <code>{yookassa['errors']}</code>
+
+<b>🕐 Время:</b> <code>{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}</code>
+"""
+
+def build_reconcile_text() -> str:
+    """Текст экрана сверки сроков с VPN серверами"""
+    reconciler = get_reconciler()
+    report = reconciler.report
+    if report is None and not reconciler.configured:
+        return ("<b>🔁 Сверка с VPN серверами</b>\n\n"
+                "Сверка выключена: на VPN серверах не задан метод статуса (VPN_API_STATUS_PATH).")
+    if report is None:
+        return "<b>🔁 Сверка с VPN серверами</b>\n\nСверка ещё не запускалась."
+    if report['finished_ts'] is None:
+        status = f"⏳ идёт с {format_ts(report['started_ts'])}"
+    else:
+        status = f"✅ завершена {format_ts(report['finished_ts'])} за {report['duration']} с"
+    return f"""
+<b>🔁 Сверка с VPN серверами</b>
+
+<b>Статус:</b> {status}
+
+• Проверено подписок: <code>{report['checked']}</code>
+• Совпадают: <code>{report['ok']}</code>
+• На сервере меньше: <code>{report['server_behind']}</code>
+• На сервере больше: <code>{report['server_ahead']}</code>
+• Нет на сервере: <code>{report['missing']}</code>
+• Ошибок запроса: <code>{report['errors']}</code>
+
+• Исправлено: <code>{report['repaired']}</code>, не удалось: <code>{report['repair_failed']}</code>
+"""
+
 async def get_detailed_stats():
-    """Получает подробную статистику"""
+    """Получает подробную статистику: (UserStats, PaymentStats)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Всего пользователей бота
-            cursor = await conn.execute("SELECT COUNT(*) FROM bot_users")
-            result = await cursor.fetchone()
-            total_users = result[0] if result else 0
-            
-            # Получаем всех пользователей с подписками для программной проверки
-            cursor = await conn.execute(
-                "SELECT user_id, subscribed, payment_date, expiry_date FROM users"
-            )
-            all_vpn_users = await cursor.fetchall()
-            
-            active_subs = 0
-            expired_subs = 0
-            
-            if all_vpn_users:
-                for user_id, subscribed, payment_date, expiry_date in all_vpn_users:
-                    # Проверяем активность подписки
-                    if subscribed and expiry_date:
-                        if is_subscription_active_check(expiry_date):
-                            active_subs += 1
-                        else:
-                            expired_subs += 1
-            
-            # Новые за сегодня (кто запустил бота)
-            today = datetime.now().strftime('%d.%m.%Y')
-            cursor = await conn.execute(
-                "SELECT COUNT(*) FROM bot_users WHERE first_interaction LIKE ?",
-                (f"{today}%",)
-            )
-            result = await cursor.fetchone()
-            new_today = result[0] if result else 0
-            
-            # Новые за неделю (кто запустил бота)
-            cursor = await conn.execute("SELECT user_id, first_interaction FROM bot_users")
-            all_bot_users = await cursor.fetchall()
-            
-            new_week = 0
-            if all_bot_users:
-                week_ago = datetime.now() - timedelta(days=7)
-                
-                for user_id, first_interaction in all_bot_users:
-                    if first_interaction:
-                        try:
-                            formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                            for fmt in formats:
-                                try:
-                                    interaction_date = datetime.strptime(first_interaction, fmt)
-                                    if interaction_date >= week_ago:
-                                        new_week += 1
-                                    break
-                                except ValueError:
-                                    continue
-                        except:
-                            pass
-        
-        # Получаем статистику платежей
-        try:
-            payment_stats = await get_payment_stats()
-        except:
-            payment_stats = {
-                'revenue_today': 0,
-                'revenue_week': 0,
-                'revenue_month': 0,
-                'avg_payment': 0,
-                'subs_1m': 0,
-                'subs_3m': 0,
-                'subs_6m': 0,
-                'subs_12m': 0
-            }
-        
-        return {
-            'total_users': total_users,
-            'active_subs': active_subs,
-            'expired_subs': expired_subs,
-            'new_today': new_today,
-            'new_week': new_week,
-            'revenue_today': payment_stats.get('revenue_today', 0),
-            'revenue_week': payment_stats.get('revenue_week', 0),
-            'revenue_month': payment_stats.get('revenue_month', 0),
-            'avg_payment': payment_stats.get('avg_payment', 0),
-            'subs_1m': payment_stats.get('subs_1m', 0),
-            'subs_3m': payment_stats.get('subs_3m', 0),
-            'subs_6m': payment_stats.get('subs_6m', 0),
-            'subs_12m': payment_stats.get('subs_12m', 0)
-        }
+        user_stats = await get_user_stats()
     except Exception as e:
         logging.error(f"Ошибка получения детальной статистики: {e}")
-        return {
-            'total_users': 0,
-            'active_subs': 0,
-            'expired_subs': 0,
-            'new_today': 0,
-            'new_week': 0,
-            'revenue_today': 0,
-            'revenue_week': 0,
-            'revenue_month': 0,
-            'avg_payment': 0,
-            'subs_1m': 0,
-            'subs_3m': 0,
-            'subs_6m': 0,
-            'subs_12m': 0
-        }
+        user_stats = UserStats()
+    
+    # Ошибки get_payment_stats обрабатывает сама и возвращает пустую статистику
+    payment_stats = await get_payment_stats()
+    return user_stats, payment_stats
+
+# Последние пользователи бота для экрана «Все пользователи»
+RECENT_BOT_USERS_SQL = """SELECT bu.user_id, bu.first_name, bu.first_interaction,
+                                 CASE WHEN u.user_id IS NOT NULL THEN 1 ELSE 0 END as has_subscription
+                          FROM bot_users bu
+                          LEFT JOIN users u ON bu.user_id = u.user_id
+                          ORDER BY bu.first_interaction_ts DESC LIMIT 15"""
+
+# Экраны списков пользователей: (callback_data, заголовок, пустой список, подпись даты)
+USERS_STATUS_SCREENS = {
+    "active": ("admin_active_users", "👥 Активные пользователи", "Нет активных пользователей", "до"),
+    "expiring": ("admin_expiring", "⏰ Истекающие подписки (ближайшие 3 дня)", "Нет истекающих подписок в ближайшие 3 дня", "истекает"),
+    "expired": ("admin_expired", "❌ Истекшие подписки", "Нет истекших подписок", "истекла")
+}
 
-def is_subscription_active_check(expiry_date_str: str) -> bool:
-    """Проверяет активность подписки с поддержкой разных форматов"""
-    if not expiry_date_str:
-        return False
+USERS_PAGE_SIZE = 15
+
+async def build_users_status_page(status: str, callback_data: str):
+    """Формирует страницу списка пользователей по статусу.
+
+    Курсор следующей страницы передаётся в callback_data после двоеточия,
+    поэтому каждая страница стоит одного индексного запроса на USERS_PAGE_SIZE строк.
+    """
+    prefix, title, empty_text, date_label = USERS_STATUS_SCREENS[status]
+    cursor = callback_data.split(":", 1)[1] if ":" in callback_data else None
     
-    try:
-        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-        for fmt in formats:
-            try:
-                expiry_date = datetime.strptime(expiry_date_str, fmt)
-                return datetime.now() < expiry_date
-            except ValueError:
-                continue
-        return False
-    except Exception as e:
-        logging.error(f"Ошибка проверки даты {expiry_date_str}: {e}")
-        return False
+    users, next_cursor = await get_users_by_status(status, USERS_PAGE_SIZE, cursor)
+    
+    if not users:
+        text = f"<b>{title}</b>\n\n{empty_text if not cursor else 'Больше записей нет'}"
+    else:
+        text = f"<b>{title}</b>\n\n"
+        for user_id, expiry_date in users:
+            text += f"• ID: <code>{user_id}</code> {date_label} <code>{expiry_date}</code>\n"
+    
+    buttons = []
+    if next_cursor:
+        buttons.append([InlineKeyboardButton(text="➡️ Следующая страница", callback_data=f"{prefix}:{next_cursor}")])
+    if cursor:
+        buttons.append([InlineKeyboardButton(text="⏮ В начало", callback_data=prefix)])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")])
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
 
 async def send_broadcast_message(bot, message_text: str = None, target_type: str = "all", photo_url: str = None):
     """Отправляет рассылку пользователям с поддержкой фото"""
@@ -238,59 +261,23 @@ async def send_broadcast_message(bot, message_text: str = None, target_type: str
             query = "SELECT user_id FROM bot_users"  # Всем пользователям бота
         elif target_type == "active":
             query = """SELECT user_id FROM users 
-                       WHERE subscribed = 1"""
+                       WHERE subscribed = 1 AND expiry_ts > :now"""
         elif target_type == "inactive":
             query = """SELECT user_id FROM bot_users 
                        WHERE user_id NOT IN (
                            SELECT user_id FROM users WHERE subscribed = 1
                        )"""
         elif target_type == "expiring":
+            # Истекает в ближайшие 3 полных дня
             query = """SELECT user_id FROM users 
-                       WHERE subscribed = 1"""
+                       WHERE subscribed = 1 AND expiry_ts > :now AND expiry_ts < :now + 4 * 86400"""
         else:
             return {"success": 0, "failed": 0, "blocked": 0}
         
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(query)
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute(query, {"now": now_ts()})
             users = await cursor.fetchall()
         
-        # Дополнительная фильтрация для активных и истекающих
-        if target_type == "active":
-            filtered_users = []
-            for (user_id,) in users:
-                # Проверяем активность подписки
-                cursor = await conn.execute(
-                    "SELECT expiry_date FROM users WHERE user_id = ?",
-                    (user_id,)
-                )
-                row = await cursor.fetchone()
-                if row and row[0] and is_subscription_active_check(row[0]):
-                    filtered_users.append((user_id,))
-            users = filtered_users
-        elif target_type == "expiring":
-            filtered_users = []
-            for (user_id,) in users:
-                cursor = await conn.execute(
-                    "SELECT expiry_date FROM users WHERE user_id = ?",
-                    (user_id,)
-                )
-                row = await cursor.fetchone()
-                if row and row[0]:
-                    try:
-                        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                        for fmt in formats:
-                            try:
-                                exp_date = datetime.strptime(row[0], fmt)
-                                days_left = (exp_date - datetime.now()).days
-                                if 0 <= days_left <= 3:
-                                    filtered_users.append((user_id,))
-                                break
-                            except ValueError:
-                                continue
-                    except:
-                        pass
-            users = filtered_users
-        
         success_count = 0
         failed_count = 0
         blocked_count = 0
@@ -370,29 +357,29 @@ def register_admin_handlers(dp):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
         
-        stats = await get_detailed_stats()
+        users, payments = await get_detailed_stats()
         
         stats_text = f"""
 <b>📊 Подробная статистика</b>
 
 <b>👥 Пользователи:</b>
-• Всего пользователей бота: <code>{stats['total_users']}</code>
-• Активных подписок: <code>{stats['active_subs']}</code>
-• Истекших подписок: <code>{stats['expired_subs']}</code>
-• Новых за сегодня: <code>{stats['new_today']}</code>
-• Новых за неделю: <code>{stats['new_week']}</code>
+• Всего пользователей бота: <code>{users.total_users}</code>
+• Активных подписок: <code>{users.active_subs}</code>
+• Истекших подписок: <code>{users.expired_subs}</code>
+• Новых за сегодня: <code>{users.new_today}</code>
+• Новых за неделю: <code>{users.new_week}</code>
 
 <b>💰 Финансы:</b>
-• Доход за сегодня: <code>{stats['revenue_today']}₽</code>
-• Доход за неделю: <code>{stats['revenue_week']}₽</code>
-• Доход за месяц: <code>{stats['revenue_month']}₽</code>
-• Средний чек: <code>{stats['avg_payment']}₽</code>
+• Доход за сегодня: <code>{payments.revenue_today}₽</code>
+• Доход за неделю: <code>{payments.revenue_week}₽</code>
+• Доход за месяц: <code>{payments.revenue_month}₽</code>
+• Средний чек: <code>{payments.avg_payment}₽</code>
 
 <b>📈 Подписки по периодам:</b>
-• 1 месяц: <code>{stats['subs_1m']}</code>
-• 3 месяца: <code>{stats['subs_3m']}</code>
-• 6 месяцев: <code>{stats['subs_6m']}</code>
-• 12 месяцев: <code>{stats['subs_12m']}</code>
+• 1 месяц: <code>{payments.subs_1m}</code>
+• 3 месяца: <code>{payments.subs_3m}</code>
+• 6 месяцев: <code>{payments.subs_6m}</code>
+• 12 месяцев: <code>{payments.subs_12m}</code>
 """
         
         back_keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -463,22 +450,10 @@ def register_admin_handlers(dp):
             user_data = await find_user_by_id(user_id)
             
             if user_data:
-                user_id, subscribed, payment_date, expiry_date, config, last_update = user_data
+                user_id, subscribed, payment_date, expiry_date, config, last_update, expiry_ts = user_data
                 
                 # Проверяем активность подписки
-                is_active = False
-                if expiry_date:
-                    try:
-                        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                        for fmt in formats:
-                            try:
-                                exp_date = datetime.strptime(expiry_date, fmt)
-                                is_active = exp_date > datetime.now()
-                                break
-                            except ValueError:
-                                continue
-                    except:
-                        pass
+                is_active = bool(expiry_ts and expiry_ts > now_ts())
                 
                 status = "🟢 Активна" if is_active else "🔴 Неактивна"
                 
@@ -524,7 +499,7 @@ def register_admin_handlers(dp):
                         ])
                 else:
                     # Пользователь без подписки - проверяем, есть ли он в bot_users
-                    async with aiosqlite.connect(DB_PATH) as conn:
+                    async with db_pool.reader() as conn:
                         cursor = await conn.execute(
                             "SELECT user_id, first_name FROM bot_users WHERE user_id = ?",
                             (user_id,)
@@ -573,7 +548,7 @@ def register_admin_handlers(dp):
             user_id = int(message.text)
             
             # Проверяем, есть ли пользователь в bot_users
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with db_pool.reader() as conn:
                 cursor = await conn.execute(
                     "SELECT user_id, first_name FROM bot_users WHERE user_id = ?",
                     (user_id,)
@@ -754,7 +729,7 @@ def register_admin_handlers(dp):
             logging.error(f"Ошибка активации подписки: {e}")
             await callback.answer("❌ Произошла ошибка", show_alert=True)
     
-    @dp.callback_query(F.data == "admin_active_users")
+    @dp.callback_query(F.data.startswith("admin_active_users"))
     async def admin_active_users_callback(callback: types.CallbackQuery):
         """Активные пользователи"""
         if not is_admin(callback.from_user.id):
@@ -762,26 +737,13 @@ def register_admin_handlers(dp):
             return
         
         try:
-            active_users = await get_users_by_status("active", 15)
-            
-            if not active_users:
-                text = "<b>👥 Активные пользователи</b>\n\nНет активных пользователей"
-            else:
-                text = "<b>👥 Активные пользователи (последние 15)</b>\n\n"
-                for user_id, expiry_date in active_users:
-                    text += f"• ID: <code>{user_id}</code> до <code>{expiry_date}</code>\n"
-            
-            await callback.message.edit_text(
-                text=text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")]
-                ])
-            )
+            text, keyboard = await build_users_status_page("active", callback.data)
+            await callback.message.edit_text(text=text, reply_markup=keyboard)
         except Exception as e:
             logging.error(f"Ошибка получения активных пользователей: {e}")
             await callback.answer("Ошибка получения данных", show_alert=True)
     
-    @dp.callback_query(F.data == "admin_expiring")
+    @dp.callback_query(F.data.startswith("admin_expiring"))
     async def admin_expiring_callback(callback: types.CallbackQuery):
         """Истекающие подписки"""
         if not is_admin(callback.from_user.id):
@@ -789,26 +751,13 @@ def register_admin_handlers(dp):
             return
         
         try:
-            expiring_users = await get_users_by_status("expiring", 15)
-            
-            if not expiring_users:
-                text = "<b>⏰ Истекающие подписки</b>\n\nНет истекающих подписок в ближайшие 3 дня"
-            else:
-                text = "<b>⏰ Истекающие подписки (ближайшие 3 дня)</b>\n\n"
-                for user_id, expiry_date in expiring_users:
-                    text += f"• ID: <code>{user_id}</code> истекает <code>{expiry_date}</code>\n"
-            
-            await callback.message.edit_text(
-                text=text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")]
-                ])
-            )
+            text, keyboard = await build_users_status_page("expiring", callback.data)
+            await callback.message.edit_text(text=text, reply_markup=keyboard)
         except Exception as e:
             logging.error(f"Ошибка получения истекающих подписок: {e}")
             await callback.answer("Ошибка получения данных", show_alert=True)
     
-    @dp.callback_query(F.data == "admin_expired")
+    @dp.callback_query(F.data.startswith("admin_expired"))
     async def admin_expired_callback(callback: types.CallbackQuery):
         """Истекшие подписки"""
         if not is_admin(callback.from_user.id):
@@ -816,21 +765,8 @@ def register_admin_handlers(dp):
             return
         
         try:
-            expired_users = await get_users_by_status("expired", 15)
-            
-            if not expired_users:
-                text = "<b>❌ Истекшие подписки</b>\n\nНет истекших подписок"
-            else:
-                text = "<b>❌ Истекшие подписки (последние 15)</b>\n\n"
-                for user_id, expiry_date in expired_users:
-                    text += f"• ID: <code>{user_id}</code> истекла <code>{expiry_date}</code>\n"
-            
-            await callback.message.edit_text(
-                text=text,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")]
-                ])
-            )
+            text, keyboard = await build_users_status_page("expired", callback.data)
+            await callback.message.edit_text(text=text, reply_markup=keyboard)
         except Exception as e:
             logging.error(f"Ошибка получения истекших подписок: {e}")
             await callback.answer("Ошибка получения данных", show_alert=True)
@@ -859,14 +795,8 @@ def register_admin_handlers(dp):
             return
         
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
-                cursor = await conn.execute(
-                    """SELECT bu.user_id, bu.first_name, bu.first_interaction,
-                          CASE WHEN u.user_id IS NOT NULL THEN 1 ELSE 0 END as has_subscription
-                   FROM bot_users bu
-                   LEFT JOIN users u ON bu.user_id = u.user_id
-                   ORDER BY bu.first_interaction DESC LIMIT 15"""
-                )
+            async with db_pool.reader() as conn:
+                cursor = await conn.execute(RECENT_BOT_USERS_SQL)
                 all_bot_users = await cursor.fetchall()
             
             if not all_bot_users:
@@ -904,16 +834,16 @@ def register_admin_handlers(dp):
 <b>💰 Статистика платежей</b>
 
 <b>📊 Доходы:</b>
-• За сегодня: <code>{payment_stats['revenue_today']}₽</code>
-• За неделю: <code>{payment_stats['revenue_week']}₽</code>
-• За месяц: <code>{payment_stats['revenue_month']}₽</code>
-• Средний чек: <code>{payment_stats['avg_payment']}₽</code>
+• За сегодня: <code>{payment_stats.revenue_today}₽</code>
+• За неделю: <code>{payment_stats.revenue_week}₽</code>
+• За месяц: <code>{payment_stats.revenue_month}₽</code>
+• Средний чек: <code>{payment_stats.avg_payment}₽</code>
 
 <b>📈 Подписки по периодам:</b>
-• 1 месяц: <code>{payment_stats['subs_1m']}</code> шт.
-• 3 месяца: <code>{payment_stats['subs_3m']}</code> шт.
-• 6 месяцев: <code>{payment_stats['subs_6m']}</code> шт.
-• 12 месяцев: <code>{payment_stats['subs_12m']}</code> шт.
+• 1 месяц: <code>{payment_stats.subs_1m}</code> шт.
+• 3 месяца: <code>{payment_stats.subs_3m}</code> шт.
+• 6 месяцев: <code>{payment_stats.subs_6m}</code> шт.
+• 12 месяцев: <code>{payment_stats.subs_12m}</code> шт.
 """
             
             await callback.message.edit_text(
@@ -978,6 +908,13 @@ def register_admin_handlers(dp):
                 InlineKeyboardButton(text="🧹 Очистка логов", callback_data="admin_clear_logs"),
                 InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")
             ],
+            [
+                InlineKeyboardButton(text="📈 Метрики", callback_data="admin_metrics"),
+                InlineKeyboardButton(text="🩹 Компенсация", callback_data="admin_compensate")
+            ],
+            [
+                InlineKeyboardButton(text="🔁 Сверка с VPN", callback_data="admin_reconcile")
+            ],
             [
                 InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back_main")
             ]
@@ -1026,11 +963,19 @@ def register_admin_handlers(dp):
             return
     
         try:
-            async with aiosqlite.connect(DB_PATH) as conn:
+            async with db_pool.writer() as conn:
                 await conn.execute("DELETE FROM users")
                 await conn.execute("DELETE FROM bot_users")
                 await conn.execute("DELETE FROM payments")
-                await conn.commit()
+                await conn.execute("DELETE FROM stats_counters")
+                await conn.execute("DELETE FROM stats_daily")
+                await conn.execute("DELETE FROM stats_expiry_daily")
+                await conn.execute("DELETE FROM provisioning_outbox")
+                await conn.execute("DELETE FROM expiry_notifications")
+                await conn.execute("DELETE FROM pending_payments")
+                # Пересчёт загрузки узлов в той же транзакции: остаются только конфиги пула
+                await sync_nodes(conn)
+            subscription_cache.clear()
         
             await callback.message.edit_text(
                 text="✅ <b>База данных успешно очищена!</b>\n\nВся статистика обнулена.",
@@ -1070,7 +1015,11 @@ def register_admin_handlers(dp):
             await callback.answer("❌ Нет доступа", show_alert=True)
             return
     
-        await callback.answer("📊 Статистика пересчитана!", show_alert=True)
+        # Полная пересборка сводок из базовых таблиц (исправление расхождений)
+        if await rebuild_stats():
+            await callback.answer("📊 Статистика пересчитана!", show_alert=True)
+        else:
+            await callback.answer("❌ Ошибка пересчета статистики", show_alert=True)
     
         # Возвращаемся в главное меню с обновленной статистикой
         stats = await get_admin_stats()
@@ -1110,6 +1059,119 @@ def register_admin_handlers(dp):
     
         await callback.answer("⚙️ Настройки (функция в разработке)", show_alert=True)
 
+    @dp.callback_query(F.data == "admin_compensate")
+    async def admin_compensate_callback(callback: types.CallbackQuery):
+        """Выбор срока компенсации для всех активных подписок"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        await callback.message.edit_text(
+            text="<b>🩹 Компенсация простоя</b>\n\nНа сколько дней продлить все активные подписки?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="1 день", callback_data="admin_compensate_1"),
+                    InlineKeyboardButton(text="3 дня", callback_data="admin_compensate_3"),
+                    InlineKeyboardButton(text="7 дней", callback_data="admin_compensate_7")
+                ],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+
+    @dp.callback_query(F.data.regexp(r"^admin_compensate_\d+$"))
+    async def admin_compensate_days_callback(callback: types.CallbackQuery):
+        """Подтверждение компенсации"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        days = int(callback.data.rsplit('_', 1)[1])
+        await callback.message.edit_text(
+            text=f"⚠️ Продлить <b>все активные подписки</b> на <b>{days} дн.</b>?",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="✅ Да", callback_data=f"admin_compensate_confirm_{days}"),
+                    InlineKeyboardButton(text="❌ Отмена", callback_data="admin_compensate")
+                ]
+            ])
+        )
+
+    @dp.callback_query(F.data.startswith("admin_compensate_confirm_"))
+    async def admin_compensate_confirm_callback(callback: types.CallbackQuery):
+        """Компенсация всем активным подпискам"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        days = int(callback.data.rsplit('_', 1)[1])
+        await callback.answer("🔄 Продлеваем подписки...")
+        try:
+            total, extended = await compensate_active_users(days)
+            text = (f"✅ <b>Компенсация выполнена</b>\n\n"
+                    f"• Подписок продлено: <code>{total}</code> на {days} дн.\n"
+                    f"• Продлено на VPN серверах: <code>{extended}</code>")
+        except Exception as e:
+            logging.error(f"Ошибка компенсации: {e}")
+            text = "❌ Ошибка при компенсации"
+
+        await callback.message.edit_text(
+            text=text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+
+    @dp.callback_query(F.data == "admin_reconcile")
+    async def admin_reconcile_callback(callback: types.CallbackQuery):
+        """Отчёт последней сверки с VPN серверами"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        await callback.message.edit_text(
+            text=build_reconcile_text(),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="▶️ Запустить", callback_data="admin_reconcile_run"),
+                    InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_reconcile")
+                ],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+
+    @dp.callback_query(F.data == "admin_reconcile_run")
+    async def admin_reconcile_run_callback(callback: types.CallbackQuery):
+        """Запуск сверки с VPN серверами в фоне"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        reconciler = get_reconciler()
+        if not reconciler.configured:
+            await callback.answer("⚠️ Сверка не настроена: не задан VPN_API_STATUS_PATH", show_alert=True)
+            return
+        if not reconciler.start_run():
+            await callback.answer("⏳ Сверка уже идёт", show_alert=True)
+            return
+        await callback.answer("🔁 Сверка запущена")
+        await asyncio.sleep(0.5)
+        await admin_reconcile_callback(callback)
+
+    @dp.callback_query(F.data == "admin_metrics")
+    async def admin_metrics_callback(callback: types.CallbackQuery):
+        """Метрики фоновых компонентов"""
+        if not is_admin(callback.from_user.id):
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return
+
+        await callback.message.edit_text(
+            text=await build_metrics_text(),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_metrics")],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_manage")]
+            ])
+        )
+
     @dp.callback_query(F.data == "admin_logs")
     async def admin_logs_callback(callback: types.CallbackQuery):
         """Просмотр логов"""
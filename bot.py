@@ -2,7 +2,6 @@ import logging
 import asyncio
 from keyboards import get_user_keyboard
 from aiogram import types, F
-import aiosqlite
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
@@ -22,27 +21,39 @@ from config import (
     ADMIN_ID,
     PRICES,
     STARS_PROVIDER_TOKEN,
-    ADMIN_IDS,
-    MINIAPP_BASE_URL
+    ADMIN_IDS
 )
 from database import (
     init_db,
+    close_db,
     check_user_payment,
     add_payment,
+    PAYMENT_DUPLICATE,
     get_user_data,
-    get_vpn_config,
+    get_subscription_state,
+    issue_missing_config,
     add_bot_user,
     give_trial_subscription,
     has_trial
 )
-from payment import create_payment, check_payment_status
-from yookassa import Payment
+from interaction_buffer import start_buffer, stop_buffer
+from vpn_client import start_client, close_client
+from vpn_nodes import get_node
+from links import get_user_links
+from config_pool import start_refiller, stop_refiller
+from provisioning_outbox import PROVISION, set_notifier, start_worker, stop_worker
+import expiry_scheduler
+from reconciliation import start_reconciler, stop_reconciler
+from webhooks import start_webhooks, stop_webhooks
+from timestamps import now_ts, format_ts
+from payment import create_payment, settle_payment
+import pending_payments
+from yookassa_gateway import get_gateway, start_gateway, close_gateway
 from keyboards import (
     create_main_keyboard,
     get_subscription_keyboard,
     get_payment_check_keyboard
 )
-from urllib.parse import quote
 
 logging.basicConfig(
     level=logging.INFO,
@@ -257,11 +268,15 @@ async def connect_vpn(message: Message):
         user_data = await get_user_data(user_id)
         if user_data:
             expiry_date, config = user_data
-            config_clean = str(config).strip('\"\'')
-            vpn_config = f"vless://{config_clean}@146.103.102.21:443?type=tcp&security=reality&pbk=vouH_-SzPyt9HyyX7IuL0QTFppA1F8zkfWUUpLa2NEE&fp=chrome&sni=google.com&sid=47&flow=xtls-rprx-vision#1-a"
-            # Кастомная ссылка с конфигом внутри (URL-encoding обязателен)
-            encoded_config = quote(vpn_config, safe='')
-            miniapp_link = f"{MINIAPP_BASE_URL}/u/{user_id}?config={encoded_config}"
+            if not config:
+                # Подписка создана без конфига (VPN сервер был недоступен) — выдаём сейчас
+                config = await issue_missing_config(user_id)
+                if not config:
+                    await message.answer("Конфигурация ещё готовится. Попробуйте через минуту.")
+                    return
+            state = await get_subscription_state(user_id)
+            links = get_user_links(user_id, str(config), get_node(state.node_id if state else None))
+            miniapp_link = links.miniapp
             
             await message.answer(
                 text=f"""
@@ -270,6 +285,9 @@ async def connect_vpn(message: Message):
 <b>🔗 Мини-приложение:</b>
 <a href="{miniapp_link}">{miniapp_link}</a>
 
+<b>🔄 Ссылка-подписка</b> (конфиг обновится в приложении сам):
+<code>{links.subscription}</code>
+
 Статус подписки - <b>Активна 🟢</b>
 Действует до -<b> {expiry_date}</b>
 
@@ -298,23 +316,17 @@ async def subscription_callback(callback: types.CallbackQuery):
     try:
         period = callback.data.split('_')[1]
         
-        payment_info = await create_payment(period, callback.from_user.id)
+        # Платёж записывается в pending_payments и проверяется общим опросом
+        payment_info = await create_payment(
+            period,
+            callback.from_user.id,
+            callback.message.chat.id,
+            callback.message.message_id
+        )
         if not payment_info:
             await callback.answer("Ошибка при создании платежа", show_alert=True)
             return
         
-        # Формируем данные для проверки платежа в виде словаря
-        payment_data = {
-            'payment_id': payment_info['payment_id'],
-            'user_id': callback.from_user.id,
-            'message_id': callback.message.message_id,
-            'chat_id': callback.message.chat.id,
-            'period': payment_info['period']
-        }
-        
-        # Правильный вызов функции с 2 аргументами
-        asyncio.create_task(check_payment_status(payment_data, bot))
-        
         pay_keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(
                 text="💳 Оплатить ЮKassa",
@@ -363,7 +375,8 @@ async def check_payment_callback(callback: types.CallbackQuery):
     payment_id = callback.data.split(':')[1]
     
     try:
-        payment = await Payment.find_one(payment_id)
+        gateway = await get_gateway()
+        payment = await gateway.find_payment(payment_id)
         
         if payment.status == "succeeded":
             await callback.answer("Оплата уже подтверждена!", show_alert=True)
@@ -533,10 +546,16 @@ async def show_device_instructions(callback: types.CallbackQuery):
         return
     
     expiry_date, config = user_data
-    config_clean = str(config).strip('\"\'')
-    vpn_config = f"vless://{config_clean}@89.111.142.122:443?security=reality&encryption=none&pbk=HCt07BSW3zdncQ4BFpr33wUxnZ7-WWhGNWHmXV-VsBA&headerType=none&fp=chrome&type=tcp&flow=xtls-rprx-vision&sni=google.com&sid=92643cc23109a57d#ShardVPN"
-    encoded_config = quote(vpn_config, safe='')
-    miniapp_link = f"{MINIAPP_BASE_URL}/u/{user_id}?config={encoded_config}"
+    if not config:
+        # Подписка создана без конфига — выдаём, как при подключении
+        config = await issue_missing_config(user_id)
+        if not config:
+            await callback.answer("Конфигурация ещё готовится. Попробуйте через минуту.", show_alert=True)
+            return
+    state = await get_subscription_state(user_id)
+    links = get_user_links(user_id, str(config), get_node(state.node_id if state else None))
+    vpn_config = links.vless
+    miniapp_link = links.miniapp
     
     # Создаем клавиатуру с кнопками для приложения
     buttons = []
@@ -552,13 +571,7 @@ async def show_device_instructions(callback: types.CallbackQuery):
             buttons.append([InlineKeyboardButton(text="⬇️ Скачать V2RayTun", url=app_url)])
     
     # Добавляем кнопку "Установить VPN" с deep link для открытия приложения
-    deep_links = {
-        'ios': f"v2raytun://import/{vpn_config}",
-        'android': f"v2raytun://import/{vpn_config}",
-        'win': f"v2raytun://import/{vpn_config}",
-        'mac': f"v2raytun://import/{vpn_config}"
-    }
-    buttons.append([InlineKeyboardButton(text="🔌 Установить VPN", url=deep_links.get(device, ''))])
+    buttons.append([InlineKeyboardButton(text="🔌 Установить VPN", url=links.deep_link)])
     buttons.append([InlineKeyboardButton(text="🔗 Открыть миниапп", url=miniapp_link)])
     
     # Добавляем кнопку поддержки
@@ -699,10 +712,15 @@ async def successful_payment_handler(message: Message):
         # Определяем, была ли подписка активной до продления
         was_active = await check_user_payment(user_id)
 
-        success = await add_payment(user_id, period)
+        # Telegram может прислать то же сообщение об оплате повторно
+        success = await add_payment(
+            user_id, period, message.successful_payment.telegram_payment_charge_id, 'stars'
+        )
         if not success:
             await message.answer("Ошибка активации подписки. Обратитесь в поддержку.")
             return
+        if success == PAYMENT_DUPLICATE:
+            return
 
         user_data = await get_user_data(user_id)
         expiry_date = user_data[0] if user_data else "не определена"
@@ -719,9 +737,76 @@ async def successful_payment_handler(message: Message):
 <blockquote><i>🔹 Нажмите «Активировать VPN», чтобы начать пользоваться.</i></blockquote>""",
             message_effect_id="5046509860389126442"
         )
+async def notify_provisioning(job, ok: bool):
+    """Сообщает пользователю о выданном конфиге, администратору — о проваленном задании"""
+    if ok:
+        if job.operation == PROVISION:
+            await bot.send_message(
+                job.user_id,
+                "<b>✅ Конфигурация готова!</b>\n\nНажмите «🌐Активировать VPN», чтобы подключиться."
+            )
+        return
+    await bot.send_message(
+        ADMIN_ID,
+        f"⚠️ VPN-задание <code>{job.idempotency_key}</code> ({job.operation}) для пользователя "
+        f"<code>{job.user_id}</code> не выполнено после всех попыток"
+    )
+
+async def notify_expiry(user_id: int, kind: str, expiry_ts: int):
+    """Напоминание о скором окончании подписки и сообщение об отключении"""
+    if kind == expiry_scheduler.REVOKE:
+        await bot.send_message(
+            user_id,
+            "<b>⛔️ Подписка закончилась</b>\n\n"
+            "Доступ к VPN отключён. Оформите подписку, чтобы снова подключиться.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="💳 Оформить подписку", callback_data='subscribe_from_profile')]
+            ])
+        )
+        return
+    days = max(1, (expiry_ts - now_ts() + 86399) // 86400)
+    await bot.send_message(
+        user_id,
+        f"<b>⏳ Подписка заканчивается через {days} дн.</b>\n\n"
+        f"<b>Дата окончания:</b> <code>{format_ts(expiry_ts)}</code>\n\n"
+        "<blockquote><i>Продлите заранее, чтобы не потерять доступ.</i></blockquote>",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data='renew_sub')]
+        ])
+    )
+
+async def settle_polled_payment(payment) -> bool:
+    """Платёж с окончательным статусом, найденный опросом"""
+    return await settle_payment(payment, bot)
+
 async def main():
     await init_db()
-    await dp.start_polling(bot)
+    await start_client()
+    await start_gateway()
+    start_buffer()
+    start_refiller()
+    set_notifier(notify_provisioning)
+    start_worker()
+    expiry_scheduler.set_notifier(notify_expiry)
+    expiry_scheduler.start_scheduler()
+    start_reconciler()
+    pending_payments.set_handler(settle_polled_payment)
+    pending_payments.start_poller()
+    await start_webhooks(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await stop_webhooks()
+        await pending_payments.stop_poller()
+        await stop_reconciler()
+        await expiry_scheduler.stop_scheduler()
+        await stop_worker()
+        await stop_refiller()
+        # Дописываем накопленные взаимодействия до закрытия пула
+        await stop_buffer()
+        await close_client()
+        await close_gateway()
+        await close_db()
 
 if __name__ == '__main__':
     loop = asyncio.new_event_loop()
@@ -0,0 +1,114 @@
+import logging
+import time
+from config import VPN_BREAKER_FAILURES, VPN_BREAKER_RESET_SECONDS
+
+__all__ = [
+    'CLOSED',
+    'OPEN',
+    'HALF_OPEN',
+    'CircuitOpenError',
+    'CircuitBreaker',
+    'get_breaker',
+    'all_breakers'
+]
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(RuntimeError):
+    """Узел отключён автоматом — запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Автомат отключения узла: closed → open → half-open → closed.
+
+    После failure_threshold ошибок подряд узел отключается на reset_timeout
+    секунд: запросы к нему сразу завершаются CircuitOpenError. Затем
+    пропускается один пробный запрос; успех замыкает автомат, ошибка —
+    снова размыкает.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = VPN_BREAKER_FAILURES,
+                 reset_timeout: float = VPN_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        # Метрики
+        self.trips = 0
+        self.rejected = 0
+        self.total_failures = 0
+
+    def _maybe_half_open(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+
+    @property
+    def available(self) -> bool:
+        """Можно ли сейчас отправлять запросы (для выбора узла)"""
+        self._maybe_half_open()
+        return self.state == CLOSED or (self.state == HALF_OPEN and not self._probe_in_flight)
+
+    def allow(self) -> bool:
+        """Разрешает запрос; в half-open — только один пробный одновременно"""
+        self._maybe_half_open()
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def release_probe(self):
+        """Освобождает пробный запрос half-open, если он был отменён"""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logging.info(f"VPN-узел {self.name}: автомат замкнут, узел снова доступен")
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.total_failures += 1
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+                logging.error(f"VPN-узел {self.name}: автомат разомкнут после {self.failures} ошибок подряд")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        self._maybe_half_open()
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+            'total_failures': self.total_failures
+        }
+
+
+_breakers = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Автомат узла (создаётся при первом обращении)"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def all_breakers() -> dict:
+    return dict(_breakers)
@@ -1,6 +1,7 @@
 # Настройки бота
 from dotenv import load_dotenv
 import os
+import json
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN', '')
 CHANNEL_ID = '@probvpn123'
@@ -11,6 +12,44 @@ ADMIN_IDS = [2057750889]
 YOOKASSA_SHOP_ID = '1137264'
 YOOKASSA_SECRET_KEY = 'test_b6A8gP_TwQCAc8CZpHQrgsyxIP0xrmy3GYqSvfUiaEE'
 YOOKASSA_RETURN_URL = 'https://t.me/SHARDPROB_bot'
+# Адрес API ЮKassa (для тестов можно указать локальный сервер)
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+# HTTP-клиент ЮKassa (yookassa_gateway.py): пул соединений и таймауты
+YOOKASSA_POOL_SIZE = int(os.getenv('YOOKASSA_POOL_SIZE', '20'))  # соединений к API
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv('YOOKASSA_CONNECT_TIMEOUT', '3'))
+YOOKASSA_TIMEOUT = float(os.getenv('YOOKASSA_TIMEOUT', '10'))  # полный таймаут запроса, секунды
+YOOKASSA_RETRIES = int(os.getenv('YOOKASSA_RETRIES', '2'))  # повторов при сетевой ошибке и 5xx
+
+# Приём HTTP-уведомлений ЮKassa (webhooks.py); порт 0 — не запускать,
+# платежи тогда подтверждаются только опросом
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '0'))
+YOOKASSA_WEBHOOK_PATH = os.getenv('YOOKASSA_WEBHOOK_PATH', '/yookassa/webhook')
+# Адреса, с которых ЮKassa отправляет уведомления; пустой список — без проверки адреса
+YOOKASSA_WEBHOOK_IPS = [ip.strip() for ip in os.getenv(
+    'YOOKASSA_WEBHOOK_IPS',
+    '185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11,77.75.156.35,77.75.154.128/25,2a02:5180::/32'
+).split(',') if ip.strip()]
+# Перепроверять статус платежа запросом к API, а не верить телу уведомления
+YOOKASSA_WEBHOOK_VERIFY_API = os.getenv('YOOKASSA_WEBHOOK_VERIFY_API', '1') == '1'
+# Брать адрес клиента из X-Forwarded-For (бот за reverse proxy)
+WEBHOOK_TRUST_FORWARDED = os.getenv('WEBHOOK_TRUST_FORWARDED', '0') == '1'
+
+# Опрос статусов неоплаченных платежей (pending_payments.py): пары
+# «возраст платежа, с: интервал проверки, с». Старше последнего возраста
+# платёж считается брошенным и больше не проверяется.
+PAYMENT_POLL_SCHEDULE = [
+    tuple(int(x) for x in step.split(':'))
+    for step in os.getenv('PAYMENT_POLL_SCHEDULE', '300:10,1800:60,3600:300').split(',') if step.strip()
+]
+# При работающих уведомлениях опрос запасной: не чаще раза в столько секунд
+PAYMENT_POLL_INTERVAL = int(os.getenv('PAYMENT_POLL_INTERVAL', '60'))
+PAYMENT_POLL_BATCH_SIZE = int(os.getenv('PAYMENT_POLL_BATCH_SIZE', '100'))
+# С этого числа платежей в пачке статусы читаются списком платежей, а не по одному
+PAYMENT_POLL_LIST_THRESHOLD = int(os.getenv('PAYMENT_POLL_LIST_THRESHOLD', '3'))
+# Повторный выбор того же тарифа отдаёт уже созданный неоплаченный платёж
+PAYMENT_REUSE_TTL = float(os.getenv('PAYMENT_REUSE_TTL', '900'))  # секунды, меньше срока опроса
+PAYMENT_REUSE_CACHE_SIZE = int(os.getenv('PAYMENT_REUSE_CACHE_SIZE', '10000'))  # пар (пользователь, тариф)
 
 # Настройки VPN
 VPN_SERVER_URL = 'http://146.103.102.21:8080'
@@ -33,4 +72,129 @@ DB_PATH = os.path.join(BASE_DIR, 'users.db')
 
 # Базовый URL мини-приложения (укажите свой домен/хост)
 # Пример: 'https://mini.yourdomain.com'
-MINIAPP_BASE_URL = 'https://example.com'
\ No newline at end of file
+MINIAPP_BASE_URL = 'https://example.com'
+
+# Пул соединений SQLite: одно соединение на запись и N соединений на чтение
+DB_POOL_READERS = int(os.getenv('DB_POOL_READERS', '4'))
+
+# Профиль движка SQLite, применяется к каждому соединению
+# WAL позволяет читателям работать параллельно с единственным писателем
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # байты
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-65536'))  # отрицательное значение — в КиБ
+SQLITE_TEMP_STORE = os.getenv('SQLITE_TEMP_STORE', 'MEMORY')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Кэш состояния подписок в памяти (проверки статуса без обращения к БД)
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '10000'))  # пользователей
+SUBSCRIPTION_CACHE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_TTL', '60'))  # секунды
+LINK_CACHE_SIZE = int(os.getenv('LINK_CACHE_SIZE', '10000'))  # готовые ссылки пользователей
+
+# Отложенная запись взаимодействий с ботом (bot_users): сброс пачкой
+# каждые N миллисекунд или при накоплении M записей
+INTERACTION_FLUSH_INTERVAL_MS = int(os.getenv('INTERACTION_FLUSH_INTERVAL_MS', '500'))
+INTERACTION_FLUSH_MAX_RECORDS = int(os.getenv('INTERACTION_FLUSH_MAX_RECORDS', '500'))
+
+# HTTP-клиент VPN API: одна сессия на процесс с keep-alive и кэшем DNS
+VPN_SERVER_NAME = os.getenv('VPN_SERVER_NAME', 'nl')
+VPN_API_POOL_SIZE = int(os.getenv('VPN_API_POOL_SIZE', '100'))  # всего соединений
+VPN_API_POOL_PER_HOST = int(os.getenv('VPN_API_POOL_PER_HOST', '50'))  # соединений на один узел
+VPN_API_KEEPALIVE = float(os.getenv('VPN_API_KEEPALIVE', '30'))  # секунды простоя соединения
+VPN_API_DNS_TTL = int(os.getenv('VPN_API_DNS_TTL', '300'))  # секунды
+VPN_API_CONNECT_TIMEOUT = float(os.getenv('VPN_API_CONNECT_TIMEOUT', '3'))
+# Полный таймаут операции, секунды
+VPN_API_TIMEOUTS = {
+    'giveconfig': float(os.getenv('VPN_API_TIMEOUT_GIVE', '10')),
+    'extendconfig': float(os.getenv('VPN_API_TIMEOUT_EXTEND', '10')),
+    'revoke': float(os.getenv('VPN_API_TIMEOUT_REVOKE', '10')),
+    'status': float(os.getenv('VPN_API_TIMEOUT_STATUS', '3'))
+}
+
+# Реестр VPN-узлов. Узлы можно задать JSON-списком в VPN_NODES_JSON
+# с теми же полями; при старте реестр переносится в таблицу vpn_nodes.
+# capacity — сколько пользователей можно разместить на узле.
+VPN_DEFAULT_NODE = os.getenv('VPN_DEFAULT_NODE', 'nl')  # узел пользователей, выданных до появления реестра
+VPN_NODES = json.loads(os.getenv('VPN_NODES_JSON', 'null')) or [
+    {
+        'node_id': 'nl',
+        'api_url': VPN_SERVER_URL,
+        'api_key': VPN_AUTH_KEY,
+        'server': VPN_SERVER_NAME,
+        'host': '146.103.102.21',
+        'port': 443,
+        'pbk': 'vouH_-SzPyt9HyyX7IuL0QTFppA1F8zkfWUUpLa2NEE',
+        'sid': '47',
+        'sni': 'google.com',
+        'fp': 'chrome',
+        'flow': 'xtls-rprx-vision',
+        'label': '1-a',
+        'capacity': int(os.getenv('VPN_NODE_CAPACITY', '1000')),
+        'enabled': True
+    }
+]
+
+# Тёплый пул заранее выданных конфигов на каждом узле: фоновое пополнение
+# до верхней отметки, как только запас опускается ниже нижней
+VPN_CONFIG_POOL_LOW = int(os.getenv('VPN_CONFIG_POOL_LOW', '20'))
+VPN_CONFIG_POOL_HIGH = int(os.getenv('VPN_CONFIG_POOL_HIGH', '50'))
+VPN_CONFIG_POOL_DAYS = int(os.getenv('VPN_CONFIG_POOL_DAYS', '3'))  # срок конфига в пуле на сервере
+VPN_CONFIG_POOL_MAX_AGE_HOURS = int(os.getenv('VPN_CONFIG_POOL_MAX_AGE_HOURS', '48'))  # старше — не выдаются
+VPN_CONFIG_POOL_REFILL_INTERVAL = float(os.getenv('VPN_CONFIG_POOL_REFILL_INTERVAL', '30'))  # секунды
+VPN_CONFIG_POOL_REFILL_CONCURRENCY = int(os.getenv('VPN_CONFIG_POOL_REFILL_CONCURRENCY', '5'))
+
+# Объединение запросов /extendconfig: продления копятся короткое окно и уходят
+# параллельно (не больше VPN_EXTEND_CONCURRENCY одновременно) или одним пакетом,
+# если на сервере есть пакетный метод. Пакетный метод принимает
+# {"server": ..., "items": [{"uid": ..., "time": ...}]} и отвечает {uid: true/false}.
+VPN_EXTEND_WINDOW_MS = int(os.getenv('VPN_EXTEND_WINDOW_MS', '50'))
+VPN_EXTEND_MAX_BATCH = int(os.getenv('VPN_EXTEND_MAX_BATCH', '200'))
+VPN_EXTEND_CONCURRENCY = int(os.getenv('VPN_EXTEND_CONCURRENCY', '20'))
+VPN_API_BATCH_EXTEND_PATH = os.getenv('VPN_API_BATCH_EXTEND_PATH', '')  # пусто — пакетного метода нет
+
+# Отказоустойчивость VPN API: автомат отключения узла, повторы и хеджирование
+VPN_BREAKER_FAILURES = int(os.getenv('VPN_BREAKER_FAILURES', '5'))  # ошибок подряд до размыкания
+VPN_BREAKER_RESET_SECONDS = float(os.getenv('VPN_BREAKER_RESET_SECONDS', '30'))  # пауза до пробного запроса
+VPN_API_RETRIES = int(os.getenv('VPN_API_RETRIES', '2'))  # повторов после первой попытки
+VPN_API_BACKOFF_BASE = float(os.getenv('VPN_API_BACKOFF_BASE', '0.2'))  # секунды, удваивается
+VPN_API_BACKOFF_MAX = float(os.getenv('VPN_API_BACKOFF_MAX', '2'))
+VPN_API_HEDGE_AFTER_MS = int(os.getenv('VPN_API_HEDGE_AFTER_MS', '0'))  # 0 — без дублирующих запросов
+
+# Outbox VPN-заданий: выдача и продление конфигов после оплаты выполняются
+# фоновым обработчиком с повторами, оплата записывается без ожидания VPN API
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))  # секунды
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '10'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '12'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '5'))  # секунды, удваивается
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '900'))
+
+# Планировщик окончания подписок: напоминания за N дней и отзыв конфига в срок
+EXPIRY_REMINDER_DAYS = [int(d) for d in os.getenv('EXPIRY_REMINDER_DAYS', '3,1').split(',') if d.strip()]
+EXPIRY_REFRESH_INTERVAL = float(os.getenv('EXPIRY_REFRESH_INTERVAL', '300'))  # секунды, сдвиг окна загрузки
+EXPIRY_CATCHUP_HOURS = int(os.getenv('EXPIRY_CATCHUP_HOURS', '24'))  # истёкшие за это время при запуске отзываются
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', '500'))
+EXPIRY_NOTIFY_RATE = float(os.getenv('EXPIRY_NOTIFY_RATE', '20'))  # сообщений в секунду
+# Метод отзыва конфига на VPN сервере; пусто — истёкший конфиг не отзывается
+# и отключается сервером сам по своему сроку, сообщение об отключении не шлётся
+VPN_API_REVOKE_PATH = os.getenv('VPN_API_REVOKE_PATH', '')
+
+# Сверка сроков в БД и на VPN серверах; включается, только если на сервере
+# есть метод статуса. Он принимает {"server": ..., "uid": ...} и отвечает 200
+# с {"expiry": epoch}, а для удалённого конфига — {"expiry": null}; пакетный —
+# {"server": ..., "uids": [...]} → {uid: epoch или null}. Любой другой ответ,
+# в том числе 404, считается ошибкой, и конфиг не трогается.
+VPN_API_STATUS_PATH = os.getenv('VPN_API_STATUS_PATH', '')  # пусто — сверка выключена
+VPN_API_BATCH_STATUS_PATH = os.getenv('VPN_API_BATCH_STATUS_PATH', '')  # пусто — пакетного метода нет
+RECONCILE_CHUNK_SIZE = int(os.getenv('RECONCILE_CHUNK_SIZE', '500'))
+RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', '20'))
+RECONCILE_TOLERANCE_HOURS = int(os.getenv('RECONCILE_TOLERANCE_HOURS', '12'))  # расхождение в пределах нормы
+RECONCILE_INTERVAL_HOURS = float(os.getenv('RECONCILE_INTERVAL_HOURS', '0'))  # 0 — только вручную
+
+# Ссылка-подписка для клиентов (/sub/<token> в miniapp.py). Токен подписан
+# HMAC; по умолчанию ключ выводится из токена бота.
+SUBSCRIPTION_SECRET = os.getenv('SUBSCRIPTION_SECRET', '') or TOKEN
+SUBSCRIPTION_FEED_TTL = float(os.getenv('SUBSCRIPTION_FEED_TTL', '30'))  # секунды, параметры узлов не перечитываются
+SUBSCRIPTION_FEED_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_FEED_CACHE_SIZE', '10000'))
+SUBSCRIPTION_UPDATE_INTERVAL_HOURS = int(os.getenv('SUBSCRIPTION_UPDATE_INTERVAL_HOURS', '12'))
+SUBSCRIPTION_PROFILE_TITLE = os.getenv('SUBSCRIPTION_PROFILE_TITLE', 'Shard VPN')
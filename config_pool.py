@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import uuid
+import db_pool
+import vpn_client
+import vpn_nodes
+from config import (
+    VPN_CONFIG_POOL_LOW,
+    VPN_CONFIG_POOL_HIGH,
+    VPN_CONFIG_POOL_DAYS,
+    VPN_CONFIG_POOL_MAX_AGE_HOURS,
+    VPN_CONFIG_POOL_REFILL_INTERVAL,
+    VPN_CONFIG_POOL_REFILL_CONCURRENCY
+)
+from timestamps import now_ts
+
+__all__ = [
+    'POOL_SCHEMA',
+    'TAKE_SQL',
+    'take_config',
+    'extend_days',
+    'pool_levels',
+    'ConfigPoolRefiller',
+    'start_refiller',
+    'stop_refiller',
+    'get_refiller'
+]
+
+# Заранее выданные, ещё никому не назначенные конфиги. Они занимают место
+# на узле так же, как конфиги пользователей, и входят в vpn_nodes.user_count.
+POOL_SCHEMA = '''CREATE TABLE IF NOT EXISTS vpn_config_pool
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  node_id TEXT NOT NULL,
+                  config_id TEXT NOT NULL UNIQUE,
+                  created_ts INTEGER NOT NULL)'''
+
+# Самый старый ещё годный конфиг узла
+TAKE_SQL = """SELECT id, config_id, created_ts FROM vpn_config_pool
+              WHERE node_id = ? AND created_ts >= ?
+              ORDER BY id LIMIT 1"""
+
+
+def _min_created_ts() -> int:
+    """Конфиги, созданные раньше этого момента, уже не выдаются"""
+    return now_ts() - VPN_CONFIG_POOL_MAX_AGE_HOURS * 3600
+
+
+async def take_config(conn):
+    """Забирает конфиг из пула в транзакции вызывающего кода.
+
+    Узлы перебираются от наименее загруженного без проверки свободных мест:
+    конфиг пула уже занимает место на своём узле. Возвращает (config_id, node_id,
+    срок конфига на сервере) или (None, None, None), если на доступных узлах
+    запас пуст. Место на узле переходит к пользователю: вызывающий код
+    учитывает его через record_placement, как и для нового конфига.
+    """
+    nodes = vpn_nodes.placement_candidates(check_capacity=False)
+    min_created = _min_created_ts()
+    for node in nodes:
+        cursor = await conn.execute(TAKE_SQL, (node.node_id, min_created))
+        row = await cursor.fetchone()
+        if row:
+            await conn.execute("DELETE FROM vpn_config_pool WHERE id = ?", (row[0],))
+            await vpn_nodes.record_placement(conn, node.node_id, -1)
+            return row[1], node.node_id, row[2] + VPN_CONFIG_POOL_DAYS * 86400
+    return None, None, None
+
+
+def extend_days(server_expiry_ts: int, expiry_ts: int) -> int:
+    """На сколько дней продлить конфиг из пула, чтобы он дожил до expiry_ts.
+
+    Срок на сервере уже идёт с создания конфига, поэтому продление — только
+    недостающая часть, округлённая вверх до дня; 0 — продлевать не нужно.
+    """
+    return max(0, (expiry_ts - server_expiry_ts + 86399) // 86400)
+
+
+async def pool_levels(conn) -> dict:
+    """Запас пригодных конфигов по узлам: {node_id: количество}"""
+    cursor = await conn.execute(
+        "SELECT node_id, COUNT(*) FROM vpn_config_pool WHERE created_ts >= ? GROUP BY node_id",
+        (_min_created_ts(),)
+    )
+    return dict(await cursor.fetchall())
+
+
+class ConfigPoolRefiller:
+    """Фоновое пополнение пула конфигов по нижней и верхней отметкам.
+
+    Вызовы VPN API идут без соединений с БД; готовые конфиги записываются
+    короткой транзакцией и занимают место на узле. Устаревшие конфиги
+    удаляются из пула и освобождают место — на сервере они истекут сами.
+    """
+
+    def __init__(self, low: int = VPN_CONFIG_POOL_LOW, high: int = VPN_CONFIG_POOL_HIGH,
+                 interval: float = VPN_CONFIG_POOL_REFILL_INTERVAL,
+                 concurrency: int = VPN_CONFIG_POOL_REFILL_CONCURRENCY):
+        self.low = low
+        self.high = max(low, high)
+        self.interval = interval
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.provisioned = 0
+        self.failed = 0
+        self.expired = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def wakeup(self):
+        """Просит пополнить пул вне очереди (например, после выдачи конфига)"""
+        self._wakeup.set()
+
+    async def _provision(self, client, node):
+        async with self._semaphore:
+            try:
+                return await client.give_config(node, f"pool-{uuid.uuid4().hex[:12]}", VPN_CONFIG_POOL_DAYS)
+            except Exception as e:
+                logging.error(f"Ошибка пополнения пула на узле {node.node_id}: {e}")
+                return None
+
+    async def refill(self):
+        """Один проход: чистка устаревших и пополнение узлов ниже нижней отметки"""
+        min_created = _min_created_ts()
+        async with db_pool.transaction() as conn:
+            cursor = await conn.execute(
+                "SELECT node_id, COUNT(*) FROM vpn_config_pool WHERE created_ts < ? GROUP BY node_id",
+                (min_created,)
+            )
+            stale = await cursor.fetchall()
+            if stale:
+                await conn.execute("DELETE FROM vpn_config_pool WHERE created_ts < ?", (min_created,))
+            for node_id, count in stale:
+                await vpn_nodes.record_placement(conn, node_id, -count)
+                self.expired += count
+        async with db_pool.reader() as conn:
+            levels = await pool_levels(conn)
+
+        client = await vpn_client.get_client()
+        for node in vpn_nodes.all_nodes():
+            if not node.available:
+                continue
+            level = levels.get(node.node_id, 0)
+            if level >= self.low:
+                continue
+            # Не больше свободных мест на узле
+            needed = min(self.high - level, node.capacity - node.user_count)
+            results = await asyncio.gather(*(self._provision(client, node) for _ in range(needed)))
+            configs = [config_id for config_id in results if config_id]
+            self.failed += needed - len(configs)
+            if configs:
+                created = now_ts()
+                async with db_pool.transaction() as conn:
+                    cursor = await conn.executemany(
+                        "INSERT OR IGNORE INTO vpn_config_pool (node_id, config_id, created_ts) VALUES (?, ?, ?)",
+                        [(node.node_id, config_id, created) for config_id in configs]
+                    )
+                    await vpn_nodes.record_placement(conn, node.node_id, cursor.rowcount)
+                self.provisioned += len(configs)
+            logging.info(f"Пул конфигов {node.node_id}: было {level}, добавлено {len(configs)} из {needed}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logging.error(f"Ошибка пополнения пула конфигов: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logging.info(f"Пополнение пула конфигов запущено: {self.low}..{self.high} на узел")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'provisioned': self.provisioned,
+            'failed': self.failed,
+            'expired': self.expired
+        }
+
+
+_refiller = None
+
+
+def get_refiller() -> ConfigPoolRefiller:
+    global _refiller
+    if _refiller is None:
+        _refiller = ConfigPoolRefiller()
+    return _refiller
+
+
+def start_refiller():
+    get_refiller().start()
+
+
+async def stop_refiller():
+    if _refiller is not None:
+        await _refiller.stop()
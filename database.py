@@ -1,37 +1,84 @@
-import aiosqlite
+import asyncio
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-import aiohttp
 import logging
-from config import DB_PATH
+import db_pool
+from db_engine import read_engine_profile, format_engine_profile
+from migrations import apply_migrations
+from db_indexes import ensure_indexes, check_query_plans
+from timestamps import DISPLAY_FORMAT, to_ts, now_ts, day_start_ts, parse_date
+import stats_counters
+import subscription_cache
+import interaction_buffer
+import vpn_client
+import vpn_nodes
+import config_pool
+import extend_coalescer
+import provisioning_outbox
+import expiry_scheduler
+from subscription_cache import SubscriptionState
+from config import VPN_API_REVOKE_PATH
 
 __all__ = [
     'init_db',
+    'close_db',
     'check_user_payment',
+    'get_subscription_state',
+    'SubscriptionState',
     'add_payment',
+    'PAYMENT_APPLIED',
+    'PAYMENT_DUPLICATE',
     'get_user_data',
-    'get_vpn_config',
-    'get_vpn_config_days',
+    'provision_vpn_config',
     'extend_vpn_config',
     'get_all_users',
     'get_user_stats',
     'delete_user',
     'extend_user_subscription',
+    'compensate_active_users',
     'get_users_by_status',
     'get_payment_stats',
+    'UserStats',
+    'PaymentStats',
     'add_bot_user',
     'give_user_subscription',
     'give_trial_subscription',
     'has_trial',
+    'issue_missing_config',
     'deactivate_user_subscription',
     'activate_user_subscription',
     'block_user',
     'unblock_user',
-    'find_user_by_id'
+    'find_user_by_id',
+    'rebuild_stats',
+    'SUBSCRIPTION_STATE_SQL',
+    'HAS_TRIAL_SQL',
+    'BOT_USER_COUNTS_SQL',
+    'SUBSCRIPTION_COUNTS_SQL',
+    'users_by_status_sql'
 ]
 
-async def init_db():
-    """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_PATH) as db:
+# Запросы горячего пути; их планы проверяет db_indexes.check_query_plans
+SUBSCRIPTION_STATE_SQL = "SELECT expiry_ts, config, subscribed, expiry_date, node_id FROM users WHERE user_id = ?"
+HAS_TRIAL_SQL = "SELECT 1 FROM payments WHERE user_id = ? AND payment_method = 'trial' LIMIT 1"
+# Все пользователи бота и новые за сегодня/неделю — один проход по bot_users
+BOT_USER_COUNTS_SQL = """SELECT COUNT(*),
+                                COUNT(CASE WHEN first_interaction_ts >= :today THEN 1 END),
+                                COUNT(CASE WHEN first_interaction_ts >= :week THEN 1 END)
+                         FROM bot_users"""
+# Активные и истекшие подписки — проход по индексу users(subscribed, expiry_ts)
+SUBSCRIPTION_COUNTS_SQL = """SELECT COUNT(CASE WHEN expiry_ts > :now THEN 1 END),
+                                    COUNT(CASE WHEN expiry_ts <= :now THEN 1 END)
+                             FROM users WHERE subscribed = 1"""
+
+async def init_db(check_plans: bool = True):
+    """Инициализация базы данных и пула соединений.
+
+    При check_plans=True проверяет планы горячих запросов и бросает
+    QueryPlanError, если какой-то из них читает таблицу целиком.
+    """
+    await db_pool.init_pool()
+    async with db_pool.writer() as db:
         # Таблица пользователей VPN
         await db.execute('''CREATE TABLE IF NOT EXISTS users
                          (user_id INTEGER PRIMARY KEY,
@@ -61,246 +108,351 @@ async def init_db():
                           FOREIGN KEY (user_id) REFERENCES users (user_id))''')
         await db.commit()
 
+        version = await apply_migrations(db)
+        logging.info(f"Версия схемы БД: {version}")
+
+        await vpn_nodes.sync_nodes(db)
+
+        await ensure_indexes(db)
+        if check_plans:
+            await check_query_plans(db)
+
+        profile = await read_engine_profile(db)
+        logging.info(f"Профиль SQLite: {format_engine_profile(profile)}")
+
+async def _subscription_state(conn, user_id: int):
+    """(subscribed, expiry_ts, config, node_id) пользователя или None — для учёта в сводках"""
+    cursor = await conn.execute(
+        "SELECT subscribed, expiry_ts, config, node_id FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+    return await cursor.fetchone()
+
+async def close_db():
+    """Закрывает пул соединений с базой данных"""
+    await db_pool.close_pool()
+
 async def add_bot_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Добавляет пользователя в таблицу всех пользователей бота"""
+    """Добавляет пользователя в таблицу всех пользователей бота.
+
+    Запись отложенная: взаимодействие попадает в буфер и сбрасывается в БД
+    пачкой. Если фоновый сброс не запущен, буфер сбрасывается сразу.
+    """
     try:
-        current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Проверяем, есть ли уже такой пользователь
-            cursor = await conn.execute(
-                "SELECT user_id FROM bot_users WHERE user_id = ?",
-                (user_id,)
-            )
-            existing = await cursor.fetchone()
-            
-            if existing:
-                # Обновляем последнее взаимодействие
-                await conn.execute(
-                    "UPDATE bot_users SET last_interaction = ?, username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
-                    (current_time, username, first_name, last_name, user_id)
-                )
-                logging.info(f"Обновлен пользователь бота: {user_id}")
-            else:
-                # Добавляем нового пользователя
-                await conn.execute(
-                    "INSERT INTO bot_users (user_id, username, first_name, last_name, first_interaction, last_interaction) VALUES (?, ?, ?, ?, ?, ?)",
-                    (user_id, username, first_name, last_name, current_time, current_time)
-                )
-                logging.info(f"Добавлен новый пользователь бота: {user_id} ({first_name})")
-            
-            await conn.commit()
-            return True
+        buffer = interaction_buffer.get_buffer()
+        buffer.add(user_id, username, first_name, last_name)
+        if not buffer.running:
+            await buffer.flush()
+        return True
     except Exception as e:
         logging.error(f"Ошибка добавления пользователя бота {user_id}: {e}")
         return False
 
+async def get_subscription_state(user_id: int):
+    """Состояние подписки пользователя (SubscriptionState или None, если записи нет).
+
+    Читается из кэша в памяти; при промахе — одно чтение по первичному ключу.
+    """
+    state = subscription_cache.get(user_id)
+    if state is not subscription_cache.MISSING:
+        return state
+
+    generation = subscription_cache.generation()
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute(SUBSCRIPTION_STATE_SQL, (user_id,))
+        row = await cursor.fetchone()
+    state = SubscriptionState(row[0], row[1], bool(row[2]), row[3], row[4]) if row else None
+    subscription_cache.put(user_id, state, generation)
+    return state
+
 async def check_user_payment(user_id: int) -> bool:
     """Проверяет активную подписку пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT expiry_date FROM users WHERE user_id=?",
-            (user_id,)
-        )
-        row = await cursor.fetchone()
-        
-    if not row or not row[0]:
-        return False
-        
     try:
-        # Пробуем разные форматы даты
-        expiry_date_str = row[0]
-        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-        
-        for fmt in formats:
-            try:
-                expiry_date = datetime.strptime(expiry_date_str, fmt)
-                return datetime.now() < expiry_date
-            except ValueError:
-                continue
-        
-        return False
+        state = await get_subscription_state(user_id)
+        return bool(state and state.expiry_ts and state.expiry_ts > now_ts())
     except Exception as e:
         logging.error(f"Ошибка проверки подписки для {user_id}: {e}")
         return False
 
-async def add_payment(user_id: int, period_months: int) -> bool:
-    """Добавляет платеж и обновляет подписку"""
+async def _read_activation_state(conn, user_id: int):
+    """(expiry_ts, config, subscribed, node_id) пользователя или None"""
+    cursor = await conn.execute(
+        "SELECT expiry_ts, config, subscribed, node_id FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+    return await cursor.fetchone()
+
+# Результат add_payment (оба значения истинны; ошибка — False)
+PAYMENT_APPLIED = 'applied'
+PAYMENT_DUPLICATE = 'duplicate'  # платёж провайдера уже зачислен раньше
+
+
+async def add_payment(user_id: int, period_months: int, provider_txn_id: str = None,
+                      payment_method: str = 'yookassa'):
+    """Добавляет платеж и обновляет подписку.
+
+    Оплата записывается одной локальной транзакцией и не ждёт VPN API.
+    В той же транзакции в outbox ставится задание: продлить текущий конфиг
+    пользователя или конфиг из тёплого пула, а если пул пуст — выдать новый.
+    Задания выполняет фоновый обработчик с повторами; пока конфиг не выдан,
+    подписка активна с пустым конфигом.
+
+    provider_txn_id — идентификатор платежа у провайдера. Запись в payments
+    идёт первой и условно (уникальный индекс по способу оплаты и этому
+    идентификатору): повторная доставка того же платежа — из уведомления,
+    опроса или другой копии бота — ничего не меняет и возвращает
+    PAYMENT_DUPLICATE.
+    """
     try:
-        payment_date = datetime.now()
-        
         # Определяем сумму платежа
         prices = {1: 149, 3: 399, 6: 699, 12: 999}
         amount = prices.get(period_months, 149)
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
+        days = 30 * period_months
+
+        payment_date = datetime.now()
+        async with db_pool.transaction() as conn:
+            cursor = await conn.execute('''
+                INSERT INTO payments (user_id, amount, period, payment_date, payment_method, payment_ts, provider_txn_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (payment_method, provider_txn_id) DO NOTHING
+                ''',
+                (user_id, amount, period_months, payment_date.strftime(DISPLAY_FORMAT), payment_method,
+                 to_ts(payment_date), provider_txn_id)
+            )
+            if not cursor.rowcount:
+                logging.info(f"Платеж {payment_method}:{provider_txn_id} уже зачислен, повтор пропущен")
+                return PAYMENT_DUPLICATE
+            payment_id = cursor.lastrowid
+
+            current = await _read_activation_state(conn, user_id)
+
             cursor = await conn.execute(
-                "SELECT user_id FROM bot_users WHERE user_id = ?",
+                "SELECT 1 FROM bot_users WHERE user_id = ?",
                 (user_id,)
             )
-            bot_user_exists = await cursor.fetchone()
-            
-            if not bot_user_exists:
-                current_time = datetime.now().strftime('%d.%m.%Y %H:%M')
+            if not await cursor.fetchone():
+                current_time = payment_date.strftime(DISPLAY_FORMAT)
                 await conn.execute(
-                    "INSERT INTO bot_users (user_id, first_interaction, last_interaction) VALUES (?, ?, ?)",
-                    (user_id, current_time, current_time)
+                    """INSERT INTO bot_users (user_id, first_interaction, last_interaction,
+                                              first_interaction_ts, last_interaction_ts)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (user_id, current_time, current_time, to_ts(payment_date), to_ts(payment_date))
                 )
+                await stats_counters.record_bot_user(conn, to_ts(payment_date))
                 logging.info(f"Пользователь {user_id} добавлен в bot_users при оплате")
-            
-            # Получаем текущие данные пользователя
-            cursor = await conn.execute(
-                "SELECT expiry_date, config FROM users WHERE user_id=?",
-                (user_id,)
-            )
-            row = await cursor.fetchone()
-            
-            if row and row[0]:  # Если есть существующая подписка
-                try:
-                    # Пробуем разные форматы даты
-                    formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                    current_expiry = None
-                    
-                    for fmt in formats:
-                        try:
-                            current_expiry = datetime.strptime(row[0], fmt)
-                            break
-                        except ValueError:
-                            continue
-                    
-                    if current_expiry:
-                        # Определяем базовую дату для продления
-                        if current_expiry > datetime.now():  # Если подписка еще активна
-                            base_date = current_expiry  # Продлеваем от даты окончания
-                        else:  # Если подписка истекла
-                            base_date = datetime.now()  # Продлеваем от текущей даты
-                            
-                        # Рассчитываем новую дату окончания
-                        expiry_date = base_date + timedelta(days=30 * period_months)
-                    else:
-                        expiry_date = datetime.now() + timedelta(days=30 * period_months)
-                        
-                except Exception as e:
-                    logging.error(f"Ошибка парсинга даты: {e}")
-                    expiry_date = datetime.now() + timedelta(days=30 * period_months)
-                
-                # Пытаемся продлить конфиг на VPN сервере
-                extend_success = await extend_vpn_config(user_id, 30 * period_months)
-                if not extend_success:
-                    logging.warning(f"Не удалось продлить конфиг для user_id={user_id}, но продолжаем")
-                    
-                config_id = row[1]  # Используем существующий config_id
-                
-            else:  # Для нового пользователя
-                expiry_date = datetime.now() + timedelta(days=30 * period_months)
-                config_id = await get_vpn_config(user_id, period_months)
-                if not config_id:
-                    logging.error(f"Не удалось получить конфиг для user_id={user_id}")
-                    return False
-            
-            # Обновляем данные пользователя в БД
+
+            # Продлеваем от даты окончания, прочитанной в этой же транзакции:
+            # параллельные продления суммируются, а не затирают друг друга
+            if current and current[0] and current[0] > to_ts(payment_date):
+                base_date = datetime.fromtimestamp(current[0])
+            else:
+                base_date = payment_date
+            expiry_date = base_date + timedelta(days=days)
+
+            # Есть конфиг — продлеваем его, иначе берём из тёплого пула
+            config_id, node_id = (current[1], current[3]) if current and current[1] else (None, None)
+            from_pool = False
+            extend_days = days
+            if not config_id:
+                config_id, node_id, server_expiry = await config_pool.take_config(conn)
+                from_pool = bool(config_id)
+                if from_pool:
+                    # Конфиг из пула уже живёт на сервере — досылаем только недостающие дни
+                    extend_days = config_pool.extend_days(server_expiry, to_ts(expiry_date))
+
             await conn.execute('''
                 INSERT OR REPLACE INTO users 
-                (user_id, subscribed, payment_date, expiry_date, config, last_update)
-                VALUES (?, ?, ?, ?, ?, ?)
+                (user_id, subscribed, payment_date, expiry_date, config, last_update, payment_ts, expiry_ts, node_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''',
                 (
                     user_id,
                     True,
-                    payment_date.strftime('%d.%m.%Y %H:%M'),
-                    expiry_date.strftime('%d.%m.%Y %H:%M'),
-                    config_id,
-                    datetime.now().strftime('%d.%m.%Y %H:%M')
+                    payment_date.strftime(DISPLAY_FORMAT),
+                    expiry_date.strftime(DISPLAY_FORMAT),
+                    config_id or '',
+                    payment_date.strftime(DISPLAY_FORMAT),
+                    to_ts(payment_date),
+                    to_ts(expiry_date),
+                    node_id
                 )
             )
-            
-            # Добавляем запись о платеже
-            await conn.execute('''
-                INSERT INTO payments (user_id, amount, period, payment_date, payment_method)
-                VALUES (?, ?, ?, ?, ?)
-                ''',
-                (user_id, amount, period_months, payment_date.strftime('%d.%m.%Y %H:%M'), 'yookassa')
-            )
-            
-            await conn.commit()
-            logging.info(f"Подписка успешно добавлена для пользователя {user_id} на {period_months} мес.")
-            return True
-            
+            if from_pool:
+                await vpn_nodes.record_placement(conn, node_id, 1)
+
+            await stats_counters.record_payment(conn, amount, to_ts(payment_date))
+            old_state = (current[2], current[0]) if current else None
+            await stats_counters.move_subscription(conn, old_state, (1, to_ts(expiry_date)))
+
+            # Задание для VPN API — в той же транзакции, что и платёж
+            if config_id:
+                if extend_days:
+                    await provisioning_outbox.enqueue(conn, f"payment:{payment_id}:extend", provisioning_outbox.EXTEND,
+                                                      user_id, extend_days, config_id, node_id)
+            elif not await provisioning_outbox.has_pending(conn, user_id, provisioning_outbox.PROVISION):
+                # Одна выдача на пользователя: срок на сервере берётся из подписки при выполнении
+                await provisioning_outbox.enqueue(conn, f"payment:{payment_id}:provision", provisioning_outbox.PROVISION,
+                                                  user_id, days)
+
+        subscription_cache.invalidate(user_id)
+        expiry_scheduler.touch(user_id, to_ts(expiry_date))
+        _wake_provisioning(from_pool)
+        logging.info(f"Подписка успешно добавлена для пользователя {user_id} на {period_months} мес.")
+        return PAYMENT_APPLIED
+
     except Exception as e:
         logging.error(f"Ошибка в add_payment: {str(e)}", exc_info=True)
         return False
 
-async def get_vpn_config(user_id: int, period_months: int) -> str:
-    """Получает конфигурацию VPN от сервера"""
-    url = "http://146.103.102.21:8080/giveconfig"
-    data = {
-        "time": 30 * period_months,
-        "id": str(user_id),
-        "server": "nl"
-    }
-    headers = {
-        "x-api-key": "18181818"
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=data, headers=headers) as resp:
-                if resp.status == 200:
-                    return await resp.text()
-                logging.error(f"Ошибка VPN сервера: {resp.status}")
-                return None
-    except Exception as e:
-        logging.error(f"Ошибка получения конфига: {e}")
-        return None
+def _days_left(expiry_ts: int) -> int:
+    """Оставшийся срок подписки в днях, с округлением вверх"""
+    return max(1, (expiry_ts - now_ts() + 86399) // 86400)
 
-async def get_vpn_config_days(user_id: int, days: int) -> str:
-    """Упрощенная выдача конфига на фиксированное число дней"""
-    months = max(1, days // 30) if days >= 30 else 1
-    return await get_vpn_config(user_id, months)
+def _wake_provisioning(from_pool: bool = False):
+    """Будит обработчик outbox после записи задания и пополнение пула после выдачи из него"""
+    provisioning_outbox.get_worker().wakeup()
+    if from_pool:
+        config_pool.get_refiller().wakeup()
+
+async def _enqueue_pool_extend(conn, user_id: int, expiry_ts: int, config_id: str, node_id: str,
+                               server_expiry_ts: int):
+    """Ставит продление конфига из пула до срока подписки (в транзакции вызывающего кода)"""
+    days = config_pool.extend_days(server_expiry_ts, expiry_ts)
+    if days:
+        await provisioning_outbox.enqueue(conn, f"pool:{config_id}", provisioning_outbox.EXTEND,
+                                          user_id, days, config_id, node_id)
+
+async def _run_extend_job(job) -> bool:
+    """Задание outbox: продление конфига на VPN сервере"""
+    return await extend_vpn_config(job.user_id, job.days, config_id=job.config_id, node_id=job.node_id,
+                                   idempotency_key=job.idempotency_key)
+
+async def _run_provision_job(job) -> bool:
+    """Задание outbox: выдача конфига подписке, оплаченной без него.
+
+    Срок на сервере — оставшийся срок подписки на момент выдачи. Если подписку
+    продлили, пока конфиг выдавался, разница досылается отдельным продлением.
+    """
+    async with db_pool.reader() as conn:
+        row = await _subscription_state(conn, job.user_id)
+    if not row or not row[1] or row[1] <= now_ts() or row[2]:
+        # Конфиг уже выдан (например, при подключении) или подписка закончилась
+        return True
+
+    config_id, node_id = await provision_vpn_config(job.user_id, _days_left(row[1]),
+                                                    idempotency_key=job.idempotency_key)
+    if not config_id:
+        return False
+
+    applied = False
+    async with db_pool.transaction() as conn:
+        current = await _subscription_state(conn, job.user_id)
+        if current and not current[2]:
+            await conn.execute(
+                "UPDATE users SET config = ?, node_id = ? WHERE user_id = ?",
+                (config_id, node_id, job.user_id)
+            )
+            await vpn_nodes.record_placement(conn, node_id, 1)
+            if current[1] and current[1] > row[1]:
+                await provisioning_outbox.enqueue(
+                    conn, f"{job.idempotency_key}:topup", provisioning_outbox.EXTEND, job.user_id,
+                    (current[1] - row[1] + 86399) // 86400, config_id, node_id
+                )
+            applied = True
+    if applied:
+        subscription_cache.invalidate(job.user_id)
+        _wake_provisioning()
+    else:
+        logging.warning(f"Конфиг для user_id={job.user_id} уже выдан параллельно, {config_id} не используется")
+    return True
+
+async def _run_revoke_job(job) -> bool:
+    """Задание outbox: отзыв конфига истёкшей подписки.
+
+    Конфиг сначала открепляется от пользователя (если подписку не успели
+    продлить), затем отзывается на сервере. Продлённая после этого подписка
+    получит новый конфиг из пула. Без метода отзыва на сервере задание
+    ничего не меняет: конфиг остаётся за пользователем до своего срока.
+    """
+    if not VPN_API_REVOKE_PATH:
+        logging.info(f"Отзыв {job.config_id} пропущен: не задан VPN_API_REVOKE_PATH")
+        return True
+    renewed = False
+    async with db_pool.transaction() as conn:
+        row = await _subscription_state(conn, job.user_id)
+        if row and row[2] == job.config_id:
+            if row[1] and row[1] > now_ts():
+                renewed = True
+            else:
+                await conn.execute(
+                    "UPDATE users SET config = '', node_id = NULL WHERE user_id = ?",
+                    (job.user_id,)
+                )
+                await vpn_nodes.record_placement(conn, row[3], -1)
+    if renewed:
+        return True
+    subscription_cache.invalidate(job.user_id)
+
+    client = await vpn_client.get_client()
+    return await client.revoke_config(vpn_nodes.get_node(job.node_id), job.config_id)
+
+provisioning_outbox.register_handler(provisioning_outbox.EXTEND, _run_extend_job)
+provisioning_outbox.register_handler(provisioning_outbox.PROVISION, _run_provision_job)
+provisioning_outbox.register_handler(provisioning_outbox.REVOKE, _run_revoke_job)
+
+async def provision_vpn_config(user_id: int, days: int, idempotency_key: str = None):
+    """Выдаёт новый конфиг на наименее загруженном доступном узле.
+
+    Если узел не ответил или отключён автоматом, пробует следующий.
+    Возвращает (config_id, node_id) или (None, None).
+    """
+    candidates = vpn_nodes.placement_candidates()
+    if not candidates:
+        logging.error(f"Нет доступных VPN-узлов со свободными местами для user_id={user_id}")
+        return None, None
+    client = await vpn_client.get_client()
+    for node in candidates:
+        try:
+            config_id = await client.give_config(node, user_id, days, idempotency_key=idempotency_key)
+        except Exception as e:
+            logging.error(f"Ошибка получения конфига на узле {node.node_id}: {e}")
+            continue
+        if config_id:
+            return config_id, node.node_id
+    return None, None
 
 async def get_user_data(user_id: int):
-    """Получает данные пользователя из БД"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT expiry_date, config FROM users WHERE user_id=?",
-            (user_id,)
-        )
-        row = await cursor.fetchone()
-        if row and row[0]:
-            return row
-        return None
+    """Получает данные пользователя (expiry_date, config)"""
+    state = await get_subscription_state(user_id)
+    if state and state.expiry_date:
+        return state.expiry_date, state.config
+    return None
 
-async def extend_vpn_config(user_id: int, days: int) -> bool:
-    """Продлевает конфигурацию VPN на сервере"""
+async def extend_vpn_config(user_id: int, days: int, config_id: str = None, node_id: str = None,
+                            idempotency_key: str = None) -> bool:
+    """Продлевает конфигурацию VPN на узле пользователя.
+
+    Если config_id не передан, конфиг и узел читаются из БД; соединение
+    освобождается до сетевого запроса. idempotency_key уходит на сервер
+    заголовком Idempotency-Key, чтобы повтор задания outbox не продлил дважды.
+    """
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT config FROM users WHERE user_id=?",
-                (user_id,)
-            )
-            row = await cursor.fetchone()
-            if not row or not row[0]:
-                logging.error(f"Не найден конфиг для user_id={user_id}")
-                return False
-                
-            config_id = row[0].strip('"\'')  # Удаляем лишние кавычки
+        if config_id is None:
+            async with db_pool.reader() as conn:
+                cursor = await conn.execute(
+                    "SELECT config, node_id FROM users WHERE user_id=?",
+                    (user_id,)
+                )
+                row = await cursor.fetchone()
+            config_id, node_id = row if row else (None, None)
+        if not config_id:
+            logging.error(f"Не найден конфиг для user_id={user_id}")
+            return False
             
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "http://146.103.102.21:8080/extendconfig",
-                json={
-                    "time": days, 
-                    "uid": config_id,
-                    "server": "nl"
-                },
-                headers={"x-api-key": "18181818"},
-                timeout=10
-            ) as resp:
-                if resp.status != 200:
-                    error = await resp.text()
-                    logging.error(f"Ошибка продления: {resp.status} - {error}")
-                    return False
-                return True
+        config_id = config_id.strip('"\'')  # Удаляем лишние кавычки
+
+        # Через объединитель: массовые продления уходят параллельно или пакетом
+        return await extend_coalescer.extend(vpn_nodes.get_node(node_id), config_id, days, idempotency_key)
                 
     except Exception as e:
         logging.error(f"Ошибка в extend_vpn_config: {str(e)}", exc_info=True)
@@ -310,258 +462,264 @@ async def extend_vpn_config(user_id: int, days: int) -> bool:
 
 async def get_all_users(limit: int = 50, offset: int = 0):
     """Получает всех пользователей с пагинацией"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db_pool.reader() as conn:
         cursor = await conn.execute(
             """SELECT user_id, subscribed, payment_date, expiry_date, config, last_update 
-               FROM users ORDER BY payment_date DESC LIMIT ? OFFSET ?""",
+               FROM users ORDER BY payment_ts DESC LIMIT ? OFFSET ?""",
             (limit, offset)
         )
         return await cursor.fetchall()
 
-async def get_user_stats():
-    """Получает статистику пользователей"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        stats = {}
-        
-        # Всего пользователей бота (кто запускал /start)
-        cursor = await conn.execute("SELECT COUNT(*) FROM bot_users")
-        stats['total_users'] = (await cursor.fetchone())[0]
-        
-        # Активные подписки - проверяем все пользователей программно
-        cursor = await conn.execute("SELECT user_id, expiry_date FROM users WHERE subscribed = 1")
-        all_subscribed = await cursor.fetchall()
-        
-        active_count = 0
-        for user_id, expiry_date in all_subscribed:
-            if expiry_date and is_subscription_active_check(expiry_date):
-                active_count += 1
-        
-        stats['active_users'] = active_count
-        
-        # Новые за сегодня (кто запустил бота)
-        today = datetime.now().strftime('%d.%m.%Y')
-        cursor = await conn.execute(
-            "SELECT COUNT(*) FROM bot_users WHERE first_interaction LIKE ?",
-            (f"{today}%",)
-        )
-        stats['new_today'] = (await cursor.fetchone())[0]
-        
-        # Новые за неделю (кто запустил бота)
-        cursor = await conn.execute("SELECT user_id, first_interaction FROM bot_users")
-        all_bot_users = await cursor.fetchall()
-        
-        week_ago = datetime.now() - timedelta(days=7)
-        new_week = 0
-        
-        for user_id, first_interaction in all_bot_users:
-            if first_interaction:
-                try:
-                    formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                    for fmt in formats:
-                        try:
-                            interaction_date = datetime.strptime(first_interaction, fmt)
-                            if interaction_date >= week_ago:
-                                new_week += 1
-                            break
-                        except ValueError:
-                            continue
-                except:
-                    pass
+@dataclass
+class UserStats:
+    """Статистика пользователей бота и подписок"""
+    total_users: int = 0
+    active_subs: int = 0
+    expired_subs: int = 0
+    new_today: int = 0
+    new_week: int = 0
+
+async def get_user_stats() -> UserStats:
+    """Получает статистику пользователей: по одному агрегирующему запросу на таблицу"""
+    now = now_ts()
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute(BOT_USER_COUNTS_SQL, {'today': day_start_ts(), 'week': now - 7 * 86400})
+        total_users, new_today, new_week = await cursor.fetchone()
         
-        stats['new_week'] = new_week
+        cursor = await conn.execute(SUBSCRIPTION_COUNTS_SQL, {'now': now})
+        active_subs, expired_subs = await cursor.fetchone()
         
-        return stats
+    return UserStats(
+        total_users=total_users,
+        active_subs=active_subs,
+        expired_subs=expired_subs,
+        new_today=new_today,
+        new_week=new_week
+    )
 
 def is_subscription_active_check(expiry_date_str: str) -> bool:
-    """Проверяет активность подписки с поддержкой разных форматов"""
+    """Проверяет активность подписки по текстовой дате (для старых данных и отображения)"""
     if not expiry_date_str:
         return False
     
     try:
-        formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-        for fmt in formats:
-            try:
-                expiry_date = datetime.strptime(expiry_date_str, fmt)
-                return datetime.now() < expiry_date
-            except ValueError:
-                continue
-        return False
+        expiry_date = parse_date(expiry_date_str)
+        return bool(expiry_date and datetime.now() < expiry_date)
     except Exception as e:
         logging.error(f"Ошибка проверки даты {expiry_date_str}: {e}")
         return False
 
-async def get_users_by_status(status: str, limit: int = 20):
-    """Получает пользователей по статусу"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT user_id, expiry_date, subscribed FROM users ORDER BY payment_date DESC"
-        )
-        all_users = await cursor.fetchall()
-        
-        result = []
-        count = 0
-        
-        for user_id, expiry_date, subscribed in all_users:
-            if count >= limit:
-                break
-                
-            is_active = False
-            if expiry_date and subscribed:
-                is_active = is_subscription_active_check(expiry_date)
-            
-            if status == "active" and is_active:
-                result.append((user_id, expiry_date))
-                count += 1
-            elif status == "expired" and subscribed and not is_active and expiry_date:
-                result.append((user_id, expiry_date))
-                count += 1
-            elif status == "expiring" and is_active and expiry_date:
-                # Проверяем, истекает ли в ближайшие 3 дня
-                try:
-                    formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                    for fmt in formats:
-                        try:
-                            exp_date = datetime.strptime(expiry_date, fmt)
-                            days_left = (exp_date - datetime.now()).days
-                            if 0 <= days_left <= 3:
-                                result.append((user_id, expiry_date))
-                                count += 1
-                            break
-                        except ValueError:
-                            continue
-                except:
-                    pass
-        
-        return result
+# Условия и порядок выборки для списков пользователей по статусу.
+# Порядок идёт по индексу users(subscribed, expiry_ts), user_id — rowid таблицы,
+# поэтому пара (expiry_ts, user_id) служит курсором для keyset-пагинации.
+USER_STATUS_QUERIES = {
+    'active': ("expiry_ts > :now", 'DESC'),
+    'expired': ("expiry_ts <= :now", 'DESC'),
+    # Истекает в ближайшие 3 полных дня
+    'expiring': ("expiry_ts > :now AND expiry_ts < :now + 4 * 86400", 'ASC')
+}
 
-async def get_payment_stats():
-    """Получает статистику платежей"""
+def encode_user_cursor(expiry_ts: int, user_id: int) -> str:
+    """Курсор страницы для callback_data"""
+    return f"{expiry_ts}:{user_id}"
+
+def decode_user_cursor(cursor: str):
+    """Разбирает курсор страницы, возвращает (expiry_ts, user_id) или None"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            stats = {}
-            
-            # Доход за сегодня
-            today = datetime.now().strftime('%d.%m.%Y')
+        expiry_ts, user_id = cursor.split(':')
+        return int(expiry_ts), int(user_id)
+    except (AttributeError, ValueError):
+        return None
+
+def users_by_status_sql(status: str, after: bool = False) -> str:
+    """Запрос страницы списка по статусу; after — с курсором предыдущей страницы"""
+    condition, order = USER_STATUS_QUERIES[status]
+    if after:
+        op = '<' if order == 'DESC' else '>'
+        condition += f" AND (expiry_ts, user_id) {op} (:after_ts, :after_id)"
+    return f"""SELECT user_id, expiry_date, expiry_ts FROM users
+               WHERE subscribed = 1 AND {condition}
+               ORDER BY expiry_ts {order}, user_id {order} LIMIT :limit"""
+
+async def get_users_by_status(status: str, limit: int = 20, cursor: str = None):
+    """Получает страницу пользователей по статусу.
+
+    Возвращает (rows, next_cursor): rows — список (user_id, expiry_date),
+    next_cursor — курсор следующей страницы или None, если это последняя.
+    """
+    if status not in USER_STATUS_QUERIES:
+        return [], None
+    params = {'now': now_ts(), 'limit': limit + 1}
+
+    after = decode_user_cursor(cursor) if cursor else None
+    if after:
+        params['after_ts'], params['after_id'] = after
+    
+    async with db_pool.reader() as conn:
+        db_cursor = await conn.execute(users_by_status_sql(status, bool(after)), params)
+        rows = await db_cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_user_id, _, last_expiry_ts = rows[-1]
+        next_cursor = encode_user_cursor(last_expiry_ts, last_user_id)
+    return [(user_id, expiry_date) for user_id, expiry_date, _ in rows], next_cursor
+
+@dataclass
+class PaymentStats:
+    """Статистика платежей"""
+    revenue_today: float = 0
+    revenue_week: float = 0
+    revenue_month: float = 0
+    avg_payment: float = 0
+    subs_1m: int = 0
+    subs_3m: int = 0
+    subs_6m: int = 0
+    subs_12m: int = 0
+
+async def get_payment_stats() -> PaymentStats:
+    """Получает статистику платежей одним агрегирующим запросом с группировкой по периоду"""
+    try:
+        now = now_ts()
+        async with db_pool.reader() as conn:
             cursor = await conn.execute(
-                "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE payment_date LIKE ?",
-                (f"{today}%",)
+                """SELECT period,
+                          COUNT(*),
+                          COALESCE(SUM(amount), 0),
+                          COALESCE(SUM(CASE WHEN payment_ts >= :today THEN amount END), 0),
+                          COALESCE(SUM(CASE WHEN payment_ts >= :week THEN amount END), 0),
+                          COALESCE(SUM(CASE WHEN payment_ts >= :month THEN amount END), 0)
+                   FROM payments GROUP BY period""",
+                {'today': day_start_ts(), 'week': now - 7 * 86400, 'month': now - 30 * 86400}
             )
-            result = await cursor.fetchone()
-            stats['revenue_today'] = result[0] if result else 0
-            
-            # Доход за неделю - программная проверка
-            cursor = await conn.execute("SELECT amount, payment_date FROM payments")
-            all_payments = await cursor.fetchall()
-            
-            revenue_week = 0
-            revenue_month = 0
-            
-            if all_payments:
-                week_ago = datetime.now() - timedelta(days=7)
-                month_ago = datetime.now() - timedelta(days=30)
-                
-                for amount, payment_date in all_payments:
-                    if payment_date and amount:
-                        try:
-                            formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                            for fmt in formats:
-                                try:
-                                    pay_date = datetime.strptime(payment_date, fmt)
-                                    if pay_date >= week_ago:
-                                        revenue_week += amount
-                                    if pay_date >= month_ago:
-                                        revenue_month += amount
-                                    break
-                                except ValueError:
-                                    continue
-                        except:
-                            pass
-            
-            stats['revenue_week'] = revenue_week
-            stats['revenue_month'] = revenue_month
-            
-            # Средний чек
-            cursor = await conn.execute("SELECT AVG(amount) FROM payments")
-            avg_result = await cursor.fetchone()
-            stats['avg_payment'] = round(avg_result[0], 2) if avg_result and avg_result[0] else 0
-            
+            rows = await cursor.fetchall()
+        
+        stats = PaymentStats()
+        total_count = 0
+        total_amount = 0
+        for period, count, amount, today, week, month in rows:
+            total_count += count
+            total_amount += amount
+            stats.revenue_today += today
+            stats.revenue_week += week
+            stats.revenue_month += month
             # Подписки по периодам
-            for period in [1, 3, 6, 12]:
-                cursor = await conn.execute(
-                    "SELECT COUNT(*) FROM payments WHERE period = ?",
-                    (period,)
-                )
-                result = await cursor.fetchone()
-                stats[f'subs_{period}m'] = result[0] if result else 0
-            
-            return stats
+            if period in (1, 3, 6, 12):
+                setattr(stats, f'subs_{period}m', count)
+        
+        # Средний чек
+        stats.avg_payment = round(total_amount / total_count, 2) if total_count else 0
+        return stats
     except Exception as e:
         logging.error(f"Ошибка получения статистики платежей: {e}")
-        return {
-            'revenue_today': 0,
-            'revenue_week': 0,
-            'revenue_month': 0,
-            'avg_payment': 0,
-            'subs_1m': 0,
-            'subs_3m': 0,
-            'subs_6m': 0,
-            'subs_12m': 0
-        }
+        return PaymentStats()
+
+async def rebuild_stats() -> bool:
+    """Пересобирает счётчики и дневные сводки статистики из базовых таблиц"""
+    try:
+        async with db_pool.writer() as conn:
+            await stats_counters.rebuild_stats(conn)
+            await conn.commit()
+        logging.info("Сводки статистики пересобраны")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка пересчета статистики: {e}")
+        return False
 
 async def delete_user(user_id: int):
     """Удаляет пользователя из БД"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    interaction_buffer.get_buffer().discard(user_id)
+    async with db_pool.writer() as conn:
+        old_state = await _subscription_state(conn, user_id)
+        cursor = await conn.execute(
+            "SELECT amount, payment_ts FROM payments WHERE user_id = ?",
+            (user_id,)
+        )
+        for amount, payment_ts in await cursor.fetchall():
+            await stats_counters.forget_payment(conn, amount, payment_ts)
+        cursor = await conn.execute(
+            "SELECT first_interaction_ts FROM bot_users WHERE user_id = ?",
+            (user_id,)
+        )
+        bot_user = await cursor.fetchone()
+        if bot_user:
+            await stats_counters.forget_bot_user(conn, bot_user[0])
+        await stats_counters.move_subscription(conn, old_state, None)
+        if old_state and old_state[2]:
+            await vpn_nodes.record_placement(conn, old_state[3], -1)
+
         await conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
         await conn.execute("DELETE FROM payments WHERE user_id = ?", (user_id,))
         await conn.execute("DELETE FROM bot_users WHERE user_id = ?", (user_id,))
         await conn.commit()
+        subscription_cache.invalidate(user_id)
         return True
 
 async def extend_user_subscription(user_id: int, days: int):
     """Продлевает подписку пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT expiry_date FROM users WHERE user_id = ?",
-            (user_id,)
-        )
-        row = await cursor.fetchone()
-        
-        if row and row[0]:
-            try:
-                # Пробуем разные форматы даты
-                formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                current_expiry = None
-                
-                for fmt in formats:
-                    try:
-                        current_expiry = datetime.strptime(row[0], fmt)
-                        break
-                    except ValueError:
-                        continue
-                
-                if current_expiry:
-                    new_expiry = current_expiry + timedelta(days=days)
-                    
-                    await conn.execute(
-                        "UPDATE users SET expiry_date = ?, subscribed = 1 WHERE user_id = ?",
-                        (new_expiry.strftime('%d.%m.%Y %H:%M'), user_id)
-                    )
-                    await conn.commit()
-                    
-                    # Пытаемся продлить на VPN сервере
-                    await extend_vpn_config(user_id, days)
-                    
-                    return True
-            except Exception as e:
-                logging.error(f"Ошибка продления подписки: {e}")
+    try:
+        async with db_pool.transaction() as conn:
+            row = await _subscription_state(conn, user_id)
+            if not row or not row[1]:
                 return False
+
+            new_expiry = datetime.fromtimestamp(row[1]) + timedelta(days=days)
+            await conn.execute(
+                "UPDATE users SET expiry_date = ?, expiry_ts = ?, subscribed = 1 WHERE user_id = ?",
+                (new_expiry.strftime(DISPLAY_FORMAT), to_ts(new_expiry), user_id)
+            )
+            await stats_counters.move_subscription(conn, row, (1, to_ts(new_expiry)))
+        subscription_cache.invalidate(user_id)
+        expiry_scheduler.touch(user_id, to_ts(new_expiry))
+    except Exception as e:
+        logging.error(f"Ошибка продления подписки: {e}")
         return False
 
+    # Продлеваем на VPN сервере уже после освобождения соединения
+    await extend_vpn_config(user_id, days)
+    return True
+
+async def compensate_active_users(days: int):
+    """Продлевает все активные подписки на days дней (компенсация простоя).
+
+    Даты меняются одной транзакцией, продления на VPN серверах уходят
+    одновременно через объединитель запросов. Возвращает (всего, продлено на серверах).
+    """
+    shift = timedelta(days=days)
+    async with db_pool.transaction() as conn:
+        cursor = await conn.execute(
+            "SELECT user_id, expiry_ts, config, node_id, subscribed FROM users WHERE subscribed = 1 AND expiry_ts > ?",
+            (now_ts(),)
+        )
+        rows = await cursor.fetchall()
+        updates = []
+        for user_id, expiry_ts, config_id, node_id, subscribed in rows:
+            new_expiry = datetime.fromtimestamp(expiry_ts) + shift
+            updates.append((new_expiry.strftime(DISPLAY_FORMAT), to_ts(new_expiry), user_id))
+            await stats_counters.move_subscription(conn, (subscribed, expiry_ts), (subscribed, to_ts(new_expiry)))
+        await conn.executemany(
+            "UPDATE users SET expiry_date = ?, expiry_ts = ? WHERE user_id = ?",
+            updates
+        )
+    subscription_cache.clear()
+    for _, expiry_ts, user_id in updates:
+        expiry_scheduler.touch(user_id, expiry_ts)
+
+    targets = [(user_id, config_id, node_id) for user_id, _, config_id, node_id, _ in rows if config_id]
+    results = await asyncio.gather(*(
+        extend_vpn_config(user_id, days, config_id=config_id, node_id=node_id)
+        for user_id, config_id, node_id in targets
+    ))
+    extended = sum(1 for ok in results if ok)
+    logging.info(f"Компенсация {days} дн.: подписок {len(rows)}, продлено на серверах {extended} из {len(targets)}")
+    return len(rows), extended
+
 async def find_user_by_id(user_id: int):
     """Находит пользователя по ID"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db_pool.reader() as conn:
         cursor = await conn.execute(
-            """SELECT user_id, subscribed, payment_date, expiry_date, config, last_update 
+            """SELECT user_id, subscribed, payment_date, expiry_date, config, last_update, expiry_ts 
                FROM users WHERE user_id = ?""",
             (user_id,)
         )
@@ -569,91 +727,127 @@ async def find_user_by_id(user_id: int):
 
 async def block_user(user_id: int):
     """Блокирует пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
+    async with db_pool.writer() as conn:
+        old_state = await _subscription_state(conn, user_id)
         await conn.execute(
             "UPDATE users SET subscribed = 0 WHERE user_id = ?",
             (user_id,)
         )
+        if old_state:
+            await stats_counters.move_subscription(conn, old_state, (0, old_state[1]))
         await conn.commit()
+        subscription_cache.invalidate(user_id)
+        if old_state:
+            expiry_scheduler.touch(user_id, old_state[1])
         return True
 
 async def unblock_user(user_id: int):
     """Разблокирует пользователя"""
-    async with aiosqlite.connect(DB_PATH) as conn:
-        cursor = await conn.execute(
-            "SELECT expiry_date FROM users WHERE user_id = ?",
-            (user_id,)
-        )
-        row = await cursor.fetchone()
-        
-        if row and row[0]:
-            # Проверяем, не истекла ли подписка
-            try:
-                formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                expiry_date = None
-                
-                for fmt in formats:
-                    try:
-                        expiry_date = datetime.strptime(row[0], fmt)
-                        break
-                    except ValueError:
-                        continue
-                
-                if expiry_date and expiry_date > datetime.now():
-                    await conn.execute(
-                        "UPDATE users SET subscribed = 1 WHERE user_id = ?",
-                        (user_id,)
-                    )
-                    await conn.commit()
-                    return True
-            except Exception as e:
-                logging.error(f"Ошибка разблокировки пользователя: {e}")
+    try:
+        async with db_pool.writer() as conn:
+            old_state = await _subscription_state(conn, user_id)
+            # Разблокируем, только если подписка ещё не истекла
+            cursor = await conn.execute(
+                "UPDATE users SET subscribed = 1 WHERE user_id = ? AND expiry_ts > ?",
+                (user_id, now_ts())
+            )
+            if cursor.rowcount > 0:
+                await stats_counters.move_subscription(conn, old_state, (1, old_state[1]))
+            await conn.commit()
+            subscription_cache.invalidate(user_id)
+            if cursor.rowcount > 0:
+                expiry_scheduler.touch(user_id, old_state[1])
+            return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Ошибка разблокировки пользователя: {e}")
         return False
 
+async def _write_granted_subscription(conn, user_id: int, days: int, period: int, method: str,
+                                      config_id: str, node_id: str):
+    """Записывает выданную подписку (админскую или пробную) в транзакции вызывающего кода.
+
+    Возвращает новый срок окончания (epoch).
+    """
+    current_time = datetime.now()
+    expiry_date = current_time + timedelta(days=days)
+    old_state = await _subscription_state(conn, user_id)
+    await conn.execute('''
+        INSERT OR REPLACE INTO users 
+        (user_id, subscribed, payment_date, expiry_date, config, last_update, payment_ts, expiry_ts, node_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        user_id,
+        True,
+        current_time.strftime(DISPLAY_FORMAT),
+        expiry_date.strftime(DISPLAY_FORMAT),
+        config_id,
+        current_time.strftime(DISPLAY_FORMAT),
+        to_ts(current_time),
+        to_ts(expiry_date),
+        node_id
+    ))
+    if old_state and old_state[2]:
+        await vpn_nodes.record_placement(conn, old_state[3], -1)
+    if config_id:
+        await vpn_nodes.record_placement(conn, node_id, 1)
+
+    # Запись о "платеже" (админская выдача или триал)
+    await conn.execute('''
+        INSERT INTO payments (user_id, amount, period, payment_date, payment_method, payment_ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, 0, period, current_time.strftime(DISPLAY_FORMAT), method, to_ts(current_time)))
+    await stats_counters.record_payment(conn, 0, to_ts(current_time))
+    await stats_counters.move_subscription(conn, old_state, (1, to_ts(expiry_date)))
+    return to_ts(expiry_date)
+
 async def give_user_subscription(user_id: int, days: int):
-    """Выдает подписку пользователю (создает новую запись)"""
+    """Выдает подписку пользователю (создает новую запись).
+
+    Конфиг берётся из тёплого пула одной локальной транзакцией; если пул
+    пуст — выдаётся через VPN API, как раньше.
+    """
+    period = days // 30 if days >= 30 else 1
     try:
-        current_time = datetime.now()
-        expiry_date = current_time + timedelta(days=days)
-        
-        # Получаем конфиг от VPN сервера
-        config_id = await get_vpn_config(user_id, days // 30 if days >= 30 else 1)
+        async with db_pool.transaction() as conn:
+            config_id, node_id, server_expiry = await config_pool.take_config(conn)
+            if config_id:
+                expiry_ts = await _write_granted_subscription(conn, user_id, days, period, 'admin_gift', config_id, node_id)
+                await _enqueue_pool_extend(conn, user_id, expiry_ts, config_id, node_id, server_expiry)
+        if config_id:
+            subscription_cache.invalidate(user_id)
+            expiry_scheduler.touch(user_id, expiry_ts)
+            _wake_provisioning(True)
+            return True
+
+        # Пул пуст — получаем конфиг от VPN сервера (срок на сервере — целыми месяцами)
+        config_id, node_id = await provision_vpn_config(user_id, 30 * period)
         if not config_id:
             logging.error(f"Не удалось получить конфиг для user_id={user_id}")
             return False
-        
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # Создаем новую подписку
-            await conn.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, subscribed, payment_date, expiry_date, config, last_update)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ''',
-                (
-                    user_id,
-                    True,
-                    current_time.strftime('%d.%m.%Y %H:%M'),
-                    expiry_date.strftime('%d.%m.%Y %H:%M'),
-                    config_id,
-                    current_time.strftime('%d.%m.%Y %H:%M')
-                )
-            )
-            
-            # Добавляем запись о "платеже" (админская выдача)
-            await conn.execute('''
-                INSERT INTO payments (user_id, amount, period, payment_date, payment_method)
-                VALUES (?, ?, ?, ?, ?)
-                ''',
-                (user_id, 0, days // 30 if days >= 30 else 1, current_time.strftime('%d.%m.%Y %H:%M'), 'admin_gift')
-            )
-            
-            await conn.commit()
-            return True
+
+        async with db_pool.transaction() as conn:
+            expiry_ts = await _write_granted_subscription(conn, user_id, days, period, 'admin_gift', config_id, node_id)
+        subscription_cache.invalidate(user_id)
+        expiry_scheduler.touch(user_id, expiry_ts)
+        return True
             
     except Exception as e:
         logging.error(f"Ошибка выдачи подписки: {str(e)}", exc_info=True)
         return False
 
+async def _has_trial(conn, user_id: int) -> bool:
+    # 1) Явный маркер триала
+    cursor = await conn.execute(HAS_TRIAL_SQL, (user_id,))
+    if await cursor.fetchone():
+        return True
+
+    # 2) Back-compat: если раньше триал выдавался без записи в payments
+    cursor = await conn.execute(
+        "SELECT 1 FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+    return (await cursor.fetchone()) is not None
+
 async def has_trial(user_id: int) -> bool:
     """True, если пользователю уже выдавался пробный доступ хотя бы один раз.
 
@@ -663,74 +857,115 @@ async def has_trial(user_id: int) -> bool:
     совместимости дополнительно проверяем наличие записи в users (старые триалы).
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            # 1) Явный маркер триала
-            cursor = await conn.execute(
-                "SELECT 1 FROM payments WHERE user_id = ? AND payment_method = 'trial' LIMIT 1",
-                (user_id,)
-            )
-            if await cursor.fetchone():
-                return True
-
-            # 2) Back-compat: если раньше триал выдавался без записи в payments
-            cursor = await conn.execute(
-                "SELECT 1 FROM users WHERE user_id = ?",
-                (user_id,)
-            )
-            return (await cursor.fetchone()) is not None
+        async with db_pool.reader() as conn:
+            return await _has_trial(conn, user_id)
     except Exception:
         return False
 
 async def give_trial_subscription(user_id: int, days: int = 14) -> bool:
-    """Выдает пробную подписку пользователю, если ещё не было записи в users"""
+    """Выдает пробную подписку пользователю, если ещё не было записи в users.
+
+    Обычный путь — одна локальная транзакция: проверка триала, конфиг из
+    тёплого пула и запись подписки; срок на сервере выставляется в фоне.
+    """
+    period = max(1, days // 30) if days >= 30 else 1
     try:
         if await has_trial(user_id):
             return False
-        current_time = datetime.now()
-        expiry_date = current_time + timedelta(days=days)
 
-        config_id = await get_vpn_config_days(user_id, days)
+        async with db_pool.transaction() as conn:
+            # Перепроверяем под блокировкой записи: параллельный запрос мог успеть
+            if await _has_trial(conn, user_id):
+                return False
+            config_id, node_id, server_expiry = await config_pool.take_config(conn)
+            if config_id:
+                expiry_ts = await _write_granted_subscription(conn, user_id, days, period, 'trial', config_id, node_id)
+                await _enqueue_pool_extend(conn, user_id, expiry_ts, config_id, node_id, server_expiry)
+        if config_id:
+            subscription_cache.invalidate(user_id)
+            expiry_scheduler.touch(user_id, expiry_ts)
+            _wake_provisioning(True)
+            return True
+
+        # Пул пуст — выдаём конфиг через VPN API
+        config_id, node_id = await provision_vpn_config(user_id, 30 * period)
         if not config_id:
             logging.warning(f"Не удалось получить конфиг (trial) для user_id={user_id}, создаём подписку без конфига — будет выдан при первом подключении")
-            config_id = ''
+            config_id, node_id = '', None
 
-        async with aiosqlite.connect(DB_PATH) as conn:
-            await conn.execute('''
-                INSERT OR REPLACE INTO users 
-                (user_id, subscribed, payment_date, expiry_date, config, last_update)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                True,
-                current_time.strftime('%d.%m.%Y %H:%M'),
-                expiry_date.strftime('%d.%m.%Y %H:%M'),
-                config_id,
-                current_time.strftime('%d.%m.%Y %H:%M')
-            ))
-
-            await conn.execute('''
-                INSERT INTO payments (user_id, amount, period, payment_date, payment_method)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, 0, max(1, days // 30) if days >= 30 else 1, current_time.strftime('%d.%m.%Y %H:%M'), 'trial'))
-
-            await conn.commit()
-            return True
+        async with db_pool.transaction() as conn:
+            if await _has_trial(conn, user_id):
+                return False
+            expiry_ts = await _write_granted_subscription(conn, user_id, days, period, 'trial', config_id, node_id)
+        subscription_cache.invalidate(user_id)
+        expiry_scheduler.touch(user_id, expiry_ts)
+        return True
     except Exception as e:
         logging.error(f"Ошибка выдачи trial: {e}")
         return False
 
+async def issue_missing_config(user_id: int):
+    """Выдаёт конфиг активной подписке, созданной без него (первое подключение).
+
+    Возвращает конфиг пользователя или None, если подписки нет или выдать не удалось.
+    """
+    try:
+        async with db_pool.transaction() as conn:
+            row = await _subscription_state(conn, user_id)
+            if not row or not row[1] or row[1] <= now_ts():
+                return None
+            if row[2]:
+                return row[2]
+            config_id, node_id, server_expiry = await config_pool.take_config(conn)
+            if config_id:
+                await conn.execute(
+                    "UPDATE users SET config = ?, node_id = ? WHERE user_id = ?",
+                    (config_id, node_id, user_id)
+                )
+                await vpn_nodes.record_placement(conn, node_id, 1)
+                await _enqueue_pool_extend(conn, user_id, row[1], config_id, node_id, server_expiry)
+        if config_id:
+            subscription_cache.invalidate(user_id)
+            _wake_provisioning(True)
+            return config_id
+
+        # Пул пуст — выдаём через VPN API на оставшийся срок
+        config_id, node_id = await provision_vpn_config(user_id, _days_left(row[1]))
+        if not config_id:
+            return None
+        async with db_pool.transaction() as conn:
+            cursor = await conn.execute(
+                "UPDATE users SET config = ?, node_id = ? WHERE user_id = ? AND (config IS NULL OR config = '')",
+                (config_id, node_id, user_id)
+            )
+            if cursor.rowcount:
+                await vpn_nodes.record_placement(conn, node_id, 1)
+        subscription_cache.invalidate(user_id)
+        if not cursor.rowcount:
+            logging.warning(f"Конфиг для user_id={user_id} уже выдан параллельно, {config_id} не используется")
+            state = await get_subscription_state(user_id)
+            return state.config if state else None
+        return config_id
+    except Exception as e:
+        logging.error(f"Ошибка выдачи конфига при подключении для {user_id}: {e}")
+        return None
+
 async def deactivate_user_subscription(user_id: int):
     """Деактивирует подписку пользователя"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
+        async with db_pool.writer() as conn:
             # Устанавливаем дату окончания на вчера
             yesterday = datetime.now() - timedelta(days=1)
+            old_state = await _subscription_state(conn, user_id)
             
             await conn.execute(
-                "UPDATE users SET subscribed = 0, expiry_date = ? WHERE user_id = ?",
-                (yesterday.strftime('%d.%m.%Y %H:%M'), user_id)
+                "UPDATE users SET subscribed = 0, expiry_date = ?, expiry_ts = ? WHERE user_id = ?",
+                (yesterday.strftime(DISPLAY_FORMAT), to_ts(yesterday), user_id)
             )
+            await stats_counters.move_subscription(conn, old_state, None)
             await conn.commit()
+            subscription_cache.invalidate(user_id)
+            expiry_scheduler.touch(user_id, to_ts(yesterday))
             return True
     except Exception as e:
         logging.error(f"Ошибка деактивации подписки: {e}")
@@ -739,56 +974,38 @@ async def deactivate_user_subscription(user_id: int):
 async def activate_user_subscription(user_id: int):
     """Активирует подписку пользователя (если дата не истекла критично)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as conn:
-            cursor = await conn.execute(
-                "SELECT expiry_date FROM users WHERE user_id = ?",
-                (user_id,)
-            )
-            row = await cursor.fetchone()
-            
-            if row and row[0]:
-                try:
-                    formats = ['%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                    expiry_date = None
-                    
-                    for fmt in formats:
-                        try:
-                            expiry_date = datetime.strptime(row[0], fmt)
-                            break
-                        except ValueError:
-                            continue
-                    
-                    if expiry_date:
-                        # Если подписка истекла недавно (менее 30 дней назад), активируем
-                        days_expired = (datetime.now() - expiry_date).days
-                        if days_expired <= 30:
-                            await conn.execute(
-                                "UPDATE users SET subscribed = 1 WHERE user_id = ?",
-                                (user_id,)
-                            )
-                            await conn.commit()
-                            
-                            # Пытаемся активировать на VPN сервере
-                            await extend_vpn_config(user_id, max(1, -days_expired))
-                            
-                            return True
-                        else:
-                            # Если истекла давно, продлеваем на 7 дней
-                            new_expiry = datetime.now() + timedelta(days=7)
-                            await conn.execute(
-                                "UPDATE users SET subscribed = 1, expiry_date = ? WHERE user_id = ?",
-                                (new_expiry.strftime('%d.%m.%Y %H:%M'), user_id)
-                            )
-                            await conn.commit()
-                            
-                            # Продлеваем на VPN сервере
-                            await extend_vpn_config(user_id, 7)
-                            
-                            return True
-                except Exception as e:
-                    logging.error(f"Ошибка парсинга даты при активации: {e}")
-                    return False
-        return False
+        async with db_pool.transaction() as conn:
+            row = await _subscription_state(conn, user_id)
+            if not row or not row[1]:
+                return False
+
+            expiry_date = datetime.fromtimestamp(row[1])
+            # Если подписка истекла недавно (менее 30 дней назад), активируем
+            days_expired = (datetime.now() - expiry_date).days
+            if days_expired <= 30:
+                await conn.execute(
+                    "UPDATE users SET subscribed = 1 WHERE user_id = ?",
+                    (user_id,)
+                )
+                await stats_counters.move_subscription(conn, row, (1, row[1]))
+                new_expiry_ts = row[1]
+                vpn_days = max(1, -days_expired)
+            else:
+                # Если истекла давно, продлеваем на 7 дней
+                new_expiry = datetime.now() + timedelta(days=7)
+                await conn.execute(
+                    "UPDATE users SET subscribed = 1, expiry_date = ?, expiry_ts = ? WHERE user_id = ?",
+                    (new_expiry.strftime(DISPLAY_FORMAT), to_ts(new_expiry), user_id)
+                )
+                await stats_counters.move_subscription(conn, row, (1, to_ts(new_expiry)))
+                new_expiry_ts = to_ts(new_expiry)
+                vpn_days = 7
+        subscription_cache.invalidate(user_id)
+        expiry_scheduler.touch(user_id, new_expiry_ts)
     except Exception as e:
         logging.error(f"Ошибка активации подписки: {e}")
         return False
+
+    # Активируем на VPN сервере уже после освобождения соединения
+    await extend_vpn_config(user_id, vpn_days)
+    return True
@@ -0,0 +1,71 @@
+import logging
+from config import (
+    SQLITE_JOURNAL_MODE,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_SIZE,
+    SQLITE_TEMP_STORE,
+    SQLITE_BUSY_TIMEOUT_MS
+)
+
+__all__ = [
+    'ENGINE_PROFILE',
+    'apply_engine_profile',
+    'apply_engine_profile_sync',
+    'read_engine_profile',
+    'format_engine_profile'
+]
+
+# Порядок важен: busy_timeout ставим первым, чтобы смена journal_mode
+# не падала с "database is locked", если файл сейчас занят другим процессом
+ENGINE_PROFILE = [
+    ('busy_timeout', SQLITE_BUSY_TIMEOUT_MS),
+    ('journal_mode', SQLITE_JOURNAL_MODE),
+    ('synchronous', SQLITE_SYNCHRONOUS),
+    ('mmap_size', SQLITE_MMAP_SIZE),
+    ('cache_size', SQLITE_CACHE_SIZE),
+    ('temp_store', SQLITE_TEMP_STORE)
+]
+
+
+async def apply_engine_profile(conn):
+    """Применяет профиль движка к соединению aiosqlite"""
+    for name, value in ENGINE_PROFILE:
+        cursor = await conn.execute(f"PRAGMA {name} = {value}")
+        await cursor.close()
+
+
+def apply_engine_profile_sync(conn):
+    """Применяет профиль движка к синхронному соединению sqlite3"""
+    for name, value in ENGINE_PROFILE:
+        conn.execute(f"PRAGMA {name} = {value}").close()
+
+
+# SQLite возвращает часть настроек числами — переводим в читаемый вид
+_PRAGMA_NAMES = {
+    'synchronous': {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'},
+    'temp_store': {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+}
+
+
+async def read_engine_profile(conn) -> dict:
+    """Читает фактические значения настроек движка из соединения"""
+    profile = {}
+    for name, _ in ENGINE_PROFILE:
+        cursor = await conn.execute(f"PRAGMA {name}")
+        row = await cursor.fetchone()
+        await cursor.close()
+        value = row[0] if row else None
+        profile[name] = _PRAGMA_NAMES.get(name, {}).get(value, value)
+
+    if str(profile.get('journal_mode', '')).upper() != str(SQLITE_JOURNAL_MODE).upper():
+        logging.warning(
+            f"SQLite не переключился в journal_mode={SQLITE_JOURNAL_MODE}, "
+            f"фактически: {profile.get('journal_mode')}"
+        )
+    return profile
+
+
+def format_engine_profile(profile: dict) -> str:
+    """Форматирует профиль для лога"""
+    return ', '.join(f"{name}={value}" for name, value in profile.items())
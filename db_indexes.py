@@ -0,0 +1,111 @@
+import logging
+
+__all__ = [
+    'INDEXES',
+    'hot_queries',
+    'QueryPlanError',
+    'ensure_indexes',
+    'explain_query',
+    'find_full_scans',
+    'check_query_plans'
+]
+
+# Управляемый набор вторичных индексов: (имя, таблица, колонки)
+INDEXES = [
+    ('idx_payments_user_method', 'payments', 'user_id, payment_method'),
+    ('idx_payments_payment_ts', 'payments', 'payment_ts'),
+    ('idx_users_expiry_ts', 'users', 'expiry_ts'),
+    ('idx_users_subscribed_expiry', 'users', 'subscribed, expiry_ts'),
+    ('idx_bot_users_first_interaction', 'bot_users', 'first_interaction_ts'),
+    ('idx_vpn_config_pool_node', 'vpn_config_pool', 'node_id, id'),
+    ('idx_provisioning_outbox_due', 'provisioning_outbox', 'status, next_attempt_ts'),
+    ('idx_provisioning_outbox_user', 'provisioning_outbox', 'user_id, operation, status'),
+    ('idx_pending_payments_due', 'pending_payments', 'next_check_ts'),
+]
+
+def hot_queries() -> list:
+    """Запросы горячего пути: [(название, SQL, пример параметров)].
+
+    SQL берётся из модулей, которые эти запросы выполняют, поэтому проверка
+    не расходится с кодом. Ни один из них не должен читать таблицу полным
+    сканированием или сортировать результат во временном B-дереве.
+    Модули импортируются здесь, а не в начале файла: они сами зависят от
+    database, который импортирует этот модуль.
+    """
+    import admin_panel
+    import config_pool
+    import database
+    import expiry_scheduler
+    import pending_payments
+    import provisioning_outbox
+    import reconciliation
+    import stats_counters
+
+    page = {'now': 0, 'after_ts': 0, 'after_id': 0, 'limit': 16}
+    queries = [
+        ('has_trial', database.HAS_TRIAL_SQL, (1,)),
+        ('subscription_state', database.SUBSCRIPTION_STATE_SQL, (1,)),
+        ('bot_user_counts', database.BOT_USER_COUNTS_SQL, {'today': 0, 'week': 0}),
+        ('subscription_counts', database.SUBSCRIPTION_COUNTS_SQL, {'now': 0}),
+    ]
+    for status in database.USER_STATUS_QUERIES:
+        queries.append((f"users_{status}_first_page", database.users_by_status_sql(status), page))
+        queries.append((f"users_{status}_page", database.users_by_status_sql(status, after=True), page))
+    queries += [
+        ('active_expiring_today', stats_counters.ACTIVE_TODAY_SQL, (0, 0)),
+        ('take_pool_config', config_pool.TAKE_SQL, ('nl', 0)),
+        ('outbox_due', provisioning_outbox.DUE_SQL, ('pending', 0, 100)),
+        ('outbox_user_pending', provisioning_outbox.HAS_PENDING_SQL, (1, 'provision', 'pending')),
+        ('pending_payments_due', pending_payments.DUE_SQL, (0, 100)),
+        ('expiry_window', expiry_scheduler.WINDOW_SQL, (0, 0, 0, 500)),
+        ('reconcile_chunk', reconciliation.CHUNK_SQL, (0, 0, 500)),
+        ('recent_bot_users', admin_panel.RECENT_BOT_USERS_SQL, ()),
+    ]
+    return queries
+
+
+class QueryPlanError(RuntimeError):
+    """Горячий запрос выполняется полным сканированием таблицы"""
+
+
+async def ensure_indexes(conn):
+    """Создаёт недостающие индексы из управляемого набора"""
+    for name, table, columns in INDEXES:
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    await conn.commit()
+
+
+async def explain_query(conn, sql: str, params=()) -> list:
+    """Возвращает строки EXPLAIN QUERY PLAN (только поле detail)"""
+    cursor = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    rows = await cursor.fetchall()
+    await cursor.close()
+    return [row[3] for row in rows]
+
+
+def find_full_scans(plan: list) -> list:
+    """Шаги плана, читающие таблицу целиком (SCAN без индекса) или сортирующие во временном B-дереве"""
+    return [
+        step for step in plan
+        if (step.startswith('SCAN ') and ' USING ' not in step) or step.startswith('USE TEMP B-TREE')
+    ]
+
+
+async def check_query_plans(conn) -> dict:
+    """Проверяет планы всех горячих запросов.
+
+    Возвращает {название: план}; при полном сканировании бросает QueryPlanError.
+    """
+    plans = {}
+    failures = []
+    for name, sql, params in hot_queries():
+        plan = await explain_query(conn, sql, params)
+        plans[name] = plan
+        scans = find_full_scans(plan)
+        if scans:
+            failures.append(f"{name}: {'; '.join(scans)}")
+
+    if failures:
+        raise QueryPlanError("Полное сканирование или сортировка в горячих запросах: " + ' | '.join(failures))
+    logging.info(f"Планы горячих запросов в порядке ({len(plans)} шт.)")
+    return plans
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import aiosqlite
+from config import DB_PATH, DB_POOL_READERS
+from db_engine import apply_engine_profile
+
+__all__ = [
+    'DatabasePool',
+    'init_pool',
+    'close_pool',
+    'get_pool',
+    'reader',
+    'writer',
+    'transaction'
+]
+
+
+class DatabasePool:
+    """Пул долгоживущих соединений aiosqlite: один писатель и N читателей.
+
+    SQLite допускает только одного писателя одновременно, поэтому все изменения
+    идут через единственное соединение под asyncio.Lock. Читатели выдаются из
+    очереди и возвращаются в неё после использования.
+    """
+
+    def __init__(self, db_path: str, readers: int = 4):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+        self._closed = True
+
+    async def _connect(self):
+        """Открывает новое соединение с базой и применяет профиль движка"""
+        conn = await aiosqlite.connect(self.db_path)
+        await apply_engine_profile(conn)
+        return conn
+
+    async def open(self):
+        """Открывает соединение писателя и соединения читателей"""
+        if not self._closed:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.readers_count):
+            conn = await self._connect()
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+        self._closed = False
+        logging.info(f"Пул БД открыт: 1 писатель, {self.readers_count} читателей ({self.db_path})")
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        if self._closed:
+            return
+        self._closed = True
+        async with self._writer_lock:
+            try:
+                await self._writer.close()
+            except Exception as e:
+                logging.error(f"Ошибка закрытия соединения писателя: {e}")
+            self._writer = None
+        for conn in self._all_readers:
+            try:
+                await conn.close()
+            except Exception as e:
+                logging.error(f"Ошибка закрытия соединения читателя: {e}")
+        self._all_readers = []
+        self._readers = asyncio.Queue()
+        logging.info("Пул БД закрыт")
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @asynccontextmanager
+    async def reader(self):
+        """Выдаёт соединение для чтения"""
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Выдаёт единственное соединение для записи.
+
+        Если блок завершился исключением, незакоммиченные изменения откатываются,
+        чтобы следующий писатель не унаследовал чужую транзакцию.
+        """
+        async with self._writer_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Короткая транзакция записи: BEGIN IMMEDIATE, commit при успехе, rollback при ошибке.
+
+        Блокировка записи берётся сразу, поэтому прочитанное внутри блока
+        не изменится до коммита. Сетевые вызовы внутри блока недопустимы.
+        """
+        async with self.writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            await conn.commit()
+
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def init_pool(db_path: str = DB_PATH, readers: int = DB_POOL_READERS) -> DatabasePool:
+    """Создаёт и открывает глобальный пул (повторный вызов возвращает существующий)"""
+    global _pool
+    async with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = DatabasePool(db_path, readers)
+            await _pool.open()
+    return _pool
+
+
+async def close_pool():
+    """Закрывает глобальный пул"""
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+
+async def get_pool() -> DatabasePool:
+    """Возвращает открытый пул, при необходимости создавая его"""
+    if _pool is None or _pool.closed:
+        return await init_pool()
+    return _pool
+
+
+@asynccontextmanager
+async def reader():
+    """Соединение для чтения из глобального пула"""
+    pool = await get_pool()
+    async with pool.reader() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def writer():
+    """Соединение для записи из глобального пула"""
+    pool = await get_pool()
+    async with pool.writer() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def transaction():
+    """Транзакция записи BEGIN IMMEDIATE на соединении писателя глобального пула"""
+    pool = await get_pool()
+    async with pool.transaction() as conn:
+        yield conn
@@ -0,0 +1,293 @@
+import asyncio
+import heapq
+import logging
+import db_pool
+import provisioning_outbox
+from config import (
+    EXPIRY_REMINDER_DAYS,
+    EXPIRY_REFRESH_INTERVAL,
+    EXPIRY_CATCHUP_HOURS,
+    EXPIRY_BATCH_SIZE,
+    EXPIRY_NOTIFY_RATE,
+    VPN_API_REVOKE_PATH
+)
+from timestamps import now_ts
+
+__all__ = [
+    'NOTIFICATIONS_SCHEMA',
+    'REVOKE',
+    'WINDOW_SQL',
+    'ExpiryScheduler',
+    'reminder_kind',
+    'set_notifier',
+    'get_scheduler',
+    'touch',
+    'start_scheduler',
+    'stop_scheduler'
+]
+
+# Отправленные напоминания и отзывы: одно событие на (пользователь, срок, вид),
+# чтобы после перезапуска ничего не повторялось. Продление меняет expiry_ts,
+# и для нового срока напоминания снова приходят.
+NOTIFICATIONS_SCHEMA = '''CREATE TABLE IF NOT EXISTS expiry_notifications
+                          (user_id INTEGER NOT NULL,
+                           expiry_ts INTEGER NOT NULL,
+                           kind TEXT NOT NULL,
+                           sent_ts INTEGER NOT NULL,
+                           PRIMARY KEY (user_id, expiry_ts, kind))'''
+
+REVOKE = 'revoke'
+
+# Часть окна загрузки: подписки со сроком до until после курсора (expiry_ts, user_id)
+WINDOW_SQL = """SELECT user_id, expiry_ts FROM users
+                WHERE subscribed = 1 AND expiry_ts <= ? AND (expiry_ts, user_id) > (?, ?)
+                ORDER BY expiry_ts, user_id LIMIT ?"""
+
+# Чтение users по списку идентификаторов — частями, в пределах лимита переменных SQLite
+_CHUNK = 500
+
+
+def reminder_kind(days: int) -> str:
+    return f"remind_{days}d"
+
+
+# Виды событий и их смещение от срока окончания: [(вид, секунд до срока)]
+_EVENTS = [(reminder_kind(days), days * 86400) for days in sorted(EXPIRY_REMINDER_DAYS, reverse=True)]
+# Отзыв и сообщение об отключении — только если сервер умеет отзывать конфиг
+if VPN_API_REVOKE_PATH:
+    _EVENTS.append((REVOKE, 0))
+_MAX_LEAD = max((lead for _, lead in _EVENTS), default=0)
+
+# Уведомление пользователя: async (user_id, kind, expiry_ts) -> None
+_notifier = None
+
+
+def set_notifier(notifier):
+    global _notifier
+    _notifier = notifier
+
+
+class ExpiryScheduler:
+    """Напоминания об окончании подписки и отзыв конфига точно в срок.
+
+    В памяти — min-куча событий (время, пользователь, срок, вид) только для
+    подписок, заканчивающихся в ближайшем окне. Окно сдвигается запросом по
+    индексу (subscribed, expiry_ts) к ещё не загруженному диапазону сроков;
+    изменения сроков в database приходят через touch(). Устаревшие события
+    не удаляются из кучи, а отбрасываются при срабатывании: срок сверяется
+    с БД одним пакетным чтением.
+    """
+
+    def __init__(self, refresh_interval: float = EXPIRY_REFRESH_INTERVAL,
+                 catchup_hours: int = EXPIRY_CATCHUP_HOURS, batch_size: int = EXPIRY_BATCH_SIZE,
+                 notify_rate: float = EXPIRY_NOTIFY_RATE):
+        self.refresh_interval = refresh_interval
+        self.catchup = catchup_hours * 3600
+        self.batch_size = max(1, batch_size)
+        self.notify_interval = 1 / notify_rate if notify_rate > 0 else 0
+        self._heap = []
+        # Все подписки со сроком до этого момента уже в куче
+        self._loaded_until = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.loaded = 0
+        self.reminders = 0
+        self.revoked = 0
+        self.skipped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _push(self, user_id: int, expiry_ts: int):
+        for kind, lead in _EVENTS:
+            heapq.heappush(self._heap, (expiry_ts - lead, user_id, expiry_ts, kind))
+
+    def touch(self, user_id: int, expiry_ts: int):
+        """Срок подписки изменился; сроки за пределами окна загрузятся при его сдвиге"""
+        if self._loaded_until is None or not expiry_ts or expiry_ts > self._loaded_until:
+            return
+        self._push(user_id, expiry_ts)
+        self._wakeup.set()
+
+    def _horizon(self) -> int:
+        return now_ts() + _MAX_LEAD + int(self.refresh_interval) * 2
+
+    async def refresh(self):
+        """Догружает подписки со сроком в (загружено, горизонт] постранично по индексу"""
+        previous = self._loaded_until
+        start = previous if previous is not None else now_ts() - self.catchup
+        until = self._horizon()
+        if until <= start:
+            return
+        # Окно сдвигается до чтения: изменения сроков во время загрузки попадут
+        # в кучу через touch(), повторные события отбрасываются при срабатывании
+        self._loaded_until = until
+        cursor_key = (start, 0)
+        try:
+            async with db_pool.reader() as conn:
+                while True:
+                    cursor = await conn.execute(WINDOW_SQL, (until, *cursor_key, self.batch_size))
+                    rows = await cursor.fetchall()
+                    for user_id, expiry_ts in rows:
+                        self._push(user_id, expiry_ts)
+                    self.loaded += len(rows)
+                    if len(rows) < self.batch_size:
+                        break
+                    cursor_key = (rows[-1][1], rows[-1][0])
+        except Exception:
+            # Окно загрузится заново; уже добавленные события задвоятся и отбросятся
+            self._loaded_until = previous
+            raise
+
+    async def _current_expiry(self, user_ids) -> dict:
+        """{user_id: (expiry_ts, config, node_id)} для активных подписок из списка"""
+        result = {}
+        user_ids = list(user_ids)
+        async with db_pool.reader() as conn:
+            for i in range(0, len(user_ids), _CHUNK):
+                chunk = user_ids[i:i + _CHUNK]
+                cursor = await conn.execute(
+                    f"""SELECT user_id, expiry_ts, config, node_id FROM users
+                        WHERE subscribed = 1 AND user_id IN ({', '.join('?' * len(chunk))})""",
+                    chunk
+                )
+                for user_id, expiry_ts, config, node_id in await cursor.fetchall():
+                    result[user_id] = (expiry_ts, config, node_id)
+        return result
+
+    def _pop_due(self, now: int) -> list:
+        due = {}
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            _, user_id, expiry_ts, kind = heapq.heappop(self._heap)
+            due[(user_id, expiry_ts, kind)] = True
+        return list(due)
+
+    async def fire(self, events: list):
+        """Выполняет наступившие события одним пакетом: отметка, отзыв через outbox, уведомления"""
+        now = now_ts()
+        current = await self._current_expiry({user_id for user_id, _, _ in events})
+        leads = dict(_EVENTS)
+        valid = []
+        for user_id, expiry_ts, kind in events:
+            state = current.get(user_id)
+            # Подписку продлили, отключили или удалили — событие устарело
+            if not state or state[0] != expiry_ts:
+                self.skipped += 1
+                continue
+            # Напоминание опоздало настолько, что уже наступило следующее — не шлём оба
+            if kind != REVOKE and expiry_ts - now <= max(
+                    (lead for _, lead in _EVENTS if lead < leads[kind]), default=0):
+                self.skipped += 1
+                continue
+            valid.append((user_id, expiry_ts, kind, state))
+        if not valid:
+            return
+
+        notify = []
+        revoked = False
+        async with db_pool.transaction() as conn:
+            for user_id, expiry_ts, kind, (_, config_id, node_id) in valid:
+                cursor = await conn.execute(
+                    "INSERT OR IGNORE INTO expiry_notifications (user_id, expiry_ts, kind, sent_ts) VALUES (?, ?, ?, ?)",
+                    (user_id, expiry_ts, kind, now)
+                )
+                if not cursor.rowcount:
+                    continue  # уже обработано до перезапуска
+                if kind == REVOKE and config_id:
+                    await provisioning_outbox.enqueue(
+                        conn, f"revoke:{user_id}:{expiry_ts}", provisioning_outbox.REVOKE,
+                        user_id, 0, config_id, node_id
+                    )
+                    revoked = True
+                notify.append((user_id, kind, expiry_ts))
+        if revoked:
+            provisioning_outbox.get_worker().wakeup()
+
+        for user_id, kind, expiry_ts in notify:
+            if kind == REVOKE:
+                self.revoked += 1
+            else:
+                self.reminders += 1
+            if _notifier is None:
+                continue
+            try:
+                await _notifier(user_id, kind, expiry_ts)
+            except Exception as e:
+                logging.warning(f"Не удалось уведомить {user_id} об окончании подписки: {e}")
+            # Не больше notify_rate сообщений в секунду
+            if self.notify_interval:
+                await asyncio.sleep(self.notify_interval)
+
+    async def _run(self):
+        last_refresh = None
+        while True:
+            try:
+                now = now_ts()
+                if last_refresh is None or now - last_refresh >= self.refresh_interval:
+                    await self.refresh()
+                    last_refresh = now
+                events = self._pop_due(now)
+                if events:
+                    await self.fire(events)
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка планировщика окончания подписок: {e}")
+            timeout = self.refresh_interval
+            if self._heap:
+                timeout = max(0, min(timeout, self._heap[0][0] - now_ts()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logging.info("Планировщик окончания подписок запущен")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'scheduled': len(self._heap),
+            'next_ts': self._heap[0][0] if self._heap else None,
+            'loaded': self.loaded,
+            'reminders': self.reminders,
+            'revoked': self.revoked,
+            'skipped': self.skipped
+        }
+
+
+_scheduler = None
+
+
+def get_scheduler() -> ExpiryScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ExpiryScheduler()
+    return _scheduler
+
+
+def touch(user_id: int, expiry_ts: int):
+    """Сообщает планировщику о новом сроке подписки (если он запущен)"""
+    if _scheduler is not None:
+        _scheduler.touch(user_id, expiry_ts)
+
+
+def start_scheduler():
+    get_scheduler().start()
+
+
+async def stop_scheduler():
+    if _scheduler is not None:
+        await _scheduler.stop()
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import vpn_client
+from config import (
+    VPN_EXTEND_WINDOW_MS,
+    VPN_EXTEND_MAX_BATCH,
+    VPN_EXTEND_CONCURRENCY,
+    VPN_API_BATCH_EXTEND_PATH
+)
+
+__all__ = [
+    'ExtendCoalescer',
+    'get_coalescer',
+    'extend'
+]
+
+
+class ExtendCoalescer:
+    """Объединяет продления конфигов, пришедшие за короткое окно.
+
+    Каждый вызов extend() получает свой результат. Продления одного конфига
+    в пределах окна складываются в один запрос (срок на сервере суммируется).
+    Пачка узла уходит одним пакетным запросом, если он настроен, иначе —
+    параллельными запросами с ограничением одновременности. Продление не
+    идемпотентно, поэтому после неудачного пакета по одному отправляется
+    только то, что точно не дошло до сервера; остальное считается
+    неудачей и остаётся повтору через outbox или сверке.
+
+    Продление с ключом идемпотентности (задание outbox) ни с чем не
+    складывается и уходит отдельным запросом с заголовком Idempotency-Key:
+    повтор того же задания сервер не применит второй раз.
+    """
+
+    def __init__(self, window_ms: int = VPN_EXTEND_WINDOW_MS, max_batch: int = VPN_EXTEND_MAX_BATCH,
+                 concurrency: int = VPN_EXTEND_CONCURRENCY, batch_path: str = VPN_API_BATCH_EXTEND_PATH):
+        self.window = max(0, window_ms) / 1000
+        self.max_batch = max(1, max_batch)
+        self.batch_path = batch_path
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        # {node_id: (node, {(config_id, idempotency_key): [days, [futures]]})}
+        self._pending = {}
+        self._timers = {}
+        self._flushes = set()
+        # Метрики
+        self.requested = 0
+        self.sent = 0
+        self.batches = 0
+        self.failed = 0
+
+    async def extend(self, node, config_id: str, days: int, idempotency_key: str = None) -> bool:
+        """Ставит продление в очередь и ждёт его результат"""
+        future = asyncio.get_running_loop().create_future()
+        _, items = self._pending.setdefault(node.node_id, (node, {}))
+        item = items.setdefault((config_id, idempotency_key), [0, []])
+        item[0] += days
+        item[1].append(future)
+        self.requested += 1
+
+        if len(items) >= self.max_batch:
+            self._flush_node(node.node_id)
+        elif node.node_id not in self._timers:
+            self._timers[node.node_id] = asyncio.get_running_loop().call_later(
+                self.window, self._flush_node, node.node_id
+            )
+        return await future
+
+    def _flush_node(self, node_id: str):
+        timer = self._timers.pop(node_id, None)
+        if timer:
+            timer.cancel()
+        entry = self._pending.pop(node_id, None)
+        if not entry:
+            return
+        task = asyncio.create_task(self._send(*entry))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send(self, node, items: dict):
+        results = {}
+        try:
+            single = items
+            # В пакет идут только продления без ключа идемпотентности
+            batch = {slot: item for slot, item in items.items() if slot[1] is None}
+            if self.batch_path and len(batch) > 1:
+                sent = await self._send_batch(node, batch)
+                if sent is not None:
+                    results.update(sent)
+                    single = {slot: item for slot, item in items.items() if slot not in batch}
+            outcomes = await asyncio.gather(*(
+                self._send_one(node, config_id, days, key) for (config_id, key), (days, _) in single.items()
+            ))
+            results.update(zip(single.keys(), outcomes))
+        finally:
+            # Каждый ожидающий получает ответ, даже если отправка упала
+            self._resolve(items, results)
+
+    def _resolve(self, items: dict, results: dict):
+        for slot, (_, futures) in items.items():
+            ok = bool(results.get(slot))
+            if not ok:
+                self.failed += 1
+            for future in futures:
+                if not future.done():
+                    future.set_result(ok)
+
+    async def _send_one(self, node, config_id: str, days: int, idempotency_key: str = None) -> bool:
+        async with self._semaphore:
+            self.sent += 1
+            try:
+                client = await vpn_client.get_client()
+                return await client.extend_config(node, config_id, days, idempotency_key=idempotency_key)
+            except Exception as e:
+                logging.error(f"Ошибка продления {config_id} на {node.node_id}: {e}")
+                return False
+
+    async def _send_batch(self, node, items: dict):
+        """Один пакетный запрос: {(config_id, None): успех}.
+
+        None — запрос точно не отправлен (нет соединения, узел отключён
+        предохранителем), можно слать по одному. При таймауте или ошибке
+        сервера пакет мог примениться, и все продления считаются неудачными.
+        """
+        payload = {
+            "server": node.server,
+            "items": [{"uid": config_id, "time": days} for (config_id, _), (days, _) in items.items()]
+        }
+        async with self._semaphore:
+            try:
+                client = await vpn_client.get_client()
+                status, body = await client.request(node, 'extendconfig', self.batch_path, payload)
+                if status != 200:
+                    logging.error(f"Пакетное продление на {node.node_id}: {status} - {body}")
+                    return {}
+                data = json.loads(body)
+                results = data.get('results', data)
+                self.batches += 1
+                self.sent += 1
+                return {slot: bool(results.get(slot[0])) for slot in items}
+            except vpn_client.NOT_SENT_ERRORS as e:
+                logging.warning(f"Пакетное продление на {node.node_id} не отправлено, шлём по одному: {e!r}")
+                return None
+            except Exception as e:
+                logging.error(f"Ошибка пакетного продления на {node.node_id}: {e!r}")
+                return {}
+
+    def stats(self) -> dict:
+        return {
+            'requested': self.requested,
+            'sent': self.sent,
+            'batches': self.batches,
+            'failed': self.failed
+        }
+
+
+_coalescer = None
+
+
+def get_coalescer() -> ExtendCoalescer:
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = ExtendCoalescer()
+    return _coalescer
+
+
+async def extend(node, config_id: str, days: int, idempotency_key: str = None) -> bool:
+    """Продление конфига через общий объединитель запросов"""
+    return await get_coalescer().extend(node, config_id, days, idempotency_key)
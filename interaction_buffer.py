@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+import db_pool
+import stats_counters
+from config import INTERACTION_FLUSH_INTERVAL_MS, INTERACTION_FLUSH_MAX_RECORDS
+from timestamps import DISPLAY_FORMAT, to_ts
+
+__all__ = [
+    'InteractionBuffer',
+    'start_buffer',
+    'stop_buffer',
+    'get_buffer'
+]
+
+# Размер пачки user_id в запросе «кто из них уже есть в bot_users»
+_LOOKUP_CHUNK = 500
+
+_UPSERT_SQL = """
+    INSERT INTO bot_users (user_id, username, first_name, last_name, first_interaction, last_interaction,
+                           first_interaction_ts, last_interaction_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        last_interaction = excluded.last_interaction,
+        last_interaction_ts = excluded.last_interaction_ts
+"""
+
+
+class InteractionBuffer:
+    """Отложенная запись взаимодействий с ботом в bot_users.
+
+    Записи копятся в памяти (по одной на пользователя, последняя побеждает) и
+    сбрасываются одной транзакцией каждые interval_ms миллисекунд или сразу
+    после накопления max_records записей. При остановке остаток сбрасывается.
+    """
+
+    def __init__(self, interval_ms: int = 500, max_records: int = 500):
+        self.interval = max(1, interval_ms) / 1000
+        self.max_records = max(1, max_records)
+        self._pending = {}
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        # Метрики
+        self.flushes = 0
+        self.records_flushed = 0
+        self.new_users = 0
+        self.errors = 0
+        self.last_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def add(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        """Ставит взаимодействие в очередь на запись"""
+        now = datetime.now()
+        previous = self._pending.get(user_id)
+        first_seen = previous[4] if previous else now
+        self._pending[user_id] = (user_id, username, first_name, last_name, first_seen, now)
+        if len(self._pending) >= self.max_records:
+            self._full.set()
+
+    def discard(self, user_id: int):
+        """Убирает из очереди запись удаляемого пользователя"""
+        self._pending.pop(user_id, None)
+
+    async def flush(self) -> int:
+        """Записывает накопленные взаимодействия, возвращает число записей"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch = list(self._pending.values())
+            self._pending = {}
+            self._full.clear()
+
+            started = time.perf_counter()
+            try:
+                new_count = await self._write(batch)
+            except Exception as e:
+                self.errors += 1
+                logging.error(f"Ошибка записи взаимодействий ({len(batch)} шт.): {e}")
+                # Возвращаем пачку в очередь, не затирая более свежие записи
+                for record in batch:
+                    self._pending.setdefault(record[0], record)
+                return 0
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.records_flushed += len(batch)
+            self.new_users += new_count
+            self.last_flush_size = len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            logging.debug(f"Записано взаимодействий: {len(batch)} (новых {new_count}) за {elapsed_ms:.1f} мс")
+            return len(batch)
+
+    async def _write(self, batch: list) -> int:
+        """Один upsert всей пачки и учёт новых пользователей в сводках"""
+        rows = []
+        for user_id, username, first_name, last_name, first_seen, last_seen in batch:
+            rows.append((
+                user_id, username, first_name, last_name,
+                first_seen.strftime(DISPLAY_FORMAT), last_seen.strftime(DISPLAY_FORMAT),
+                to_ts(first_seen), to_ts(last_seen)
+            ))
+
+        async with db_pool.writer() as conn:
+            ids = [row[0] for row in rows]
+            existing = set()
+            for i in range(0, len(ids), _LOOKUP_CHUNK):
+                chunk = ids[i:i + _LOOKUP_CHUNK]
+                placeholders = ', '.join('?' * len(chunk))
+                cursor = await conn.execute(
+                    f"SELECT user_id FROM bot_users WHERE user_id IN ({placeholders})",
+                    chunk
+                )
+                existing.update(row[0] for row in await cursor.fetchall())
+
+            await conn.executemany(_UPSERT_SQL, rows)
+
+            # Новые пользователи по дням первого взаимодействия
+            new_by_day = {}
+            for row in rows:
+                if row[0] not in existing:
+                    day = stats_counters.day_key(row[6])
+                    ts, count = new_by_day.get(day, (row[6], 0))
+                    new_by_day[day] = (ts, count + 1)
+            for ts, count in new_by_day.values():
+                await stats_counters.record_bot_user(conn, ts, count)
+
+            await conn.commit()
+        return len(rows) - len(existing)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        """Запускает фоновый сброс"""
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logging.info(f"Буфер взаимодействий запущен: {self.interval * 1000:.0f} мс / {self.max_records} записей")
+
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает остаток"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'records_flushed': self.records_flushed,
+            'new_users': self.new_users,
+            'errors': self.errors,
+            'last_flush_size': self.last_flush_size,
+            'avg_flush_size': round(self.records_flushed / self.flushes, 1) if self.flushes else 0,
+            'last_flush_ms': round(self.last_flush_ms, 1),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0,
+            'max_flush_ms': round(self.max_flush_ms, 1)
+        }
+
+
+_buffer = None
+
+
+def get_buffer() -> InteractionBuffer:
+    """Общий буфер взаимодействий (создаётся при первом обращении)"""
+    global _buffer
+    if _buffer is None:
+        _buffer = InteractionBuffer(INTERACTION_FLUSH_INTERVAL_MS, INTERACTION_FLUSH_MAX_RECORDS)
+    return _buffer
+
+
+def start_buffer():
+    get_buffer().start()
+
+
+async def stop_buffer():
+    if _buffer is not None:
+        await _buffer.stop()
@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import hmac
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import quote
+from config import MINIAPP_BASE_URL, LINK_CACHE_SIZE, SUBSCRIPTION_SECRET
+
+__all__ = [
+    'UserLinks',
+    'LinkBuilder',
+    'build_vless_link',
+    'subscription_token',
+    'parse_subscription_token',
+    'get_user_links',
+    'stats'
+]
+
+# Параметры узла, из которых собирается ссылка: их изменение меняет версию шаблона
+_LINK_FIELDS = ('host', 'port', 'pbk', 'sid', 'sni', 'fp', 'flow', 'label')
+
+
+@dataclass(frozen=True)
+class UserLinks:
+    """Готовые ссылки пользователя для подключения"""
+    vless: str
+    miniapp: str
+    deep_link: str
+    subscription: str  # ссылка-подписка для автообновления в клиенте
+
+
+def _sign(user_id: int) -> str:
+    digest = hmac.new(SUBSCRIPTION_SECRET.encode(), str(user_id).encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip('=')
+
+
+def subscription_token(user_id: int) -> str:
+    """Токен ссылки-подписки: идентификатор пользователя и подпись HMAC"""
+    return f"{user_id}.{_sign(user_id)}"
+
+
+def parse_subscription_token(token: str):
+    """Идентификатор пользователя из токена или None, если подпись неверна"""
+    user_id, _, signature = token.partition('.')
+    if not user_id.isdigit() or not signature:
+        return None
+    if not hmac.compare_digest(signature, _sign(int(user_id))):
+        return None
+    return int(user_id)
+
+
+class LinkBuilder:
+    """Ссылки vless:// по заранее собранным шаблонам узлов.
+
+    Для каждого узла один раз собираются части ссылки до и после
+    идентификатора конфига; при изменении параметров узла шаблон
+    пересобирается с новой версией. Ссылки пользователей хранятся в LRU
+    с ключом (пользователь, конфиг, узел, версия шаблона), поэтому смена
+    конфига или узла сама делает старую запись недостижимой.
+    """
+
+    def __init__(self, maxsize: int = LINK_CACHE_SIZE, miniapp_base_url: str = MINIAPP_BASE_URL):
+        self.maxsize = max(1, maxsize)
+        self.miniapp_base_url = miniapp_base_url.rstrip('/')
+        # {node_id: (параметры, версия, начало ссылки, конец ссылки)}
+        self._templates = {}
+        self._version = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _template(self, node):
+        fields = tuple(getattr(node, name) for name in _LINK_FIELDS)
+        template = self._templates.get(node.node_id)
+        if template is None or template[0] != fields:
+            self._version += 1
+            template = (
+                fields,
+                self._version,
+                "vless://",
+                f"@{node.host}:{node.port}"
+                f"?type=tcp&security=reality&encryption=none&pbk={node.pbk}&fp={node.fp}"
+                f"&sni={node.sni}&sid={node.sid}&flow={node.flow}#{node.label}"
+            )
+            self._templates[node.node_id] = template
+        return template
+
+    def vless(self, node, config_id: str) -> str:
+        """Ссылка vless:// для конфига на узле"""
+        _, _, prefix, suffix = self._template(node)
+        return prefix + config_id + suffix
+
+    def user_links(self, user_id: int, config_id: str, node) -> UserLinks:
+        """Ссылки пользователя из кэша или по шаблону узла"""
+        config_id = config_id.strip('"\'')
+        _, version, prefix, suffix = self._template(node)
+        key = (user_id, config_id, node.node_id, version)
+        links = self._entries.get(key)
+        if links is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return links
+
+        self.misses += 1
+        vless = prefix + config_id + suffix
+        links = UserLinks(
+            vless=vless,
+            miniapp=f"{self.miniapp_base_url}/u/{user_id}?config={quote(vless, safe='')}",
+            deep_link=f"v2raytun://import/{vless}",
+            subscription=f"{self.miniapp_base_url}/sub/{subscription_token(user_id)}"
+        )
+        self._entries[key] = links
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return links
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'templates': len(self._templates),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+_builder = LinkBuilder()
+
+
+def build_vless_link(node, config_id: str) -> str:
+    return _builder.vless(node, config_id)
+
+
+def get_user_links(user_id: int, config_id: str, node) -> UserLinks:
+    return _builder.user_links(user_id, config_id, node)
+
+
+def stats() -> dict:
+    return _builder.stats()
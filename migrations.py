@@ -0,0 +1,158 @@
+import logging
+from timestamps import parse_ts
+from stats_counters import STATS_SCHEMA, rebuild_stats
+from vpn_nodes import NODES_SCHEMA
+from config_pool import POOL_SCHEMA
+from provisioning_outbox import OUTBOX_SCHEMA
+from expiry_scheduler import NOTIFICATIONS_SCHEMA
+from pending_payments import PENDING_SCHEMA
+from config import VPN_DEFAULT_NODE
+
+__all__ = [
+    'MIGRATIONS',
+    'get_schema_version',
+    'apply_migrations'
+]
+
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз в собственной транзакции и повышает версию до своего номера.
+
+
+async def _add_column(conn, table: str, column: str, definition: str):
+    """Добавляет колонку, если её ещё нет"""
+    cursor = await conn.execute(f"PRAGMA table_info({table})")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if column not in columns:
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+async def _backfill_ts(conn, table: str, key: str, pairs):
+    """Заполняет числовые колонки по текстовым датам (pairs: [(text_col, ts_col), ...])"""
+    text_cols = ', '.join(text_col for text_col, _ in pairs)
+    cursor = await conn.execute(f"SELECT {key}, {text_cols} FROM {table}")
+    rows = await cursor.fetchall()
+
+    updates = []
+    unparsed = 0
+    for row in rows:
+        values = []
+        for i, (text_col, _) in enumerate(pairs, start=1):
+            ts = parse_ts(row[i])
+            if row[i] and ts is None:
+                unparsed += 1
+            values.append(ts)
+        updates.append((*values, row[0]))
+
+    assignments = ', '.join(f"{ts_col} = ?" for _, ts_col in pairs)
+    await conn.executemany(f"UPDATE {table} SET {assignments} WHERE {key} = ?", updates)
+    if unparsed:
+        logging.warning(f"Миграция {table}: {unparsed} дат не удалось разобрать, оставлены пустыми")
+    logging.info(f"Миграция {table}: обновлено строк {len(updates)}")
+
+
+async def _migration_1_numeric_timestamps(conn):
+    """Числовые (epoch) колонки для дат подписок, платежей и взаимодействий"""
+    await _add_column(conn, 'users', 'payment_ts', 'INTEGER')
+    await _add_column(conn, 'users', 'expiry_ts', 'INTEGER')
+    await _add_column(conn, 'payments', 'payment_ts', 'INTEGER')
+    await _add_column(conn, 'bot_users', 'first_interaction_ts', 'INTEGER')
+    await _add_column(conn, 'bot_users', 'last_interaction_ts', 'INTEGER')
+
+    await _backfill_ts(conn, 'users', 'user_id', [
+        ('payment_date', 'payment_ts'),
+        ('expiry_date', 'expiry_ts')
+    ])
+    await _backfill_ts(conn, 'payments', 'id', [
+        ('payment_date', 'payment_ts')
+    ])
+    await _backfill_ts(conn, 'bot_users', 'user_id', [
+        ('first_interaction', 'first_interaction_ts'),
+        ('last_interaction', 'last_interaction_ts')
+    ])
+
+
+async def _migration_2_stats_counters(conn):
+    """Счётчики и дневные сводки статистики для админ-панели"""
+    for statement in STATS_SCHEMA:
+        await conn.execute(statement)
+    await rebuild_stats(conn)
+
+
+async def _migration_3_vpn_nodes(conn):
+    """Реестр VPN-узлов и закрепление пользователей за узлами"""
+    await conn.execute(NODES_SCHEMA)
+    await _add_column(conn, 'users', 'node_id', 'TEXT')
+    # Все выданные ранее конфиги созданы на узле по умолчанию
+    await conn.execute(
+        "UPDATE users SET node_id = ? WHERE node_id IS NULL AND config IS NOT NULL AND config != ''",
+        (VPN_DEFAULT_NODE,)
+    )
+
+
+async def _migration_4_config_pool(conn):
+    """Тёплый пул заранее выданных VPN-конфигов"""
+    await conn.execute(POOL_SCHEMA)
+
+
+async def _migration_5_provisioning_outbox(conn):
+    """Outbox заданий VPN API, записываемых вместе с оплатой"""
+    await conn.execute(OUTBOX_SCHEMA)
+
+
+async def _migration_6_expiry_notifications(conn):
+    """Отметки об отправленных напоминаниях и отзывах конфигов"""
+    await conn.execute(NOTIFICATIONS_SCHEMA)
+
+
+async def _migration_7_pending_payments(conn):
+    """Неоплаченные платежи ЮKassa для общего опроса статусов"""
+    await conn.execute(PENDING_SCHEMA)
+
+
+async def _migration_8_payment_provider_txn(conn):
+    """Идентификатор платежа у провайдера: один платёж зачисляется один раз"""
+    await _add_column(conn, 'payments', 'provider_txn_id', 'TEXT')
+    # У старых платежей идентификатора нет (NULL), уникальность их не затрагивает
+    await conn.execute(
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_provider_txn
+           ON payments (payment_method, provider_txn_id)"""
+    )
+
+
+MIGRATIONS = [
+    (1, _migration_1_numeric_timestamps),
+    (2, _migration_2_stats_counters),
+    (3, _migration_3_vpn_nodes),
+    (4, _migration_4_config_pool),
+    (5, _migration_5_provisioning_outbox),
+    (6, _migration_6_expiry_notifications),
+    (7, _migration_7_pending_payments),
+    (8, _migration_8_payment_provider_txn),
+]
+
+
+async def get_schema_version(conn) -> int:
+    """Текущая версия схемы БД"""
+    cursor = await conn.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def apply_migrations(conn):
+    """Применяет все ещё не выполненные миграции по порядку"""
+    version = await get_schema_version(conn)
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        logging.info(f"Применяется миграция схемы {number}: {migration.__doc__}")
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            await migration(conn)
+            await conn.execute(f"PRAGMA user_version = {number}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            logging.error(f"Миграция схемы {number} не выполнена", exc_info=True)
+            raise
+        version = number
+    return version
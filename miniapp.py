@@ -1,16 +1,42 @@
 import os
+import time
+import base64
+import hashlib
 import sqlite3
+import threading
+from collections import OrderedDict
 from urllib.parse import quote
 from datetime import datetime
-from flask import Flask, request, render_template_string
+from flask import Flask, request, render_template_string, make_response
 
 try:
-    from config import DB_PATH
+    from config import (
+        DB_PATH,
+        VPN_DEFAULT_NODE,
+        SUBSCRIPTION_SECRET,
+        SUBSCRIPTION_FEED_TTL,
+        SUBSCRIPTION_FEED_CACHE_SIZE,
+        SUBSCRIPTION_UPDATE_INTERVAL_HOURS,
+        SUBSCRIPTION_PROFILE_TITLE
+    )
     from database import is_subscription_active_check
+    from db_engine import apply_engine_profile_sync
+    import links
+    import vpn_nodes
 except Exception:
+    # Без модулей бота ссылка-подписка отключена
+    links = None
+    SUBSCRIPTION_SECRET = ''
+    SUBSCRIPTION_FEED_TTL = 30
+    SUBSCRIPTION_FEED_CACHE_SIZE = 10000
+    SUBSCRIPTION_UPDATE_INTERVAL_HOURS = 12
+    SUBSCRIPTION_PROFILE_TITLE = 'Shard VPN'
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     DB_PATH = os.path.join(BASE_DIR, 'users.db')
 
+    def apply_engine_profile_sync(conn):
+        conn.execute("PRAGMA busy_timeout = 5000")
+
     def is_subscription_active_check(expiry_date_str: str) -> bool:
         if not expiry_date_str:
             return False
@@ -29,9 +55,10 @@ app = Flask(__name__)
 def fetch_user_row(user_id: int):
     conn = sqlite3.connect(DB_PATH)
     try:
+        apply_engine_profile_sync(conn)
         cur = conn.cursor()
         cur.execute(
-            "SELECT subscribed, expiry_date, config FROM users WHERE user_id = ?",
+            "SELECT subscribed, expiry_date, config, expiry_ts, node_id FROM users WHERE user_id = ?",
             (user_id,)
         )
         row = cur.fetchone()
@@ -40,12 +67,110 @@ def fetch_user_row(user_id: int):
         return {
             'subscribed': bool(row[0]),
             'expiry_date': row[1],
-            'config_id': (row[2] or '').strip('"\'')
+            'config_id': (row[2] or '').strip('"\''),
+            'expiry_ts': row[3],
+            'node_id': row[4]
         }
     finally:
         conn.close()
 
 
+def fetch_node(node_id: str):
+    """Узел из таблицы vpn_nodes (реестр в памяти есть только у бота)"""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        apply_engine_profile_sync(conn)
+        conn.row_factory = sqlite3.Row
+        row = conn.execute(
+            "SELECT * FROM vpn_nodes WHERE node_id = ?",
+            (node_id or VPN_DEFAULT_NODE,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return vpn_nodes.get_node(node_id)
+    return vpn_nodes.VPNNode(**{key: row[key] for key in row.keys()})
+
+
+class FeedCache:
+    """Готовые ответы ссылки-подписки по пользователям.
+
+    На каждый запрос читается только версия подписки: строка users по
+    первичному ключу (срок, конфиг, узел) и параметры узла из общего кэша
+    узлов, который перечитывается раз в node_ttl секунд. Тело и ETag
+    пересобираются, лишь когда версия изменилась, так что клиент с
+    If-None-Match получает 304 без сборки ответа. Flask обслуживает запросы
+    в потоках, поэтому словари защищены блокировкой.
+    """
+
+    def __init__(self, maxsize: int = 10000, node_ttl: float = 30):
+        self.maxsize = max(1, maxsize)
+        self.node_ttl = node_ttl
+        # {user_id: запись}
+        self._entries = OrderedDict()
+        # {node_id: (узел, отпечаток параметров, момент чтения)}
+        self._nodes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _node(self, node_id: str):
+        with self._lock:
+            cached = self._nodes.get(node_id)
+        if cached is not None and cached[2] + self.node_ttl > time.monotonic():
+            return cached[0], cached[1]
+        node = fetch_node(node_id)
+        stamp = hashlib.sha256(repr(sorted(vars(node).items())).encode()).hexdigest()[:16]
+        with self._lock:
+            self._nodes[node_id] = (node, stamp, time.monotonic())
+        return node, stamp
+
+    def get(self, user_id: int):
+        """Запись для пользователя; None — подписки или конфига нет"""
+        row = fetch_user_row(user_id)
+        if row is None or not row['config_id']:
+            with self._lock:
+                self._entries.pop(user_id, None)
+            return None
+        node, stamp = self._node(row['node_id'])
+        version = (row['subscribed'], row['expiry_ts'] or 0, row['config_id'], node.node_id, stamp)
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached is not None and cached['version'] == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        entry = build_feed(row, node, version)
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+
+feed_cache = FeedCache(SUBSCRIPTION_FEED_CACHE_SIZE, SUBSCRIPTION_FEED_TTL)
+
+
+def build_feed(row: dict, node, version: tuple) -> dict:
+    """Тело подписки (base64 списка ссылок) с валидаторами для кэша клиента.
+
+    ETag выводится из версии подписки, а не из тела: пока срок, конфиг и
+    узел не менялись, он тот же.
+    """
+    body = base64.b64encode(links.build_vless_link(node, row['config_id']).encode()).decode()
+    return {
+        'version': version,
+        'body': body,
+        'etag': hashlib.sha256(repr(version).encode()).hexdigest()[:32],
+        'last_modified': int(time.time()),
+        'expiry_ts': row['expiry_ts'] or 0,
+        'subscribed': row['subscribed']
+    }
+
+
 PAGE_TEMPLATE = """
 <!doctype html>
 <html lang=\"ru\">
@@ -147,7 +272,10 @@ def user_page(user_id: int):
         exists = False
     else:
         expiry_date = row['expiry_date'] or ''
-        active = bool(row['subscribed'] and is_subscription_active_check(expiry_date))
+        if row['expiry_ts'] is not None:
+            active = bool(row['subscribed'] and row['expiry_ts'] > time.time())
+        else:
+            active = bool(row['subscribed'] and is_subscription_active_check(expiry_date))
         exists = True
 
     if config_str:
@@ -164,6 +292,41 @@ def user_page(user_id: int):
     )
 
 
+@app.get("/sub/<token>")
+def subscription_feed(token: str):
+    """Ссылка-подписка для клиентов: список конфигов в base64 с поддержкой 304"""
+    user_id = links.parse_subscription_token(token) if links and SUBSCRIPTION_SECRET else None
+    if user_id is None:
+        return "Not found", 404
+    entry = feed_cache.get(user_id)
+    if entry is None:
+        return "Not found", 404
+
+    now = int(time.time())
+    interval = SUBSCRIPTION_UPDATE_INTERVAL_HOURS * 3600
+    active = entry['subscribed'] and entry['expiry_ts'] > now
+    if active:
+        response = make_response(entry['body'], 200)
+        # Дальше срока подписки кэшировать нельзя: после него ответ станет 410
+        max_age = max(0, min(interval, entry['expiry_ts'] - now))
+    else:
+        # Подписка закончилась: клиент видит срок и перестаёт опрашивать до продления
+        response = make_response("Subscription expired", 410)
+        max_age = interval
+    response.mimetype = 'text/plain'
+    response.set_etag(entry['etag'])
+    response.last_modified = entry['last_modified']
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.expires = now + max_age
+    response.headers['Subscription-Userinfo'] = f"upload=0; download=0; total=0; expire={entry['expiry_ts']}"
+    response.headers['Profile-Update-Interval'] = str(SUBSCRIPTION_UPDATE_INTERVAL_HOURS)
+    response.headers['Profile-Title'] = f"base64:{base64.b64encode(SUBSCRIPTION_PROFILE_TITLE.encode()).decode()}"
+    if active:
+        response.make_conditional(request)
+    return response
+
+
 if __name__ == "__main__":
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", "8081"))
@@ -1,19 +1,136 @@
 import uuid
 import asyncio
-import aiosqlite
 import logging
-from yookassa import Configuration, Payment
-from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_RETURN_URL, DB_PATH
-from database import add_payment
-from datetime import datetime
-# Настройка ЮKассы
-Configuration.configure(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
-
-# Глобальный набор для отслеживания активных проверок
-active_checks = set()
-
-async def create_payment(period: str, user_id: int):
-    """Создает платеж в ЮKассе"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from config import YOOKASSA_RETURN_URL, PAYMENT_REUSE_TTL, PAYMENT_REUSE_CACHE_SIZE
+import db_pool
+import pending_payments
+from database import add_payment, check_user_payment, get_user_data, PAYMENT_DUPLICATE
+from yookassa_gateway import get_gateway
+
+
+@dataclass
+class _Reusable:
+    """Неоплаченный платёж и сообщение, в котором сейчас его кнопка оплаты"""
+    payment_info: dict
+    chat_id: int
+    message_id: int
+    expires_at: float
+
+
+class _ReuseCache:
+    """LRU неоплаченных платежей по (user_id, период) со временем жизни записи"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def peek(self, key: tuple):
+        """Запись без учёта в метриках и без проверки срока"""
+        return self._entries.get(key)
+
+    def put(self, key: tuple, payment_info: dict, chat_id: int, message_id: int):
+        self._entries[key] = _Reusable(payment_info, chat_id, message_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: tuple, payment_id: str = None):
+        """Убирает запись; с payment_id — только если она об этом платеже"""
+        entry = self._entries.get(key)
+        if entry is not None and (payment_id is None or entry.payment_info['payment_id'] == payment_id):
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+# Неоплаченные платежи по (user_id, период): повторный выбор тарифа отдаёт
+# ту же ссылку на оплату без запроса к API
+_reusable = _ReuseCache(PAYMENT_REUSE_CACHE_SIZE, PAYMENT_REUSE_TTL)
+# Платежи, которые создаются прямо сейчас: {(user_id, период): задача}
+_creating = {}
+
+
+async def _move_button(key: tuple, entry: _Reusable, chat_id: int, message_id: int) -> bool:
+    """Указывает платёжу новое сообщение с кнопкой оплаты; False — платежа уже нет в ожидании"""
+    if (entry.chat_id, entry.message_id) == (chat_id, message_id):
+        return True
+    async with db_pool.transaction() as conn:
+        cursor = await conn.execute(
+            "UPDATE pending_payments SET chat_id = ?, message_id = ? WHERE payment_id = ?",
+            (chat_id, message_id, entry.payment_info['payment_id'])
+        )
+    if not cursor.rowcount:
+        _reusable.discard(key)
+        return False
+    entry.chat_id, entry.message_id = chat_id, message_id
+    return True
+
+
+async def _reuse_pending(key: tuple, chat_id: int, message_id: int):
+    """Данные ещё ожидающего оплаты платежа из кэша или None.
+
+    Если кнопку нажали в другом сообщении, строка в pending_payments
+    заодно указывает на него; если строки уже нет (платёж оплачен,
+    отменён или брошен), запись кэша устарела. Оплата и отмена сами
+    убирают платёж из кэша, поэтому нажатие в том же сообщении к БД
+    не обращается.
+    """
+    entry = _reusable.get(key)
+    if entry is None or not await _move_button(key, entry, chat_id, message_id):
+        return None
+    return entry.payment_info
+
+
+async def create_payment(period: str, user_id: int, chat_id: int = None, message_id: int = None):
+    """Создает платеж в ЮKассе и ставит его на проверку статуса.
+
+    Если у пользователя уже есть неоплаченный платёж за этот период,
+    возвращается он; одновременные нажатия ждут один и тот же запрос,
+    и кнопка оплаты переносится в сообщение каждого из них.
+    """
+    key = (user_id, period)
+    reused = await _reuse_pending(key, chat_id, message_id)
+    if reused is not None:
+        return reused
+    task = _creating.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_create_payment(period, user_id, chat_id, message_id))
+        _creating[key] = task
+        task.add_done_callback(lambda _: _creating.pop(key, None))
+        return await asyncio.shield(task)
+    payment_info = await asyncio.shield(task)
+    if payment_info is not None:
+        entry = _reusable.peek(key)
+        if entry is not None:
+            await _move_button(key, entry, chat_id, message_id)
+    return payment_info
+
+
+async def _create_payment(period: str, user_id: int, chat_id: int, message_id: int):
+    """Создает новый платеж в ЮKассе"""
     periods = {
         '1': {'value': '149.00', 'description': '1 месяц'},
         '3': {'value': '399.00', 'description': '3 месяца'},
@@ -26,7 +143,8 @@ async def create_payment(period: str, user_id: int):
         return None
     
     try:
-        payment = Payment.create({
+        gateway = await get_gateway()
+        payment = await gateway.create_payment({
             "amount": {
                 "value": periods[period]['value'],
                 "currency": "RUB"
@@ -42,111 +160,119 @@ async def create_payment(period: str, user_id: int):
                 "period": period
             }
         }, str(uuid.uuid4()))
-        
-        return {
-            'confirmation_url': payment.confirmation.confirmation_url,
+
+        async with db_pool.transaction() as conn:
+            await pending_payments.add_pending(
+                conn, payment.id, user_id, period, payment.confirmation_url, chat_id, message_id
+            )
+        pending_payments.get_poller().wakeup()
+
+        payment_info = {
+            'confirmation_url': payment.confirmation_url,
             'payment_id': payment.id,
             'period': period
         }
+        _reusable.put((user_id, period), payment_info, chat_id, message_id)
+        return payment_info
     except Exception as e:
         logging.error(f"Ошибка создания платежа: {str(e)}", exc_info=True)
         return None
 
-async def check_payment_status(payment_data: dict, bot):
-    """Автоматически проверяет статус платежа"""
-    payment_id = payment_data['payment_id']
-    
+
+def reuse_stats() -> dict:
+    """Метрики повторной выдачи неоплаченных платежей"""
+    return _reusable.stats()
+
+
+async def activate_payment(payment_id: str, bot, metadata: dict = None) -> bool:
+    """Зачисляет оплаченный платёж: продлевает подписку и сообщает пользователю.
+
+    Данные платежа берутся из pending_payments, а если его там нет (платёж
+    уже брошен опросом или создан до появления таблицы) — из metadata.
+    Повторная доставка уже зачисленного платежа отсекается в add_payment
+    и пользователю второй раз не сообщается. Возвращает False, если
+    зачислить не удалось: платёж остаётся в ожидании, и уведомление или
+    опрос повторят попытку.
+    """
     try:
-        for _ in range(60):  # 10 минут (60 попыток * 10 секунд)
-            try:
-                payment = Payment.find_one(payment_id)
-                
-                if payment.status == "succeeded":
-                    # Проверяем, была ли подписка активной ДО продления
-                    was_active = False
-                    try:
-                        async with aiosqlite.connect(DB_PATH) as conn:
-                            cursor = await conn.execute(
-                                "SELECT expiry_date FROM users WHERE user_id=?",
-                                (payment_data['user_id'],)
-                            )
-                            row_before = await cursor.fetchone()
-                            if row_before and row_before[0]:
-                                expiry_str = row_before[0]
-                                from datetime import datetime
-                                for fmt in ('%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
-                                    try:
-                                        dt = datetime.strptime(expiry_str, fmt)
-                                        was_active = datetime.now() < dt
-                                        if was_active or True:
-                                            break
-                                    except ValueError:
-                                        continue
-                    except Exception:
-                        was_active = False
-                    # Добавляем оплату в БД
-                    success = await add_payment(
-                        payment_data['user_id'],
-                        int(payment_data['period'])
-                    )
-                    
-                    if not success:
-                        logging.error("Не удалось обновить подписку в БД")
-                        return False
-                    
-                    # Удаляем сообщение с платежом
-                    try:
-                        await bot.delete_message(
-                            chat_id=payment_data['chat_id'],
-                            message_id=payment_data['message_id']
-                        )
-                    except Exception as e:
-                        logging.warning(f"Не удалось удалить сообщение: {e}")
-
-                    # Получаем дату окончания и форматируем её
-                    async with aiosqlite.connect(DB_PATH) as conn:
-                        cursor = await conn.execute(
-                            "SELECT expiry_date FROM users WHERE user_id=?",
-                            (payment_data['user_id'],)
-                        )
-                        row = await cursor.fetchone()
-                        if row and row[0]:
-                            try:
-                                expiry_date = datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
-                            except ValueError:
-                                expiry_date = row[0]
-                        else:
-                            expiry_date = "не определена"
-
-                    # Отправляем сообщение об успешной оплате
-                    action_word = "продлена" if was_active else "активирована"
-                    await bot.send_message(
-                        chat_id=payment_data['chat_id'],
-                        text=f"""
+        async with db_pool.reader() as conn:
+            pending = await pending_payments.get_pending(conn, payment_id)
+        if pending is not None:
+            user_id, period = pending.user_id, pending.period
+            chat_id, message_id = pending.chat_id or pending.user_id, pending.message_id
+        elif metadata and 'user_id' in metadata and 'period' in metadata:
+            user_id, period = int(metadata['user_id']), metadata['period']
+            chat_id, message_id = user_id, None
+        else:
+            logging.error(f"Платеж {payment_id}: нет данных пользователя для зачисления")
+            return False
+
+        # Проверяем, была ли подписка активной ДО продления
+        was_active = await check_user_payment(user_id)
+        # Добавляем оплату в БД
+        success = await add_payment(user_id, int(period), payment_id, 'yookassa')
+    except Exception as e:
+        logging.error(f"Ошибка зачисления платежа {payment_id}: {e}", exc_info=True)
+        success = False
+    if not success:
+        logging.error("Не удалось обновить подписку в БД")
+        return False
+
+    async with db_pool.transaction() as conn:
+        await pending_payments.remove_pending(conn, payment_id)
+    _reusable.discard((user_id, period), payment_id)
+    if success == PAYMENT_DUPLICATE:
+        return True
+
+    # Удаляем сообщение с платежом
+    if message_id:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logging.warning(f"Не удалось удалить сообщение: {e}")
+
+    # Получаем дату окончания
+    user_data = await get_user_data(user_id)
+    expiry_date = user_data[0] if user_data else "не определена"
+
+    # Отправляем сообщение об успешной оплате
+    action_word = "продлена" if was_active else "активирована"
+    try:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=f"""
 <b>✅ Оплата успешно выполнена</b>
 
 <b>Ваша подписка на Shard VPN {action_word}!</b>
 
-<b>Срок подписки:</b> {payment_data['period']} мес.
+<b>Срок подписки:</b> {period} мес.
 <b>Дата окончания:</b> <code>{expiry_date}</code>
 
 <blockquote><i>🔹 Нажмите «Активировать VPN», чтобы начать пользоваться.</i></blockquote>
 """,
-                        message_effect_id="5046509860389126442"
-                    )
-                    return True
-                    
-                elif payment.status in ("canceled", "failed"):
-                    return False
-                    
-            except Exception as e:
-                logging.error(f"Ошибка проверки платежа: {str(e)}", exc_info=True)
-            
-            await asyncio.sleep(10)
-        
-        logging.warning(f"Платеж {payment_id} не завершился в течение 10 минут")
-        return False
-        
+            message_effect_id="5046509860389126442"
+        )
     except Exception as e:
-        logging.error(f"Критическая ошибка в check_payment_status: {str(e)}", exc_info=True)
-        return False
\ No newline at end of file
+        logging.warning(f"Не удалось сообщить {user_id} об оплате: {e}")
+    return True
+
+
+async def cancel_payment(payment_id: str):
+    """Платёж отменён: прекращаем его проверку"""
+    async with db_pool.transaction() as conn:
+        pending = await pending_payments.get_pending(conn, payment_id)
+        removed = await pending_payments.remove_pending(conn, payment_id)
+    if pending is not None:
+        _reusable.discard((pending.user_id, pending.period), payment_id)
+    if removed:
+        logging.info(f"Платеж {payment_id} отменён")
+
+
+async def settle_payment(payment, bot) -> bool:
+    """Доводит платёж с окончательным статусом (GatewayPayment); True — больше проверять не нужно"""
+    if payment.status == "succeeded":
+        return await activate_payment(payment.id, bot, payment.metadata)
+    if payment.status in ("canceled", "failed"):
+        await cancel_payment(payment.id)
+        return True
+    return False
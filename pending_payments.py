@@ -0,0 +1,305 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+import db_pool
+from yookassa_gateway import get_gateway
+from config import (
+    PAYMENT_POLL_SCHEDULE,
+    PAYMENT_POLL_INTERVAL,
+    PAYMENT_POLL_BATCH_SIZE,
+    PAYMENT_POLL_LIST_THRESHOLD
+)
+from timestamps import now_ts
+
+__all__ = [
+    'PENDING_SCHEMA',
+    'PendingPayment',
+    'DUE_SQL',
+    'add_pending',
+    'get_pending',
+    'remove_pending',
+    'pending_count',
+    'set_handler',
+    'PaymentPoller',
+    'get_poller',
+    'start_poller',
+    'stop_poller'
+]
+
+# Созданные, но ещё не оплаченные платежи ЮKassa. Строка удаляется, когда
+# платёж зачислен, отменён или брошен неоплаченным, так что таблица не растёт.
+PENDING_SCHEMA = '''CREATE TABLE IF NOT EXISTS pending_payments
+                    (payment_id TEXT PRIMARY KEY,
+                     user_id INTEGER NOT NULL,
+                     chat_id INTEGER,
+                     message_id INTEGER,
+                     period TEXT NOT NULL,
+                     confirmation_url TEXT,
+                     created_ts INTEGER NOT NULL,
+                     next_check_ts INTEGER NOT NULL,
+                     checks INTEGER NOT NULL DEFAULT 0)'''
+
+_COLUMNS = ('payment_id', 'user_id', 'chat_id', 'message_id', 'period',
+            'confirmation_url', 'created_ts', 'next_check_ts', 'checks')
+
+# Платежи, время проверки которых пришло
+DUE_SQL = f"""SELECT {', '.join(_COLUMNS)} FROM pending_payments
+              WHERE next_check_ts <= ? ORDER BY next_check_ts LIMIT ?"""
+
+# Расписание проверок по возрастанию возраста; пустое в конфиге — час раз в минуту
+_SCHEDULE = sorted(PAYMENT_POLL_SCHEDULE) or [(3600, 60)]
+# Через столько секунд после создания неоплаченный платёж больше не проверяется
+_PENDING_TTL = _SCHEDULE[-1][0]
+# Интервал проверки оплаченного, но не зачисленного платежа после срока
+_STUCK_INTERVAL = _SCHEDULE[-1][1]
+# Страниц списка платежей за один проход, дальше — запросы по одному
+_LIST_MAX_PAGES = 5
+# Пауза без платежей в очереди; новый платёж будит опрос сразу
+_IDLE_INTERVAL = 30
+
+# Уведомления ЮKassa принимаются (webhooks.py) — опрос нужен только как запасной
+webhooks_enabled = False
+
+# Обработка платежа с окончательным статусом: async (GatewayPayment) -> bool
+_handler = None
+
+
+def set_handler(handler):
+    global _handler
+    _handler = handler
+
+
+@dataclass
+class PendingPayment:
+    """Строка pending_payments"""
+    payment_id: str
+    user_id: int
+    chat_id: int
+    message_id: int
+    period: str
+    confirmation_url: str
+    created_ts: int
+    next_check_ts: int
+    checks: int
+
+
+def _interval(age: int):
+    """Интервал следующей проверки по возрасту платежа; None — платёж брошен"""
+    for max_age, interval in _SCHEDULE:
+        if age < max_age:
+            return max(interval, PAYMENT_POLL_INTERVAL) if webhooks_enabled else interval
+    return None
+
+
+async def add_pending(conn, payment_id: str, user_id: int, period: str, confirmation_url: str,
+                      chat_id: int = None, message_id: int = None):
+    """Записывает созданный платёж (в транзакции вызывающего кода)"""
+    now = now_ts()
+    await conn.execute(
+        f"""INSERT OR IGNORE INTO pending_payments ({', '.join(_COLUMNS[:-1])})
+            VALUES ({', '.join('?' * (len(_COLUMNS) - 1))})""",
+        (payment_id, user_id, chat_id, message_id, period, confirmation_url, now, now + _interval(0))
+    )
+
+
+async def get_pending(conn, payment_id: str):
+    cursor = await conn.execute(
+        f"SELECT {', '.join(_COLUMNS)} FROM pending_payments WHERE payment_id = ?",
+        (payment_id,)
+    )
+    row = await cursor.fetchone()
+    return PendingPayment(*row) if row else None
+
+
+async def remove_pending(conn, payment_id: str) -> bool:
+    """Убирает платёж из ожидания; False — его там уже не было"""
+    cursor = await conn.execute("DELETE FROM pending_payments WHERE payment_id = ?", (payment_id,))
+    return cursor.rowcount > 0
+
+
+async def pending_count(conn) -> int:
+    cursor = await conn.execute("SELECT COUNT(*) FROM pending_payments")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+class PaymentPoller:
+    """Один цикл проверки статусов всех неоплаченных платежей.
+
+    Платежи берутся из pending_payments пачками по времени следующей
+    проверки, поэтому после перезапуска опрос продолжается с того же места.
+    Если в пачке несколько платежей, статусы читаются списком платежей ЮKassa
+    начиная с самого старого из них; по одному запрашиваются только те, что
+    в список не попали. Чем старше платёж, тем реже он проверяется, а после
+    последней ступени расписания удаляется как брошенный — но только если
+    ЮKassa подтвердила, что он не оплачен. Оплаченный, но не зачисленный
+    платёж проверяется дальше, пока зачисление не пройдёт.
+    """
+
+    def __init__(self, batch_size: int = PAYMENT_POLL_BATCH_SIZE,
+                 list_threshold: int = PAYMENT_POLL_LIST_THRESHOLD):
+        self.batch_size = max(1, batch_size)
+        self.list_threshold = max(1, list_threshold)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.checked = 0
+        self.api_calls = 0
+        self.resolved = 0
+        self.expired = 0
+        # Оплачены, но не зачислены после срока опроса
+        self._stuck = set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def wakeup(self):
+        """Просит пересчитать время ближайшей проверки (после записи нового платежа)"""
+        self._wakeup.set()
+
+    async def _fetch(self, pending: list) -> dict:
+        """{payment_id: GatewayPayment} для платежей пачки, статус которых удалось получить"""
+        gateway = await get_gateway()
+        wanted = {p.payment_id for p in pending}
+        found = {}
+        if len(pending) >= self.list_threshold:
+            cursor = None
+            since = min(p.created_ts for p in pending)
+            for _ in range(_LIST_MAX_PAGES):
+                try:
+                    items, cursor = await gateway.list_payments(since, cursor)
+                except Exception as e:
+                    logging.warning(f"Не удалось получить список платежей: {e}")
+                    break
+                self.api_calls += 1
+                found.update((item.id, item) for item in items if item.id in wanted)
+                if not cursor or len(found) == len(wanted):
+                    break
+
+        async def find_one(payment_id: str):
+            try:
+                return await gateway.find_payment(payment_id)
+            except Exception as e:
+                logging.warning(f"Не удалось проверить платеж {payment_id}: {e}")
+                return None
+
+        missing = [payment_id for payment_id in wanted if payment_id not in found]
+        self.api_calls += len(missing)
+        for payment in await asyncio.gather(*(find_one(payment_id) for payment_id in missing)):
+            if payment is not None:
+                found[payment.id] = payment
+        return found
+
+    async def process(self) -> int:
+        """Один проход по платежам, время проверки которых пришло; возвращает их число"""
+        now = now_ts()
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute(DUE_SQL, (now, self.batch_size))
+            pending = [PendingPayment(*row) for row in await cursor.fetchall()]
+        if not pending:
+            return 0
+
+        found = await self._fetch(pending)
+        self.checked += len(pending)
+        for p in pending:
+            payment = found.get(p.payment_id)
+            if payment is None or payment.status in ('pending', 'waiting_for_capture') or _handler is None:
+                continue
+            try:
+                # Обработчик сам убирает платёж из ожидания, если довёл его до конца
+                if await _handler(payment):
+                    self.resolved += 1
+                    self._stuck.discard(p.payment_id)
+            except Exception as e:
+                logging.error(f"Ошибка обработки платежа {p.payment_id}: {e}")
+
+        now = now_ts()
+        async with db_pool.transaction() as conn:
+            for p in pending:
+                interval = _interval(now - p.created_ts)
+                if interval is None:
+                    payment = found.get(p.payment_id)
+                    status = payment.status if payment else None
+                    if status == 'pending':
+                        if await remove_pending(conn, p.payment_id):
+                            self.expired += 1
+                            logging.info(f"Платеж {p.payment_id} не оплачен за {_PENDING_TTL // 60} мин, проверка прекращена")
+                        continue
+                    # Статус неизвестен или деньги получены — не бросаем
+                    interval = _STUCK_INTERVAL
+                    if status in ('succeeded', 'waiting_for_capture'):
+                        self._stuck.add(p.payment_id)
+                        logging.error(f"Платеж {p.payment_id} ({status}) не зачислен за {_PENDING_TTL // 60} мин, "
+                                      f"user_id={p.user_id}, повтор через {interval} с")
+                await conn.execute(
+                    "UPDATE pending_payments SET next_check_ts = ?, checks = checks + 1 WHERE payment_id = ?",
+                    (now + interval, p.payment_id)
+                )
+        return len(pending)
+
+    async def _next_due(self):
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute("SELECT MIN(next_check_ts) FROM pending_payments")
+            row = await cursor.fetchone()
+        return row[0]
+
+    async def _run(self):
+        while True:
+            timeout = _IDLE_INTERVAL
+            try:
+                # Полная пачка — возможно, есть ещё платежи к проверке, не ждём
+                if await self.process() >= self.batch_size:
+                    continue
+                next_due = await self._next_due()
+                if next_due is not None:
+                    timeout = max(0, min(timeout, next_due - now_ts()))
+            except Exception as e:
+                logging.error(f"Ошибка опроса платежей: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logging.info("Опрос неоплаченных платежей запущен")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'checked': self.checked,
+            'api_calls': self.api_calls,
+            'resolved': self.resolved,
+            'expired': self.expired,
+            'stuck': len(self._stuck)
+        }
+
+
+_poller = None
+
+
+def get_poller() -> PaymentPoller:
+    global _poller
+    if _poller is None:
+        _poller = PaymentPoller()
+    return _poller
+
+
+def start_poller():
+    get_poller().start()
+
+
+async def stop_poller():
+    if _poller is not None:
+        await _poller.stop()
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+import db_pool
+from config import (
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_CONCURRENCY,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE,
+    OUTBOX_BACKOFF_MAX
+)
+from timestamps import now_ts
+
+__all__ = [
+    'OUTBOX_SCHEMA',
+    'PROVISION',
+    'EXTEND',
+    'REVOKE',
+    'OutboxJob',
+    'DUE_SQL',
+    'HAS_PENDING_SQL',
+    'enqueue',
+    'has_pending',
+    'outbox_levels',
+    'ProvisioningWorker',
+    'register_handler',
+    'set_notifier',
+    'get_worker',
+    'start_worker',
+    'stop_worker'
+]
+
+# Задания для VPN API, записанные в одной транзакции с изменением подписки.
+# idempotency_key не даёт поставить одно и то же задание дважды.
+OUTBOX_SCHEMA = '''CREATE TABLE IF NOT EXISTS provisioning_outbox
+                   (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    operation TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    days INTEGER NOT NULL DEFAULT 0,
+                    config_id TEXT,
+                    node_id TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_ts INTEGER NOT NULL,
+                    last_error TEXT,
+                    created_ts INTEGER NOT NULL,
+                    completed_ts INTEGER)'''
+
+# Операции заданий
+PROVISION = 'provision'  # выдать конфиг пользователю без конфига
+EXTEND = 'extend'  # продлить конфиг на сервере на days дней
+REVOKE = 'revoke'  # отозвать конфиг истёкшей подписки
+
+# Статусы заданий
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# Задания, время которых пришло, и проверка невыполненного задания пользователя
+DUE_SQL = """SELECT id, idempotency_key, operation, user_id, days, config_id, node_id, attempts
+             FROM provisioning_outbox
+             WHERE status = ? AND next_attempt_ts <= ?
+             ORDER BY next_attempt_ts LIMIT ?"""
+HAS_PENDING_SQL = "SELECT 1 FROM provisioning_outbox WHERE user_id = ? AND operation = ? AND status = ? LIMIT 1"
+
+
+@dataclass
+class OutboxJob:
+    """Задание из provisioning_outbox"""
+    id: int
+    idempotency_key: str
+    operation: str
+    user_id: int
+    days: int
+    config_id: str
+    node_id: str
+    attempts: int
+
+
+async def enqueue(conn, key: str, operation: str, user_id: int, days: int = 0,
+                  config_id: str = None, node_id: str = None) -> bool:
+    """Ставит задание в транзакции вызывающего кода; False — задание с таким ключом уже есть"""
+    ts = now_ts()
+    cursor = await conn.execute(
+        """INSERT OR IGNORE INTO provisioning_outbox
+           (idempotency_key, operation, user_id, days, config_id, node_id, next_attempt_ts, created_ts)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (key, operation, user_id, days, config_id, node_id, ts, ts)
+    )
+    return cursor.rowcount > 0
+
+
+async def has_pending(conn, user_id: int, operation: str) -> bool:
+    """Есть ли у пользователя невыполненное задание этой операции"""
+    cursor = await conn.execute(HAS_PENDING_SQL, (user_id, operation, PENDING))
+    return await cursor.fetchone() is not None
+
+
+async def outbox_levels(conn) -> dict:
+    """Число заданий по статусам: {status: количество}"""
+    cursor = await conn.execute("SELECT status, COUNT(*) FROM provisioning_outbox GROUP BY status")
+    return dict(await cursor.fetchall())
+
+
+# Обработчики операций: {operation: async (job) -> bool}; регистрирует database
+_handlers = {}
+# Уведомление о завершении: async (job, ok) -> None; ok=False — попытки исчерпаны
+_notifier = None
+
+
+def register_handler(operation: str, handler):
+    _handlers[operation] = handler
+
+
+def set_notifier(notifier):
+    global _notifier
+    _notifier = notifier
+
+
+class ProvisioningWorker:
+    """Фоновое выполнение заданий outbox с повторами.
+
+    Неудачное задание откладывается с экспоненциальной паузой и случайным
+    разбросом; после max_attempts попыток оно помечается failed и о нём
+    сообщается через уведомитель. Обработчики должны быть безопасны для
+    повторного выполнения: задание может повториться, если бот остановился
+    между вызовом API и отметкой о выполнении.
+    """
+
+    def __init__(self, interval: float = OUTBOX_POLL_INTERVAL, batch_size: int = OUTBOX_BATCH_SIZE,
+                 concurrency: int = OUTBOX_CONCURRENCY, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def wakeup(self):
+        """Просит обработать очередь сейчас (после записи нового задания)"""
+        self._wakeup.set()
+
+    def _backoff(self, attempts: int) -> int:
+        delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        return int(random.uniform(delay / 2, delay)) + 1
+
+    async def _execute(self, job: OutboxJob):
+        handler = _handlers.get(job.operation)
+        async with self._semaphore:
+            try:
+                if handler is None:
+                    return False, f"нет обработчика для {job.operation}"
+                if await handler(job):
+                    return True, None
+                return False, "VPN API не выполнил запрос"
+            except Exception as e:
+                logging.error(f"Ошибка задания outbox {job.idempotency_key}: {e}")
+                return False, str(e)
+
+    async def process(self) -> int:
+        """Один проход по заданиям, время которых пришло; возвращает число обработанных"""
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute(DUE_SQL, (PENDING, now_ts(), self.batch_size))
+            jobs = [OutboxJob(*row) for row in await cursor.fetchall()]
+        if not jobs:
+            return 0
+
+        results = await asyncio.gather(*(self._execute(job) for job in jobs))
+
+        ts = now_ts()
+        finished = []
+        async with db_pool.transaction() as conn:
+            for job, (ok, error) in zip(jobs, results):
+                attempts = job.attempts + 1
+                if ok:
+                    await conn.execute(
+                        "UPDATE provisioning_outbox SET status = ?, attempts = ?, completed_ts = ?, last_error = NULL WHERE id = ?",
+                        (DONE, attempts, ts, job.id)
+                    )
+                    self.completed += 1
+                    finished.append((job, True))
+                elif attempts >= self.max_attempts:
+                    await conn.execute(
+                        "UPDATE provisioning_outbox SET status = ?, attempts = ?, completed_ts = ?, last_error = ? WHERE id = ?",
+                        (FAILED, attempts, ts, error, job.id)
+                    )
+                    self.failed += 1
+                    finished.append((job, False))
+                    logging.error(f"Задание outbox {job.idempotency_key} не выполнено за {attempts} попыток: {error}")
+                else:
+                    await conn.execute(
+                        "UPDATE provisioning_outbox SET attempts = ?, next_attempt_ts = ?, last_error = ? WHERE id = ?",
+                        (attempts, ts + self._backoff(attempts), error, job.id)
+                    )
+                    self.retried += 1
+
+        if _notifier is not None:
+            for job, ok in finished:
+                try:
+                    await _notifier(job, ok)
+                except Exception as e:
+                    logging.error(f"Ошибка уведомления по заданию outbox {job.idempotency_key}: {e}")
+        return len(jobs)
+
+    async def _run(self):
+        while True:
+            try:
+                # Полная пачка — возможно, в очереди есть ещё, не ждём интервал
+                if await self.process() >= self.batch_size:
+                    continue
+            except Exception as e:
+                logging.error(f"Ошибка обработки outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logging.info("Обработка outbox VPN-заданий запущена")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'completed': self.completed,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+
+_worker = None
+
+
+def get_worker() -> ProvisioningWorker:
+    global _worker
+    if _worker is None:
+        _worker = ProvisioningWorker()
+    return _worker
+
+
+def start_worker():
+    get_worker().start()
+
+
+async def stop_worker():
+    if _worker is not None:
+        await _worker.stop()
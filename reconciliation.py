@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+import db_pool
+import extend_coalescer
+import provisioning_outbox
+import subscription_cache
+import vpn_client
+import vpn_nodes
+from config import (
+    VPN_API_STATUS_PATH,
+    VPN_API_BATCH_STATUS_PATH,
+    RECONCILE_CHUNK_SIZE,
+    RECONCILE_CONCURRENCY,
+    RECONCILE_TOLERANCE_HOURS,
+    RECONCILE_INTERVAL_HOURS
+)
+from timestamps import now_ts
+
+__all__ = [
+    'DISCREPANCIES',
+    'CHUNK_SQL',
+    'Reconciler',
+    'get_reconciler',
+    'start_reconciler',
+    'stop_reconciler'
+]
+
+# Виды расхождений между users.expiry_ts и сроком конфига на сервере
+DISCREPANCIES = (
+    'ok',  # сроки совпадают с точностью до допуска
+    'server_behind',  # на сервере срок меньше — продлеваем
+    'server_ahead',  # на сервере срок больше — только в отчёт
+    'missing',  # сервер подтвердил, что конфига нет — выдаём новый через outbox
+    'errors'  # статус получить не удалось
+)
+
+# Очередная часть активных подписок после last_user_id. Унарный плюс не даёт
+# взять idx_users_subscribed_expiry: с ним SQLite пересортировывал бы всё
+# активное множество на каждую часть, а так идёт по первичному ключу.
+CHUNK_SQL = """SELECT user_id, expiry_ts, config, node_id FROM users
+                WHERE user_id > ? AND +subscribed = 1 AND +expiry_ts > ?
+                  AND config IS NOT NULL AND config != ''
+                ORDER BY user_id LIMIT ?"""
+
+
+class Reconciler:
+    """Сверка сроков активных подписок в БД и на VPN серверах.
+
+    Пользователи читаются частями по первичному ключу, в памяти только
+    текущая часть. Статусы конфигов запрашиваются у узлов параллельно
+    (пакетом, если на сервере есть пакетный метод). Отставшие конфиги
+    продлеваются через объединитель продлений. Конфиг открепляется и
+    выдаётся заново заданием outbox, только если сервер явно ответил, что
+    его нет; ошибки и непонятные ответы лишь попадают в отчёт. Без метода
+    статуса на сервере сверка не запускается.
+    """
+
+    def __init__(self, chunk_size: int = RECONCILE_CHUNK_SIZE, concurrency: int = RECONCILE_CONCURRENCY,
+                 tolerance_hours: int = RECONCILE_TOLERANCE_HOURS, interval_hours: float = RECONCILE_INTERVAL_HOURS):
+        self.chunk_size = max(1, chunk_size)
+        self.tolerance = tolerance_hours * 3600
+        self.interval = interval_hours * 3600
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._lock = asyncio.Lock()
+        self._run_task = None
+        self._task = None
+        # Отчёт последней (или текущей) сверки
+        self.report = None
+
+    @property
+    def in_progress(self) -> bool:
+        return self._lock.locked()
+
+    @property
+    def configured(self) -> bool:
+        """На VPN серверах есть метод статуса конфига"""
+        return bool(VPN_API_STATUS_PATH or VPN_API_BATCH_STATUS_PATH)
+
+    async def _status_one(self, client, node, config_id: str):
+        async with self._semaphore:
+            try:
+                return await client.config_status(node, config_id)
+            except Exception as e:
+                logging.warning(f"Сверка: нет статуса {config_id} на {node.node_id}: {e}")
+                return None
+
+    async def _fetch_statuses(self, client, node, config_ids: list) -> dict:
+        """{config_id: срок на сервере, 0 — сервер подтвердил, что нет, None — ошибка}"""
+        if VPN_API_BATCH_STATUS_PATH:
+            async with self._semaphore:
+                try:
+                    return await client.config_statuses(node, config_ids)
+                except Exception as e:
+                    if not VPN_API_STATUS_PATH:
+                        logging.warning(f"Сверка: пакетный статус на {node.node_id} не получен: {e}")
+                        return {}
+                    logging.warning(f"Сверка: пакетный статус на {node.node_id} не получен, запрашиваем по одному: {e}")
+        results = await asyncio.gather(*(self._status_one(client, node, config_id) for config_id in config_ids))
+        return dict(zip(config_ids, results))
+
+    async def _reconcile_chunk(self, rows, report: dict, repair: bool):
+        client = await vpn_client.get_client()
+        by_node = {}
+        for user_id, expiry_ts, config, node_id in rows:
+            by_node.setdefault(node_id, []).append((user_id, expiry_ts, config.strip('"\''), config))
+        nodes = {node_id: vpn_nodes.get_node(node_id) for node_id in by_node}
+        fetched = await asyncio.gather(*(
+            self._fetch_statuses(client, nodes[node_id], [item[2] for item in items])
+            for node_id, items in by_node.items()
+        ))
+
+        behind = []
+        missing = []
+        for (node_id, items), statuses in zip(by_node.items(), fetched):
+            for user_id, expiry_ts, config_id, raw_config in items:
+                server_ts = statuses.get(config_id)
+                if server_ts is None:
+                    kind = 'errors'
+                elif server_ts == 0:
+                    kind = 'missing'
+                    missing.append((user_id, raw_config, node_id))
+                elif server_ts < expiry_ts - self.tolerance:
+                    kind = 'server_behind'
+                    days = (expiry_ts - server_ts + 86399) // 86400
+                    behind.append((nodes[node_id], config_id, days))
+                elif server_ts > expiry_ts + self.tolerance:
+                    kind = 'server_ahead'
+                else:
+                    kind = 'ok'
+                report[kind] += 1
+        report['checked'] += len(rows)
+        if not repair:
+            return
+
+        if behind:
+            results = await asyncio.gather(*(
+                extend_coalescer.extend(node, config_id, days) for node, config_id, days in behind
+            ))
+            report['repaired'] += sum(1 for ok in results if ok)
+            report['repair_failed'] += sum(1 for ok in results if not ok)
+
+        if missing:
+            reissued = []
+            async with db_pool.transaction() as conn:
+                for user_id, raw_config, node_id in missing:
+                    cursor = await conn.execute(
+                        "UPDATE users SET config = '', node_id = NULL WHERE user_id = ? AND config = ?",
+                        (user_id, raw_config)
+                    )
+                    if not cursor.rowcount:
+                        continue  # конфиг сменился во время сверки
+                    await vpn_nodes.record_placement(conn, node_id, -1)
+                    await provisioning_outbox.enqueue(
+                        conn, f"reconcile:{user_id}:{raw_config}", provisioning_outbox.PROVISION, user_id
+                    )
+                    reissued.append(user_id)
+            for user_id in reissued:
+                subscription_cache.invalidate(user_id)
+            if reissued:
+                provisioning_outbox.get_worker().wakeup()
+            report['repaired'] += len(reissued)
+
+    async def reconcile(self, repair: bool = True):
+        """Полная сверка активных подписок; возвращает отчёт с числом расхождений по видам.
+
+        None — метод статуса не настроен, сверка не проводилась.
+        """
+        if not self.configured:
+            logging.warning("Сверка с VPN серверами пропущена: не задан VPN_API_STATUS_PATH")
+            return None
+        async with self._lock:
+            started = time.monotonic()
+            report = {kind: 0 for kind in DISCREPANCIES}
+            report.update(checked=0, repaired=0, repair_failed=0, started_ts=now_ts(),
+                          finished_ts=None, duration=None, repair=repair)
+            self.report = report
+
+            last_user_id = 0
+            active_since = now_ts()
+            while True:
+                async with db_pool.reader() as conn:
+                    cursor = await conn.execute(CHUNK_SQL, (last_user_id, active_since, self.chunk_size))
+                    rows = await cursor.fetchall()
+                if not rows:
+                    break
+                last_user_id = rows[-1][0]
+                await self._reconcile_chunk(rows, report, repair)
+
+            report['finished_ts'] = now_ts()
+            report['duration'] = round(time.monotonic() - started, 1)
+            counts = ', '.join(f"{kind}: {report[kind]}" for kind in DISCREPANCIES)
+            logging.info(f"Сверка с VPN серверами: проверено {report['checked']} ({counts}), "
+                         f"исправлено {report['repaired']}, за {report['duration']} с")
+            return report
+
+    def start_run(self, repair: bool = True) -> bool:
+        """Запускает сверку в фоне; False — сверка уже идёт или не настроена"""
+        if not self.configured or self.in_progress or (self._run_task and not self._run_task.done()):
+            return False
+        self._run_task = asyncio.create_task(self._run_once(repair))
+        return True
+
+    async def _run_once(self, repair: bool):
+        try:
+            await self.reconcile(repair)
+        except Exception as e:
+            logging.error(f"Ошибка сверки с VPN серверами: {e}", exc_info=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._run_once(True)
+
+    def start(self):
+        """Запускает сверку по расписанию (если интервал и метод статуса заданы)"""
+        if self.interval > 0 and not self.configured:
+            logging.warning("Сверка по расписанию не запущена: не задан VPN_API_STATUS_PATH")
+            return
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+            logging.info(f"Сверка с VPN серверами по расписанию: каждые {self.interval / 3600:g} ч")
+
+    async def stop(self):
+        for task in (self._task, self._run_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._run_task = None
+
+
+_reconciler = None
+
+
+def get_reconciler() -> Reconciler:
+    global _reconciler
+    if _reconciler is None:
+        _reconciler = Reconciler()
+    return _reconciler
+
+
+def start_reconciler():
+    get_reconciler().start()
+
+
+async def stop_reconciler():
+    if _reconciler is not None:
+        await _reconciler.stop()
@@ -0,0 +1,41 @@
+# Проверка планов горячих запросов (для CI и ручного запуска)
+# Без аргументов создаёт временную БД со свежей схемой, иначе проверяет указанный файл:
+#   python -m scripts.check_query_plans [путь_к_users.db]
+import asyncio
+import os
+import sys
+import tempfile
+import config
+
+async def check_query_plans(db_path: str) -> int:
+    """Создаёт схему и индексы в указанной БД и проверяет планы запросов"""
+    config.DB_PATH = db_path
+    import db_pool
+    from database import init_db, close_db
+    from db_indexes import check_query_plans as run_check, explain_query, hot_queries, QueryPlanError
+
+    await db_pool.init_pool(db_path)
+    try:
+        await init_db(check_plans=False)
+        async with db_pool.reader() as conn:
+            for name, sql, params in hot_queries():
+                plan = await explain_query(conn, sql, params)
+                print(f"{name}:")
+                for step in plan:
+                    print(f"    {step}")
+            try:
+                await run_check(conn)
+            except QueryPlanError as e:
+                print(f"\nОШИБКА: {e}")
+                return 1
+        print("\nВсе горячие запросы используют индексы")
+        return 0
+    finally:
+        await close_db()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'plan_check.db')
+    sys.exit(asyncio.run(check_query_plans(path)))
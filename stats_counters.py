@@ -0,0 +1,178 @@
+from datetime import datetime
+from timestamps import now_ts, day_start_ts
+
+__all__ = [
+    'STATS_SCHEMA',
+    'day_key',
+    'record_bot_user',
+    'forget_bot_user',
+    'record_payment',
+    'forget_payment',
+    'move_subscription',
+    'read_dashboard',
+    'rebuild_stats',
+    'ACTIVE_TODAY_SQL'
+]
+
+# Действующие подписки, которые заканчиваются сегодня
+ACTIVE_TODAY_SQL = "SELECT COUNT(*) FROM users WHERE subscribed = 1 AND expiry_ts > ? AND expiry_ts < ?"
+
+# Счётчики и дневные сводки для админ-панели. Все функции ниже принимают
+# соединение писателя и выполняются в той же транзакции, что и изменение
+# базовых таблиц, поэтому сводки не расходятся с данными при сбоях.
+STATS_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS stats_counters
+       (name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0)''',
+    # Новые пользователи и платежи по дням
+    '''CREATE TABLE IF NOT EXISTS stats_daily
+       (day TEXT PRIMARY KEY,
+        new_users INTEGER NOT NULL DEFAULT 0,
+        payments INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0)''',
+    # Сколько действующих (subscribed = 1) подписок заканчивается в каждый день
+    '''CREATE TABLE IF NOT EXISTS stats_expiry_daily
+       (day TEXT PRIMARY KEY,
+        subs INTEGER NOT NULL DEFAULT 0)'''
+]
+
+
+def day_key(ts: int) -> str:
+    """Ключ дня (локальная дата) для epoch-секунд"""
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+
+
+async def _bump_counter(conn, name: str, delta: int):
+    await conn.execute(
+        """INSERT INTO stats_counters (name, value) VALUES (?, ?)
+           ON CONFLICT(name) DO UPDATE SET value = value + excluded.value""",
+        (name, delta)
+    )
+
+
+async def _bump_daily(conn, ts: int, new_users: int = 0, payments: int = 0, revenue: float = 0):
+    await conn.execute(
+        """INSERT INTO stats_daily (day, new_users, payments, revenue) VALUES (?, ?, ?, ?)
+           ON CONFLICT(day) DO UPDATE SET
+               new_users = new_users + excluded.new_users,
+               payments = payments + excluded.payments,
+               revenue = revenue + excluded.revenue""",
+        (day_key(ts), new_users, payments, revenue)
+    )
+
+
+async def record_bot_user(conn, first_interaction_ts: int, count: int = 1):
+    """Учитывает новых пользователей бота"""
+    await _bump_counter(conn, 'total_users', count)
+    await _bump_daily(conn, first_interaction_ts, new_users=count)
+
+
+async def forget_bot_user(conn, first_interaction_ts):
+    """Убирает удалённого пользователя бота из счётчиков"""
+    await _bump_counter(conn, 'total_users', -1)
+    if first_interaction_ts:
+        await _bump_daily(conn, first_interaction_ts, new_users=-1)
+
+
+async def record_payment(conn, amount: float, payment_ts: int):
+    """Учитывает платёж в дневной сводке"""
+    await _bump_daily(conn, payment_ts, payments=1, revenue=amount or 0)
+
+
+async def forget_payment(conn, amount: float, payment_ts):
+    """Убирает удалённый платёж из дневной сводки"""
+    if payment_ts:
+        await _bump_daily(conn, payment_ts, payments=-1, revenue=-(amount or 0))
+
+
+async def move_subscription(conn, old_state, new_state):
+    """Переносит подписку между днями окончания.
+
+    old_state/new_state — (subscribed, expiry_ts) до и после изменения
+    или None, если строки в users нет.
+    """
+    old_day = day_key(old_state[1]) if old_state and old_state[0] and old_state[1] else None
+    new_day = day_key(new_state[1]) if new_state and new_state[0] and new_state[1] else None
+    if old_day == new_day:
+        return
+    for day, delta in ((old_day, -1), (new_day, 1)):
+        if day:
+            await conn.execute(
+                """INSERT INTO stats_expiry_daily (day, subs) VALUES (?, ?)
+                   ON CONFLICT(day) DO UPDATE SET subs = subs + excluded.subs""",
+                (day, delta)
+            )
+
+
+async def read_dashboard(conn) -> dict:
+    """Быстрая статистика для главного экрана админки (ограниченное число строк)"""
+    now = now_ts()
+    today = day_key(now)
+    tomorrow_ts = day_start_ts(-1)
+
+    cursor = await conn.execute("SELECT value FROM stats_counters WHERE name = 'total_users'")
+    row = await cursor.fetchone()
+    total_users = row[0] if row else 0
+
+    cursor = await conn.execute("SELECT new_users FROM stats_daily WHERE day = ?", (today,))
+    row = await cursor.fetchone()
+    new_today = row[0] if row else 0
+
+    # Доход за 30 дней: не более 31 строки сводки
+    cursor = await conn.execute(
+        "SELECT COALESCE(SUM(revenue), 0) FROM stats_daily WHERE day >= ?",
+        (day_key(day_start_ts(30)),)
+    )
+    monthly_revenue = (await cursor.fetchone())[0]
+
+    # Активные: все подписки, истекающие с завтрашнего дня, плюс сегодняшние,
+    # у которых время окончания ещё не наступило (узкий диапазон по индексу)
+    cursor = await conn.execute(
+        "SELECT COALESCE(SUM(subs), 0) FROM stats_expiry_daily WHERE day > ?",
+        (today,)
+    )
+    active_later = (await cursor.fetchone())[0]
+    cursor = await conn.execute(ACTIVE_TODAY_SQL, (now, tomorrow_ts))
+    active_today = (await cursor.fetchone())[0]
+
+    return {
+        'total_users': total_users,
+        'active_subs': active_later + active_today,
+        'monthly_revenue': monthly_revenue,
+        'new_today': new_today
+    }
+
+
+async def rebuild_stats(conn):
+    """Полностью пересобирает счётчики и сводки из базовых таблиц (исправление расхождений).
+
+    Изменения не коммитятся — это делает вызывающий код.
+    """
+    await conn.execute("DELETE FROM stats_counters")
+    await conn.execute("DELETE FROM stats_daily")
+    await conn.execute("DELETE FROM stats_expiry_daily")
+
+    await conn.execute(
+        "INSERT INTO stats_counters (name, value) SELECT 'total_users', COUNT(*) FROM bot_users"
+    )
+    await conn.execute(
+        """INSERT INTO stats_daily (day, new_users)
+           SELECT date(first_interaction_ts, 'unixepoch', 'localtime'), COUNT(*)
+           FROM bot_users WHERE first_interaction_ts IS NOT NULL
+           GROUP BY 1"""
+    )
+    await conn.execute(
+        """INSERT INTO stats_daily (day, payments, revenue)
+           SELECT date(payment_ts, 'unixepoch', 'localtime'), COUNT(*), COALESCE(SUM(amount), 0)
+           FROM payments WHERE payment_ts IS NOT NULL
+           GROUP BY 1
+           ON CONFLICT(day) DO UPDATE SET
+               payments = excluded.payments,
+               revenue = excluded.revenue"""
+    )
+    await conn.execute(
+        """INSERT INTO stats_expiry_daily (day, subs)
+           SELECT date(expiry_ts, 'unixepoch', 'localtime'), COUNT(*)
+           FROM users WHERE subscribed = 1 AND expiry_ts IS NOT NULL
+           GROUP BY 1"""
+    )
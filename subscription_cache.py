@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from config import SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL
+
+__all__ = [
+    'SubscriptionState',
+    'SubscriptionCache',
+    'MISSING',
+    'get',
+    'generation',
+    'put',
+    'invalidate',
+    'clear',
+    'stats'
+]
+
+
+@dataclass(frozen=True)
+class SubscriptionState:
+    """Состояние подписки пользователя из таблицы users"""
+    expiry_ts: int = None
+    config: str = None
+    subscribed: bool = False
+    expiry_date: str = None  # текст для отображения, как в БД
+    node_id: str = None  # VPN-узел, на котором выдан конфиг
+
+
+# Маркер «значения нет в кэше» (None означает «записи в users нет»)
+MISSING = object()
+
+
+class SubscriptionCache:
+    """LRU-кэш состояния подписок с ограниченным размером и временем жизни.
+
+    Кэш заполняется при чтении и сбрасывается после каждого изменения users.
+    Чтобы значение, прочитанное до изменения, не попало в кэш уже после сброса,
+    put() принимает поколение, полученное до чтения из БД: любой сброс его
+    увеличивает, и устаревшая запись отбрасывается.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        """Состояние из кэша, None если записи нет в users, MISSING если не закэшировано"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        state, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return state
+
+    def generation(self) -> int:
+        """Текущее поколение — запоминается перед чтением из БД"""
+        return self._generation
+
+    def put(self, user_id: int, state, generation: int):
+        """Кладёт прочитанное состояние, если с момента чтения не было сбросов"""
+        if generation != self._generation:
+            return
+        self._entries[user_id] = (state, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """Сбрасывает состояние пользователя после изменения в БД"""
+        self._generation += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Полностью очищает кэш"""
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+_cache = SubscriptionCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+
+
+def get(user_id: int):
+    return _cache.get(user_id)
+
+
+def generation() -> int:
+    return _cache.generation()
+
+
+def put(user_id: int, state, generation: int):
+    _cache.put(user_id, state, generation)
+
+
+def invalidate(user_id: int):
+    _cache.invalidate(user_id)
+
+
+def clear():
+    _cache.clear()
+
+
+def stats() -> dict:
+    return _cache.stats()
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+# Окружение задаётся до импорта config: тесты не должны трогать users.db
+# и настоящие API. VPN сервер и ЮKassa подменяются локальными заглушками.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+VPN_STUB_PORT = 18766
+YOOKASSA_STUB_PORT = 18767
+
+os.environ.setdefault('BOT_TOKEN', '1:test')
+os.environ['VPN_NODES_JSON'] = json.dumps([{
+    'node_id': 'nl',
+    'api_url': f'http://127.0.0.1:{VPN_STUB_PORT}',
+    'api_key': 'test',
+    'server': 'test',
+    'host': '127.0.0.1',
+    'capacity': 1000000
+}])
+os.environ['VPN_API_STATUS_PATH'] = '/configstatus'
+os.environ['YOOKASSA_API_URL'] = f'http://127.0.0.1:{YOOKASSA_STUB_PORT}/v3'
+
+import config  # noqa: E402
+
+_tmp = tempfile.mkdtemp(prefix='bot-tests-')
+config.DB_PATH = os.path.join(_tmp, 'test.db')
+
+import pytest  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+
+class FakeYooKassa:
+    """Локальная заглушка API ЮKassa: создание, чтение и список платежей"""
+
+    def __init__(self, create_delay: float = 0):
+        self.create_delay = create_delay
+        self.payments = {}
+        self.calls = {'create': 0, 'find': 0, 'list': 0}
+        self._runner = None
+
+    def set_status(self, payment_id: str, status: str):
+        self.payments[payment_id]['status'] = status
+        self.payments[payment_id]['paid'] = status == 'succeeded'
+
+    async def create(self, request):
+        self.calls['create'] += 1
+        data = await request.json()
+        if self.create_delay:
+            await asyncio.sleep(self.create_delay)
+        payment_id = f"pay-{len(self.payments) + 1}"
+        self.payments[payment_id] = {
+            'id': payment_id,
+            'status': 'pending',
+            'paid': False,
+            'created_at': '2026-01-01T00:00:00.000Z',
+            'confirmation': {'confirmation_url': f"https://pay.test/{payment_id}"},
+            'metadata': data.get('metadata', {})
+        }
+        return web.json_response(self.payments[payment_id])
+
+    async def find(self, request):
+        self.calls['find'] += 1
+        payment = self.payments.get(request.match_info['payment_id'])
+        if payment is None:
+            return web.json_response({'type': 'error', 'code': 'not_found'}, status=404)
+        return web.json_response(payment)
+
+    async def list(self, request):
+        self.calls['list'] += 1
+        return web.json_response({'type': 'list', 'items': list(self.payments.values())})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/v3/payments', self.create)
+        app.router.add_get('/v3/payments', self.list)
+        app.router.add_get('/v3/payments/{payment_id}', self.find)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', YOOKASSA_STUB_PORT).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+def run_db():
+    """Запускает сценарий (async-функцию без аргументов) на чистой временной БД"""
+    import database
+    import vpn_client
+    import yookassa_gateway
+
+    def run(scenario):
+        async def main():
+            await database.init_db()
+            try:
+                return await scenario()
+            finally:
+                await vpn_client.close_client()
+                await yookassa_gateway.close_gateway()
+                await database.close_db()
+        try:
+            return asyncio.run(main())
+        finally:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(config.DB_PATH + suffix):
+                    os.remove(config.DB_PATH + suffix)
+    return run
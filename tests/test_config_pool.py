@@ -0,0 +1,65 @@
+from aiohttp import web
+import config_pool
+import database
+import db_pool
+import provisioning_outbox
+import vpn_nodes
+from conftest import VPN_STUB_PORT
+
+
+async def _serve_giveconfig():
+    issued = []
+
+    async def giveconfig(request):
+        issued.append((await request.json())['time'])
+        return web.Response(text=f"cfg{len(issued)}")
+
+    app = web.Application()
+    app.router.add_post('/giveconfig', giveconfig)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', VPN_STUB_PORT).start()
+    return runner, issued
+
+
+def test_pool_counts_toward_capacity_and_activation_extends_by_shortfall(run_db):
+    async def scenario():
+        runner, issued = await _serve_giveconfig()
+        try:
+            node = vpn_nodes.get_node('nl')
+            node.capacity = 4
+            refiller = config_pool.ConfigPoolRefiller(low=3, high=10)
+            await refiller.refill()
+        finally:
+            await runner.cleanup()
+
+        # Пул занимает места на узле и не выходит за его ёмкость
+        assert len(issued) == 4
+        assert node.user_count == 4 and not node.available
+        async with db_pool.writer() as conn:
+            await vpn_nodes.sync_nodes(conn)
+        node = vpn_nodes.get_node('nl')
+        assert node.user_count == 4
+
+        # Узел заполнен пулом, но выдача из пула места не требует
+        assert await database.add_payment(7, 1, 'txn-1') == database.PAYMENT_APPLIED
+        # Конфиг перешёл из пула пользователю — занятых мест столько же
+        assert vpn_nodes.get_node('nl').user_count == 4
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute("SELECT config FROM users WHERE user_id = 7")
+            (user_config,), = await cursor.fetchall()
+            cursor = await conn.execute("SELECT COUNT(*) FROM vpn_config_pool")
+            (pooled,), = await cursor.fetchall()
+        assert user_config.startswith('cfg') and pooled == 3
+
+        async with db_pool.reader() as conn:
+            cursor = await conn.execute(
+                "SELECT days FROM provisioning_outbox WHERE user_id = 7 AND operation = ?",
+                (provisioning_outbox.EXTEND,)
+            )
+            (days,), = await cursor.fetchall()
+        # Срок пула на сервере уже идёт: досылается только недостающее до оплаченного
+        shortfall = 30 - config_pool.VPN_CONFIG_POOL_DAYS
+        assert shortfall <= days <= shortfall + 1
+
+    run_db(scenario)
@@ -0,0 +1,96 @@
+import asyncio
+from aiohttp import web
+import extend_coalescer
+import vpn_client
+import vpn_nodes
+from circuit_breaker import CircuitOpenError
+from conftest import VPN_STUB_PORT
+
+
+async def _serve(batch_status: int, calls: dict):
+    """Заглушка VPN сервера: пакетное продление применяется, но отвечает batch_status"""
+
+    async def batch(request):
+        calls['batch'] += 1
+        return web.Response(status=batch_status, text='error')
+
+    async def extend(request):
+        calls['extend'] += 1
+        if 'keys' in calls:
+            calls['keys'].append(request.headers.get('Idempotency-Key'))
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_post('/batchextend', batch)
+    app.router.add_post('/extendconfig', extend)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', VPN_STUB_PORT).start()
+    return runner
+
+
+async def _extend_two(coalescer) -> list:
+    node = vpn_nodes.get_node('nl')
+    return await asyncio.gather(coalescer.extend(node, 'a', 30), coalescer.extend(node, 'b', 30))
+
+
+def test_failed_batch_is_not_resent_item_by_item():
+    calls = {'batch': 0, 'extend': 0}
+
+    async def scenario():
+        runner = await _serve(500, calls)
+        try:
+            coalescer = extend_coalescer.ExtendCoalescer(window_ms=10, batch_path='/batchextend')
+            assert await _extend_two(coalescer) == [False, False]
+        finally:
+            await vpn_client.close_client()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    # Пакет мог примениться — повтор по одному продлил бы конфиги дважды
+    assert calls == {'batch': 1, 'extend': 0}
+
+
+def test_unsent_batch_falls_back_to_single_extends(monkeypatch):
+    calls = {'batch': 0, 'extend': 0}
+    request = vpn_client.VPNClient.request
+
+    async def refuse_batch(self, node, operation, path, payload, idempotency_key=None):
+        if path == '/batchextend':
+            raise CircuitOpenError("узел отключён")
+        return await request(self, node, operation, path, payload, idempotency_key)
+
+    monkeypatch.setattr(vpn_client.VPNClient, 'request', refuse_batch)
+
+    async def scenario():
+        runner = await _serve(200, calls)
+        try:
+            coalescer = extend_coalescer.ExtendCoalescer(window_ms=10, batch_path='/batchextend')
+            assert await _extend_two(coalescer) == [True, True]
+        finally:
+            await vpn_client.close_client()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    assert calls == {'batch': 0, 'extend': 2}
+
+
+def test_keyed_extends_are_sent_singly_with_their_key():
+    calls = {'batch': 0, 'extend': 0, 'keys': []}
+
+    async def scenario():
+        runner = await _serve(200, calls)
+        try:
+            coalescer = extend_coalescer.ExtendCoalescer(window_ms=10, batch_path='/batchextend')
+            node = vpn_nodes.get_node('nl')
+            assert await asyncio.gather(
+                coalescer.extend(node, 'a', 30, 'extend:1'),
+                coalescer.extend(node, 'a', 30, 'extend:2')
+            ) == [True, True]
+        finally:
+            await vpn_client.close_client()
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    # Задания outbox не складываются и не уходят пакетом: повтор узнаётся по ключу
+    assert calls['batch'] == 0 and sorted(calls['keys']) == ['extend:1', 'extend:2']
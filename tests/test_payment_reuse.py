@@ -0,0 +1,55 @@
+import asyncio
+import db_pool
+import payment
+from conftest import FakeYooKassa
+
+
+async def _message_ids() -> dict:
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT payment_id, message_id FROM pending_payments")
+        return dict(await cursor.fetchall())
+
+
+def test_concurrent_taps_share_payment_and_move_button(run_db):
+    async def scenario():
+        async with FakeYooKassa(create_delay=0.1) as yookassa:
+            first, second = await asyncio.gather(
+                payment.create_payment('1', 11, 11, 100),
+                payment.create_payment('1', 11, 11, 101)
+            )
+            assert first['payment_id'] == second['payment_id']
+            assert yookassa.calls['create'] == 1
+            # Кнопка оплаты — в сообщении того нажатия, что дождалось последним
+            assert await _message_ids() == {first['payment_id']: 101}
+
+    run_db(scenario)
+
+
+def test_reuse_touches_db_only_when_message_changes(run_db, monkeypatch):
+    async def scenario():
+        async with FakeYooKassa() as yookassa:
+            created = await payment.create_payment('3', 12, 12, 200)
+
+            writes = []
+            transaction = db_pool.transaction
+
+            def counting_transaction():
+                writes.append(1)
+                return transaction()
+
+            monkeypatch.setattr(db_pool, 'transaction', counting_transaction)
+            assert await payment.create_payment('3', 12, 12, 200) == created
+            assert writes == []
+            assert await payment.create_payment('3', 12, 12, 201) == created
+            assert writes == [1]
+            monkeypatch.undo()
+
+            assert await _message_ids() == {created['payment_id']: 201}
+            assert yookassa.calls['create'] == 1
+
+            # Отменённый платёж больше не отдаётся
+            await payment.cancel_payment(created['payment_id'])
+            again = await payment.create_payment('3', 12, 12, 201)
+            assert again['payment_id'] != created['payment_id']
+
+    run_db(scenario)
@@ -0,0 +1,68 @@
+import importlib
+import config
+import db_pool
+import pending_payments
+from timestamps import now_ts
+from yookassa_gateway import GatewayPayment
+
+
+class FakeGateway:
+    """Отвечает заданными статусами платежей"""
+
+    def __init__(self, statuses: dict):
+        self.statuses = statuses
+
+    async def find_payment(self, payment_id: str) -> GatewayPayment:
+        return GatewayPayment(id=payment_id, status=self.statuses[payment_id])
+
+    async def list_payments(self, created_since_ts: int, cursor: str = None, limit: int = 100):
+        return [GatewayPayment(id=pid, status=status) for pid, status in self.statuses.items()], None
+
+
+async def _add_expired(payment_ids):
+    created = now_ts() - pending_payments._PENDING_TTL - 60
+    async with db_pool.transaction() as conn:
+        for payment_id in payment_ids:
+            await pending_payments.add_pending(conn, payment_id, 1, '1', 'https://pay')
+        await conn.execute("UPDATE pending_payments SET created_ts = ?, next_check_ts = ?", (created, created))
+
+
+async def _pending_ids() -> set:
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT payment_id FROM pending_payments")
+        return {row[0] for row in await cursor.fetchall()}
+
+
+def test_expired_paid_payment_is_kept_until_settled(run_db, monkeypatch):
+    gateway = FakeGateway({'unpaid': 'pending', 'paid': 'succeeded', 'held': 'waiting_for_capture'})
+
+    async def get_gateway():
+        return gateway
+
+    async def failing_handler(payment):
+        return False  # зачисление не прошло
+
+    monkeypatch.setattr(pending_payments, 'get_gateway', get_gateway)
+    monkeypatch.setattr(pending_payments, '_handler', failing_handler)
+
+    async def scenario():
+        await _add_expired(['unpaid', 'paid', 'held'])
+        poller = pending_payments.PaymentPoller(list_threshold=10)
+        assert await poller.process() == 3
+        # Брошен только неоплаченный платёж
+        assert await _pending_ids() == {'paid', 'held'}
+        assert poller.stats()['expired'] == 1
+        assert poller.stats()['stuck'] == 2
+
+    run_db(scenario)
+
+
+def test_empty_schedule_falls_back_to_default(monkeypatch):
+    monkeypatch.setattr(config, 'PAYMENT_POLL_SCHEDULE', [])
+    try:
+        module = importlib.reload(pending_payments)
+        assert module._PENDING_TTL > 0
+        assert module._interval(0) is not None
+    finally:
+        monkeypatch.undo()
+        importlib.reload(pending_payments)
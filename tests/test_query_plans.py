@@ -0,0 +1,30 @@
+import db_pool
+from db_indexes import check_query_plans, explain_query, find_full_scans, hot_queries
+
+
+def test_find_full_scans_flags_scan_and_temp_sort():
+    plan = [
+        'SEARCH users USING INDEX idx_users_subscribed_expiry (subscribed=? AND expiry_ts>?)',
+        'USE TEMP B-TREE FOR ORDER BY',
+        'SCAN payments',
+        'SCAN bot_users USING COVERING INDEX idx_bot_users_first_interaction'
+    ]
+    assert find_full_scans(plan) == ['USE TEMP B-TREE FOR ORDER BY', 'SCAN payments']
+
+
+def test_hot_queries_use_indexes(run_db):
+    async def scenario():
+        async with db_pool.reader() as conn:
+            plans = await check_query_plans(conn)
+            assert set(plans) == {name for name, _, _ in hot_queries()}
+
+            # Прежний запрос сверки без унарного плюса пересортировывал активных
+            plan = await explain_query(
+                conn,
+                "SELECT user_id FROM users WHERE user_id > ? AND subscribed = 1 AND expiry_ts > ? "
+                "ORDER BY user_id LIMIT ?",
+                (0, 0, 500)
+            )
+            assert find_full_scans(plan)
+
+    run_db(scenario)
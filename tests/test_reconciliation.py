@@ -0,0 +1,140 @@
+from aiohttp import web
+import db_pool
+import provisioning_outbox
+import reconciliation
+from conftest import VPN_STUB_PORT
+from db_indexes import explain_query
+from timestamps import now_ts
+
+DAY = 86400
+
+
+class StubVPNServer:
+    """Заглушка VPN сервера: метод статуса и продление конфигов.
+
+    Для uid из deleted сервер подтверждает удаление ({"expiry": null}),
+    для uid из unknown отвечает 404, как сервер без метода статуса.
+    """
+
+    def __init__(self):
+        self.expiry = {}
+        self.deleted = set()
+        self.unknown = set()
+        self.calls = {'status': 0, 'extend': 0}
+        self._runner = None
+
+    async def status(self, request):
+        self.calls['status'] += 1
+        uid = (await request.json())['uid']
+        if uid in self.unknown:
+            return web.Response(status=404)
+        return web.json_response({'expiry': None if uid in self.deleted else self.expiry[uid]})
+
+    async def extend(self, request):
+        self.calls['extend'] += 1
+        data = await request.json()
+        self.expiry[data['uid']] += data['time'] * DAY
+        return web.Response(text='ok')
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_post('/configstatus', self.status)
+        app.router.add_post('/extendconfig', self.extend)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', VPN_STUB_PORT).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
+
+
+async def _add_users(rows):
+    async with db_pool.writer() as conn:
+        await conn.executemany(
+            "INSERT INTO users (user_id, subscribed, expiry_ts, config, node_id) VALUES (?, 1, ?, ?, 'nl')",
+            rows
+        )
+        await conn.commit()
+
+
+async def _config(user_id: int) -> str:
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT config FROM users WHERE user_id = ?", (user_id,))
+        return (await cursor.fetchone())[0]
+
+
+def test_reconcile_reports_and_repairs(run_db):
+    users = 2000
+    now = now_ts()
+
+    async def scenario():
+        async with StubVPNServer() as server:
+            rows = []
+            for user_id in range(1, users + 1):
+                expiry = now + 10 * DAY
+                config_id = f"c{user_id}"
+                kind = user_id % 10
+                if kind == 1:
+                    server.expiry[config_id] = expiry - 5 * DAY  # отстаёт
+                elif kind == 2:
+                    server.expiry[config_id] = expiry + 5 * DAY  # впереди
+                elif kind == 3:
+                    server.deleted.add(config_id)
+                elif kind == 4:
+                    server.unknown.add(config_id)
+                else:
+                    server.expiry[config_id] = expiry + 60
+                rows.append((user_id, expiry, config_id))
+            await _add_users(rows)
+
+            reconciler = reconciliation.Reconciler(chunk_size=300, concurrency=20)
+            report = await reconciler.reconcile()
+            assert report['checked'] == users
+            assert report['server_behind'] == users // 10
+            assert report['server_ahead'] == users // 10
+            assert report['missing'] == users // 10
+            assert report['errors'] == users // 10
+            assert report['ok'] == users * 6 // 10
+            assert report['repair_failed'] == 0
+            assert server.calls['status'] == users
+
+            # 404 — не подтверждение удаления: конфиг остаётся за пользователем
+            assert await _config(4) == 'c4'
+            # Подтверждённо удалённый конфиг откреплён и выдаётся заново
+            assert await _config(3) == ''
+            async with db_pool.reader() as conn:
+                cursor = await conn.execute(
+                    "SELECT COUNT(*) FROM provisioning_outbox WHERE operation = ?",
+                    (provisioning_outbox.PROVISION,)
+                )
+                assert (await cursor.fetchone())[0] == users // 10
+
+            # Отставшие конфиги продлены — повторная сверка без исправлений их не находит
+            report = await reconciler.reconcile(repair=False)
+            assert report['server_behind'] == 0
+            assert report['missing'] == 0
+
+    run_db(scenario)
+
+
+def test_reconcile_chunk_walks_primary_key(run_db):
+    async def scenario():
+        async with db_pool.reader() as conn:
+            plan = await explain_query(conn, reconciliation.CHUNK_SQL, (0, 0, 500))
+        assert plan == ['SEARCH users USING INTEGER PRIMARY KEY (rowid>?)']
+
+    run_db(scenario)
+
+
+def test_reconcile_requires_status_method(run_db, monkeypatch):
+    monkeypatch.setattr(reconciliation, 'VPN_API_STATUS_PATH', '')
+    monkeypatch.setattr(reconciliation, 'VPN_API_BATCH_STATUS_PATH', '')
+
+    async def scenario():
+        reconciler = reconciliation.Reconciler()
+        assert not reconciler.configured
+        assert await reconciler.reconcile() is None
+        assert not reconciler.start_run()
+
+    run_db(scenario)
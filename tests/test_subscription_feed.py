@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+import db_pool
+import links
+import miniapp
+from timestamps import now_ts
+
+
+def test_feed_revalidates_by_subscription_version(run_db, monkeypatch):
+    node_reads = []
+    fetch_node = miniapp.fetch_node
+
+    def counting_fetch_node(node_id):
+        node_reads.append(node_id)
+        return fetch_node(node_id)
+
+    monkeypatch.setattr(miniapp, 'fetch_node', counting_fetch_node)
+    monkeypatch.setattr(miniapp, 'feed_cache', miniapp.FeedCache(node_ttl=3600))
+
+    async def set_user(expiry_ts: int):
+        async with db_pool.writer() as conn:
+            await conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, subscribed, expiry_ts, config, node_id) VALUES (31, 1, ?, 'cfg31', 'nl')",
+                (expiry_ts,)
+            )
+            await conn.commit()
+
+    async def scenario():
+        client = miniapp.app.test_client()
+        url = f"/sub/{links.subscription_token(31)}"
+        await set_user(now_ts() + 86400)
+
+        first = client.get(url)
+        assert first.status_code == 200
+        etag = first.headers['ETag']
+
+        # Версия не изменилась — 304 без пересборки и без чтения узла
+        with ThreadPoolExecutor(8) as pool:
+            statuses = list(pool.map(lambda _: client.get(url, headers={'If-None-Match': etag}).status_code,
+                                     range(32)))
+        assert statuses == [304] * 32
+        assert node_reads == ['nl']
+        assert miniapp.feed_cache.misses == 1 and miniapp.feed_cache.hits == 32
+
+        # Продление меняет версию, а с ней ETag и срок в заголовке
+        await set_user(now_ts() + 2 * 86400)
+        renewed = client.get(url, headers={'If-None-Match': etag})
+        assert renewed.status_code == 200
+        assert renewed.headers['ETag'] != etag
+
+        # Подписка истекла — клиент получает 410, а не старый ответ
+        await set_user(now_ts() - 60)
+        assert client.get(url).status_code == 410
+
+    run_db(scenario)
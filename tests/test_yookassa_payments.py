@@ -0,0 +1,123 @@
+import aiohttp
+import db_pool
+import payment
+import pending_payments
+from conftest import FakeYooKassa
+from webhooks import WebhookServer
+
+WEBHOOK_PORT = 18768
+WEBHOOK_URL = f"http://127.0.0.1:{WEBHOOK_PORT}/yookassa/webhook"
+
+
+class FakeBot:
+    """Запоминает сообщения вместо отправки в Telegram"""
+
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append((chat_id, message_id))
+
+
+async def _notify(event: str, payment_id: str, status: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(WEBHOOK_URL, json={
+            'type': 'notification',
+            'event': event,
+            'object': {'id': payment_id, 'status': status}
+        }) as resp:
+            return resp.status
+
+
+async def _expiry_ts(user_id: int):
+    async with db_pool.reader() as conn:
+        cursor = await conn.execute("SELECT expiry_ts FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def _is_pending(payment_id: str) -> bool:
+    async with db_pool.reader() as conn:
+        return await pending_payments.get_pending(conn, payment_id) is not None
+
+
+def test_webhook_activates_payment_verified_by_api(run_db):
+    bot = FakeBot()
+
+    async def scenario():
+        async with FakeYooKassa() as yookassa:
+            server = WebhookServer(bot, host='127.0.0.1', port=WEBHOOK_PORT, allowed_ips=['127.0.0.1'])
+            await server.start()
+            try:
+                created = await payment.create_payment('1', 21, 21, 500)
+                payment_id = created['payment_id']
+
+                # Тело уведомления расходится с API — подписка не продлевается
+                assert await _notify('payment.succeeded', payment_id, 'succeeded') == 200
+                assert await _expiry_ts(21) is None and await _is_pending(payment_id)
+
+                yookassa.set_status(payment_id, 'succeeded')
+                assert await _notify('payment.succeeded', payment_id, 'succeeded') == 200
+                assert await _expiry_ts(21) is not None
+                assert not await _is_pending(payment_id)
+                assert bot.deleted == [(21, 500)] and len(bot.sent) == 1
+
+                # Повторная доставка не продлевает и не пишет второй раз
+                expiry_ts = await _expiry_ts(21)
+                assert await _notify('payment.succeeded', payment_id, 'succeeded') == 200
+                assert await _expiry_ts(21) == expiry_ts and len(bot.sent) == 1
+                assert server.stats()['rejected'] == 1
+            finally:
+                await server.stop()
+
+    run_db(scenario)
+
+
+def test_webhook_rejects_unknown_address(run_db):
+    async def scenario():
+        async with FakeYooKassa():
+            server = WebhookServer(FakeBot(), host='127.0.0.1', port=WEBHOOK_PORT, allowed_ips=['185.71.76.0/27'])
+            await server.start()
+            try:
+                created = await payment.create_payment('1', 22, 22, 600)
+                assert await _notify('payment.succeeded', created['payment_id'], 'succeeded') == 403
+                assert await _is_pending(created['payment_id'])
+            finally:
+                await server.stop()
+
+    run_db(scenario)
+
+
+def test_poll_fallback_settles_paid_and_canceled_payments(run_db, monkeypatch):
+    bot = FakeBot()
+
+    async def settle(found):
+        return await payment.settle_payment(found, bot)
+
+    monkeypatch.setattr(pending_payments, '_handler', settle)
+
+    async def scenario():
+        async with FakeYooKassa() as yookassa:
+            paid = (await payment.create_payment('1', 23, 23, 700))['payment_id']
+            canceled = (await payment.create_payment('3', 23, 23, 701))['payment_id']
+            waiting = (await payment.create_payment('6', 23, 23, 702))['payment_id']
+            yookassa.set_status(paid, 'succeeded')
+            yookassa.set_status(canceled, 'canceled')
+            async with db_pool.transaction() as conn:
+                await conn.execute("UPDATE pending_payments SET next_check_ts = 0")
+
+            poller = pending_payments.PaymentPoller(list_threshold=2)
+            assert await poller.process() == 3
+            # Три платежа в пачке — статусы одним запросом списка
+            assert yookassa.calls['list'] == 1 and yookassa.calls['find'] == 0
+
+            assert await _expiry_ts(23) is not None and len(bot.sent) == 1
+            assert not await _is_pending(paid) and not await _is_pending(canceled)
+            assert await _is_pending(waiting)
+            assert poller.stats()['resolved'] == 2
+
+    run_db(scenario)
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+__all__ = [
+    'DISPLAY_FORMAT',
+    'LEGACY_FORMATS',
+    'parse_date',
+    'to_ts',
+    'parse_ts',
+    'now_ts',
+    'day_start_ts',
+    'format_ts'
+]
+
+# Формат, в котором даты показываются пользователям и пишутся в текстовые колонки
+DISPLAY_FORMAT = '%d.%m.%Y %H:%M'
+
+# Форматы, которые исторически встречаются в текстовых колонках БД
+LEGACY_FORMATS = ('%d.%m.%Y %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_date(value: str):
+    """Разбирает дату из текстовой колонки, возвращает datetime или None"""
+    if not value:
+        return None
+    for fmt in LEGACY_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def to_ts(dt: datetime) -> int:
+    """Переводит локальное время в epoch-секунды"""
+    return int(dt.timestamp())
+
+
+def parse_ts(value: str):
+    """Разбирает текстовую дату сразу в epoch-секунды (None, если не удалось)"""
+    dt = parse_date(value)
+    return to_ts(dt) if dt else None
+
+
+def now_ts() -> int:
+    """Текущее время в epoch-секундах"""
+    return to_ts(datetime.now())
+
+
+def day_start_ts(days_ago: int = 0) -> int:
+    """Начало локальных суток (сегодня или days_ago дней назад) в epoch-секундах"""
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return to_ts(start - timedelta(days=days_ago))
+
+
+def format_ts(ts) -> str:
+    """Форматирует epoch-секунды для отображения"""
+    if ts is None:
+        return ''
+    return datetime.fromtimestamp(ts).strftime(DISPLAY_FORMAT)
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import random
+import aiohttp
+from circuit_breaker import CircuitOpenError, get_breaker, HALF_OPEN
+from config import (
+    VPN_API_POOL_SIZE,
+    VPN_API_POOL_PER_HOST,
+    VPN_API_KEEPALIVE,
+    VPN_API_DNS_TTL,
+    VPN_API_CONNECT_TIMEOUT,
+    VPN_API_TIMEOUTS,
+    VPN_API_RETRIES,
+    VPN_API_BACKOFF_BASE,
+    VPN_API_BACKOFF_MAX,
+    VPN_API_HEDGE_AFTER_MS,
+    VPN_API_REVOKE_PATH,
+    VPN_API_STATUS_PATH,
+    VPN_API_BATCH_STATUS_PATH
+)
+
+__all__ = [
+    'IDEMPOTENT_OPERATIONS',
+    'NOT_SENT_ERRORS',
+    'VPNClient',
+    'start_client',
+    'close_client',
+    'get_client'
+]
+
+# Операции, которые можно безопасно повторять и дублировать: повторный запрос
+# не меняет результат. giveconfig и extendconfig повторяются, только если
+# соединение не установилось и запрос точно не дошёл до сервера.
+IDEMPOTENT_OPERATIONS = {'status', 'revoke'}
+
+# Ошибки, при которых запрос не был отправлен
+NOT_SENT_ERRORS = (aiohttp.ClientConnectorError, CircuitOpenError)
+
+
+class VPNClient:
+    """Клиент VPN API с одной долгоживущей сессией aiohttp на все узлы.
+
+    Соединения переиспользуются (keep-alive), адреса узлов кэшируются,
+    у каждой операции свой полный таймаут. Каждый вызов получает узел
+    (vpn_nodes.VPNNode), к API которого он обращается.
+
+    Запросы к узлу идут через его автомат отключения: к отключённому узлу
+    запрос сразу завершается CircuitOpenError. Ошибки повторяются с
+    экспоненциальной паузой и случайным разбросом, идемпотентные операции
+    при медленном ответе могут дублироваться (hedging).
+    """
+
+    def __init__(self, timeouts: dict = None, retries: int = VPN_API_RETRIES,
+                 hedge_after_ms: int = VPN_API_HEDGE_AFTER_MS):
+        self.timeouts = {**VPN_API_TIMEOUTS, **(timeouts or {})}
+        self.retries = max(0, retries)
+        self.hedge_after = hedge_after_ms / 1000 if hedge_after_ms > 0 else None
+        self._session = None
+        # Метрики
+        self.retried = 0
+        self.hedged = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def start(self):
+        """Создаёт сессию и пул соединений"""
+        if not self.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=VPN_API_POOL_SIZE,
+            limit_per_host=VPN_API_POOL_PER_HOST,
+            keepalive_timeout=VPN_API_KEEPALIVE,
+            use_dns_cache=True,
+            ttl_dns_cache=VPN_API_DNS_TTL
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        logging.info(f"VPN API клиент запущен (до {VPN_API_POOL_SIZE} соединений)")
+
+    async def close(self):
+        """Закрывает сессию и все соединения"""
+        if self.closed:
+            return
+        await self._session.close()
+        self._session = None
+        # Даём транспортам закрыться до остановки цикла событий
+        await asyncio.sleep(0)
+        logging.info("VPN API клиент остановлен")
+
+    def _timeout(self, operation: str) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=self.timeouts.get(operation, 10),
+            sock_connect=VPN_API_CONNECT_TIMEOUT
+        )
+
+    async def _attempt(self, node, operation: str, path: str, payload: dict, headers: dict):
+        """Одна попытка через автомат узла; 5xx и сетевые ошибки считаются отказом узла"""
+        breaker = get_breaker(node.node_id)
+        if not breaker.allow():
+            raise CircuitOpenError(f"VPN-узел {node.node_id} временно отключён")
+        try:
+            async with self._session.post(
+                f"{node.api_url.rstrip('/')}{path}",
+                json=payload,
+                headers=headers,
+                timeout=self._timeout(operation)
+            ) as resp:
+                status, body = resp.status, await resp.text()
+        except asyncio.CancelledError:
+            # Отменённый дубль не должен занимать пробный запрос half-open
+            if breaker.state == HALF_OPEN:
+                breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return status, body
+
+    async def _hedged(self, node, operation: str, path: str, payload: dict, headers: dict):
+        """Если ответа нет дольше hedge_after, отправляет второй такой же запрос и берёт первый успешный"""
+        first = asyncio.create_task(self._attempt(node, operation, path, payload, headers))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        self.hedged += 1
+        tasks = {first, asyncio.create_task(self._attempt(node, operation, path, payload, headers))}
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная пауза с полным случайным разбросом"""
+        return random.uniform(0, min(VPN_API_BACKOFF_MAX, VPN_API_BACKOFF_BASE * 2 ** attempt))
+
+    async def request(self, node, operation: str, path: str, payload: dict, idempotency_key: str = None):
+        """POST к API узла с повторами, возвращает (статус, текст ответа).
+
+        idempotency_key передаётся в заголовке Idempotency-Key, чтобы сервер
+        мог распознать повтор уже выполненного запроса.
+        """
+        if self.closed:
+            await self.start()
+        headers = {"x-api-key": node.api_key}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        idempotent = operation in IDEMPOTENT_OPERATIONS
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                if idempotent and self.hedge_after:
+                    status, body = await self._hedged(node, operation, path, payload, headers)
+                else:
+                    status, body = await self._attempt(node, operation, path, payload, headers)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if last or not (idempotent or isinstance(e, NOT_SENT_ERRORS)):
+                    raise
+                logging.warning(f"VPN API {node.node_id} {operation}: {e!r}, повтор {attempt + 1}")
+            else:
+                if status < 500 or not idempotent or last:
+                    return status, body
+                logging.warning(f"VPN API {node.node_id} {operation}: статус {status}, повтор {attempt + 1}")
+            self.retried += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def give_config(self, node, user_id: int, days: int, idempotency_key: str = None):
+        """Выдаёт новый конфиг на days дней, возвращает его идентификатор или None"""
+        status, body = await self.request(node, 'giveconfig', '/giveconfig', {
+            "time": days,
+            "id": str(user_id),
+            "server": node.server
+        }, idempotency_key=idempotency_key)
+        if status == 200:
+            return body
+        logging.error(f"Ошибка VPN сервера {node.node_id}: {status}")
+        return None
+
+    async def extend_config(self, node, config_id: str, days: int, idempotency_key: str = None) -> bool:
+        """Продлевает конфиг на days дней"""
+        status, body = await self.request(node, 'extendconfig', '/extendconfig', {
+            "time": days,
+            "uid": config_id,
+            "server": node.server
+        }, idempotency_key=idempotency_key)
+        if status != 200:
+            logging.error(f"Ошибка продления на {node.node_id}: {status} - {body}")
+            return False
+        return True
+
+    async def config_status(self, node, config_id: str):
+        """Срок конфига на сервере (epoch); 0 — сервер подтвердил, что конфига нет.
+
+        Любой другой ответ, в том числе 404 (метода может не быть), — RuntimeError.
+        """
+        if not VPN_API_STATUS_PATH:
+            raise RuntimeError("метод статуса не настроен")
+        status, body = await self.request(node, 'status', VPN_API_STATUS_PATH, {
+            "uid": config_id,
+            "server": node.server
+        })
+        if status != 200:
+            raise RuntimeError(f"статус {status} - {body}")
+        data = json.loads(body)
+        if 'expiry' not in data:
+            raise RuntimeError(f"нет срока в ответе - {body}")
+        return int(data['expiry'] or 0)
+
+    async def config_statuses(self, node, config_ids: list) -> dict:
+        """Сроки нескольких конфигов одним запросом: {config_id: epoch}.
+
+        0 — сервер подтвердил, что конфига нет, None — конфига нет в ответе.
+        Требует пакетного метода статуса; без него бросает RuntimeError.
+        """
+        if not VPN_API_BATCH_STATUS_PATH:
+            raise RuntimeError("пакетный метод статуса не настроен")
+        status, body = await self.request(node, 'status', VPN_API_BATCH_STATUS_PATH, {
+            "uids": config_ids,
+            "server": node.server
+        })
+        if status != 200:
+            raise RuntimeError(f"статус {status} - {body}")
+        data = json.loads(body)
+        return {
+            config_id: int(data[config_id] or 0) if config_id in data else None
+            for config_id in config_ids
+        }
+
+    async def revoke_config(self, node, config_id: str) -> bool:
+        """Отзывает конфиг на сервере; успех — только ответ 200.
+
+        404 не считается отзывом: так отвечает и сервер без такого метода.
+        """
+        if not VPN_API_REVOKE_PATH:
+            raise RuntimeError("метод отзыва не настроен")
+        status, body = await self.request(node, 'revoke', VPN_API_REVOKE_PATH, {
+            "uid": config_id,
+            "server": node.server
+        })
+        if status != 200:
+            logging.error(f"Ошибка отзыва конфига на {node.node_id}: {status} - {body}")
+            return False
+        return True
+
+
+_client = None
+
+
+async def start_client() -> VPNClient:
+    """Создаёт и запускает общий клиент (повторный вызов возвращает существующий)"""
+    global _client
+    if _client is None:
+        _client = VPNClient()
+    await _client.start()
+    return _client
+
+
+async def close_client():
+    """Останавливает общий клиент"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+async def get_client() -> VPNClient:
+    """Общий клиент, при необходимости запускает его"""
+    if _client is None or _client.closed:
+        return await start_client()
+    return _client
@@ -0,0 +1,184 @@
+import logging
+from dataclasses import dataclass
+from circuit_breaker import get_breaker
+from config import VPN_NODES, VPN_DEFAULT_NODE
+
+__all__ = [
+    'VPNNode',
+    'NODES_SCHEMA',
+    'sync_nodes',
+    'get_node',
+    'all_nodes',
+    'placement_candidates',
+    'choose_node',
+    'record_placement',
+    'set_node_health'
+]
+
+NODES_SCHEMA = '''CREATE TABLE IF NOT EXISTS vpn_nodes
+                  (node_id TEXT PRIMARY KEY,
+                   api_url TEXT NOT NULL,
+                   api_key TEXT,
+                   server TEXT,
+                   host TEXT NOT NULL,
+                   port INTEGER NOT NULL DEFAULT 443,
+                   pbk TEXT,
+                   sid TEXT,
+                   sni TEXT,
+                   fp TEXT,
+                   flow TEXT,
+                   label TEXT,
+                   capacity INTEGER NOT NULL DEFAULT 0,
+                   user_count INTEGER NOT NULL DEFAULT 0,
+                   enabled INTEGER NOT NULL DEFAULT 1,
+                   healthy INTEGER NOT NULL DEFAULT 1)'''
+
+_COLUMNS = ('node_id', 'api_url', 'api_key', 'server', 'host', 'port', 'pbk', 'sid',
+            'sni', 'fp', 'flow', 'label', 'capacity', 'user_count', 'enabled', 'healthy')
+
+# Поля, которые задаются конфигом (user_count и healthy ведёт сам бот)
+_CONFIG_COLUMNS = ('node_id', 'api_url', 'api_key', 'server', 'host', 'port', 'pbk', 'sid',
+                   'sni', 'fp', 'flow', 'label', 'capacity', 'enabled')
+
+
+@dataclass
+class VPNNode:
+    """VPN-узел: адрес API, публичный адрес и параметры Reality"""
+    node_id: str
+    api_url: str
+    api_key: str = None
+    server: str = None
+    host: str = ''
+    port: int = 443
+    pbk: str = None
+    sid: str = None
+    sni: str = None
+    fp: str = None
+    flow: str = None
+    label: str = None
+    capacity: int = 0
+    user_count: int = 0  # занятые места: конфиги пользователей и тёплого пула
+    enabled: bool = True
+    healthy: bool = True
+
+    @property
+    def load(self) -> float:
+        """Доля занятой ёмкости"""
+        return self.user_count / self.capacity if self.capacity else 1.0
+
+    @property
+    def reachable(self) -> bool:
+        """Узел включён, здоров и не отключён автоматом"""
+        return self.enabled and self.healthy and get_breaker(self.node_id).available
+
+    @property
+    def available(self) -> bool:
+        """Можно ли размещать на узле новых пользователей"""
+        return self.reachable and self.user_count < self.capacity
+
+
+# Реестр в памяти: {node_id: VPNNode}; источник правды — таблица vpn_nodes
+_nodes = {}
+
+
+async def sync_nodes(conn):
+    """Переносит узлы из конфига в vpn_nodes, пересчитывает загрузку и загружает реестр.
+
+    Узлы, которых больше нет в конфиге, отключаются, но остаются в таблице:
+    пользователи на них сохраняют закрепление.
+    """
+    configured = []
+    for raw in VPN_NODES:
+        node = VPNNode(**{key: raw[key] for key in _CONFIG_COLUMNS if key in raw})
+        configured.append(node.node_id)
+        values = [getattr(node, key) for key in _CONFIG_COLUMNS]
+        assignments = ', '.join(f"{key} = excluded.{key}" for key in _CONFIG_COLUMNS[1:])
+        await conn.execute(
+            f"""INSERT INTO vpn_nodes ({', '.join(_CONFIG_COLUMNS)})
+                VALUES ({', '.join('?' * len(_CONFIG_COLUMNS))})
+                ON CONFLICT(node_id) DO UPDATE SET {assignments}""",
+            values
+        )
+    placeholders = ', '.join('?' * len(configured))
+    await conn.execute(f"UPDATE vpn_nodes SET enabled = 0 WHERE node_id NOT IN ({placeholders})", configured)
+
+    # Загрузка узлов по фактическим данным: конфиги пользователей и тёплого пула
+    await conn.execute(
+        """UPDATE vpn_nodes SET user_count = (
+               SELECT COUNT(*) FROM users
+               WHERE users.node_id = vpn_nodes.node_id AND users.config IS NOT NULL AND users.config != ''
+           ) + (
+               SELECT COUNT(*) FROM vpn_config_pool WHERE vpn_config_pool.node_id = vpn_nodes.node_id
+           )"""
+    )
+    await conn.commit()
+
+    cursor = await conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM vpn_nodes")
+    _nodes.clear()
+    for row in await cursor.fetchall():
+        node = VPNNode(*row)
+        node.enabled = bool(node.enabled)
+        node.healthy = bool(node.healthy)
+        _nodes[node.node_id] = node
+
+    summary = ', '.join(f"{n.node_id}: {n.user_count}/{n.capacity}" for n in _nodes.values() if n.enabled)
+    logging.info(f"VPN-узлы: {summary}")
+
+
+def get_node(node_id: str = None) -> VPNNode:
+    """Узел по идентификатору; для пользователей без узла — узел по умолчанию"""
+    node = _nodes.get(node_id or VPN_DEFAULT_NODE)
+    if node is None:
+        node = _nodes.get(VPN_DEFAULT_NODE)
+    if node is None:
+        # Реестр ещё не загружен — берём узел по умолчанию прямо из конфига
+        raw = next((n for n in VPN_NODES if n['node_id'] == VPN_DEFAULT_NODE), VPN_NODES[0])
+        node = VPNNode(**{key: raw[key] for key in _CONFIG_COLUMNS if key in raw})
+    return node
+
+
+def all_nodes() -> list:
+    return list(_nodes.values())
+
+
+def placement_candidates(check_capacity: bool = True) -> list:
+    """Доступные узлы от наименее загруженного.
+
+    check_capacity=False — без проверки свободных мест: для конфигов из пула,
+    которые уже заняли место на узле.
+    """
+    return sorted(
+        (node for node in _nodes.values() if (node.available if check_capacity else node.reachable)),
+        key=lambda node: (node.load, node.user_count)
+    )
+
+
+def choose_node() -> VPNNode:
+    """Наименее загруженный доступный узел или None, если мест нет"""
+    candidates = placement_candidates()
+    return candidates[0] if candidates else None
+
+
+async def record_placement(conn, node_id: str, delta: int):
+    """Меняет число пользователей на узле (в транзакции вызывающего кода)"""
+    if not node_id:
+        return
+    await conn.execute(
+        "UPDATE vpn_nodes SET user_count = user_count + ? WHERE node_id = ?",
+        (delta, node_id)
+    )
+    node = _nodes.get(node_id)
+    if node:
+        node.user_count += delta
+
+
+async def set_node_health(conn, node_id: str, healthy: bool):
+    """Отмечает узел доступным или недоступным для размещения"""
+    await conn.execute(
+        "UPDATE vpn_nodes SET healthy = ? WHERE node_id = ?",
+        (int(healthy), node_id)
+    )
+    await conn.commit()
+    node = _nodes.get(node_id)
+    if node:
+        node.healthy = healthy
@@ -0,0 +1,173 @@
+import ipaddress
+import logging
+from aiohttp import web
+import payment
+import pending_payments
+from yookassa_gateway import get_gateway
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    YOOKASSA_WEBHOOK_PATH,
+    YOOKASSA_WEBHOOK_IPS,
+    YOOKASSA_WEBHOOK_VERIFY_API,
+    WEBHOOK_TRUST_FORWARDED
+)
+
+__all__ = [
+    'WebhookServer',
+    'get_server',
+    'start_webhooks',
+    'stop_webhooks'
+]
+
+# События ЮKassa и статус платежа, который им соответствует
+_EVENTS = {
+    'payment.succeeded': 'succeeded',
+    'payment.canceled': 'canceled'
+}
+
+
+class WebhookServer:
+    """HTTP-сервер для уведомлений ЮKassa о платежах.
+
+    Уведомление принимается только с разрешённых адресов; статус платежа
+    перепроверяется запросом к API, тело уведомления используется лишь как
+    сигнал. Оплаченный платёж зачисляется тем же путём, что и при опросе.
+    Ответ не 200 заставляет ЮKassa повторить доставку, поэтому он
+    возвращается только при временных ошибках.
+    """
+
+    def __init__(self, bot, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                 path: str = YOOKASSA_WEBHOOK_PATH, allowed_ips=YOOKASSA_WEBHOOK_IPS,
+                 verify_api: bool = YOOKASSA_WEBHOOK_VERIFY_API):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.allowed = [ipaddress.ip_network(ip, strict=False) for ip in allowed_ips]
+        self.verify_api = verify_api
+        self._runner = None
+        # Метрики
+        self.received = 0
+        self.activated = 0
+        self.canceled = 0
+        self.rejected = 0
+        self.errors = 0
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def _client_ip(self, request: web.Request) -> str:
+        if WEBHOOK_TRUST_FORWARDED:
+            forwarded = request.headers.get('X-Forwarded-For', '')
+            if forwarded:
+                return forwarded.split(',')[0].strip()
+        return request.remote or ''
+
+    def _ip_allowed(self, ip: str) -> bool:
+        if not self.allowed:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self.allowed)
+
+    async def _fetch_payment(self, payment_id: str):
+        """(статус, metadata) платежа по данным API"""
+        gateway = await get_gateway()
+        found = await gateway.find_payment(payment_id)
+        return found.status, found.metadata
+
+    async def handle_yookassa(self, request: web.Request) -> web.Response:
+        self.received += 1
+        ip = self._client_ip(request)
+        if not self._ip_allowed(ip):
+            self.rejected += 1
+            logging.warning(f"Уведомление ЮKassa с неразрешённого адреса {ip}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            event = data['event']
+            payment_id = data['object']['id']
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        if event not in _EVENTS:
+            return web.Response(status=200)  # прочие события не нужны
+
+        try:
+            if self.verify_api:
+                status, metadata = await self._fetch_payment(payment_id)
+            else:
+                status = data['object'].get('status')
+                metadata = data['object'].get('metadata') or {}
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Не удалось проверить платеж {payment_id} по уведомлению: {e}")
+            return web.Response(status=500)
+
+        if status != _EVENTS[event]:
+            # Тело не совпадает с API — уведомлению не верим
+            self.rejected += 1
+            logging.warning(f"Уведомление {event} для {payment_id}, а статус в API: {status}")
+            return web.Response(status=200)
+
+        if status == 'canceled':
+            await payment.cancel_payment(payment_id)
+            self.canceled += 1
+            return web.Response(status=200)
+
+        if not await payment.activate_payment(payment_id, self.bot, metadata):
+            self.errors += 1
+            return web.Response(status=500)
+        self.activated += 1
+        return web.Response(status=200)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_yookassa)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        pending_payments.webhooks_enabled = True
+        logging.info(f"Уведомления ЮKassa принимаются на {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            pending_payments.webhooks_enabled = False
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'activated': self.activated,
+            'canceled': self.canceled,
+            'rejected': self.rejected,
+            'errors': self.errors
+        }
+
+
+_server = None
+
+
+def get_server() -> WebhookServer:
+    return _server
+
+
+async def start_webhooks(bot):
+    """Запускает приём уведомлений, если задан WEBHOOK_PORT"""
+    global _server
+    if not WEBHOOK_PORT or _server is not None:
+        return
+    _server = WebhookServer(bot)
+    await _server.start()
+
+
+async def stop_webhooks():
+    global _server
+    if _server is not None:
+        await _server.stop()
+        _server = None
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import aiohttp
+from config import (
+    YOOKASSA_SHOP_ID,
+    YOOKASSA_SECRET_KEY,
+    YOOKASSA_API_URL,
+    YOOKASSA_POOL_SIZE,
+    YOOKASSA_CONNECT_TIMEOUT,
+    YOOKASSA_TIMEOUT,
+    YOOKASSA_RETRIES
+)
+
+__all__ = [
+    'YooKassaError',
+    'GatewayPayment',
+    'YooKassaGateway',
+    'start_gateway',
+    'close_gateway',
+    'get_gateway'
+]
+
+# Пауза между повторами: экспоненциальная, с полным случайным разбросом
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 5
+# Предел ожидания по ответу 202 («запрос ещё обрабатывается»), секунды
+_PROCESSING_WAIT_MAX = 5
+
+
+def _parse(body: str) -> dict:
+    """Тело ответа как JSON; не-JSON (например, страница прокси) — пустой словарь"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+class YooKassaError(Exception):
+    """Ошибка API ЮKassa (статус ответа и описание из тела)"""
+
+    def __init__(self, status: int, description: str):
+        super().__init__(f"ЮKassa {status}: {description}")
+        self.status = status
+        self.description = description
+
+
+@dataclass(frozen=True)
+class GatewayPayment:
+    """Платёж ЮKassa: нужные боту поля ответа API"""
+    id: str
+    status: str
+    paid: bool = False
+    confirmation_url: str = None
+    created_at: str = None
+    metadata: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'GatewayPayment':
+        return cls(
+            id=data['id'],
+            status=data['status'],
+            paid=bool(data.get('paid')),
+            confirmation_url=(data.get('confirmation') or {}).get('confirmation_url'),
+            created_at=data.get('created_at'),
+            metadata=dict(data.get('metadata') or {})
+        )
+
+
+class YooKassaGateway:
+    """Асинхронный клиент API ЮKassa на одной сессии aiohttp.
+
+    Соединения переиспользуются, запрос ограничен таймаутом и не блокирует
+    цикл событий. Сетевые ошибки и 5xx повторяются: чтение безопасно само по
+    себе, а создание платежа повторяется с тем же ключом идемпотентности,
+    так что второй платёж не появится.
+    """
+
+    def __init__(self, shop_id: str = YOOKASSA_SHOP_ID, secret_key: str = YOOKASSA_SECRET_KEY,
+                 api_url: str = YOOKASSA_API_URL, retries: int = YOOKASSA_RETRIES):
+        self.api_url = api_url.rstrip('/')
+        self.auth = aiohttp.BasicAuth(str(shop_id), secret_key)
+        self.retries = max(0, retries)
+        self._session = None
+        # Метрики
+        self.requests = 0
+        self.retried = 0
+        self.errors = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._session is None or self._session.closed
+
+    async def start(self):
+        """Создаёт сессию и пул соединений"""
+        if not self.closed:
+            return
+        connector = aiohttp.TCPConnector(limit=YOOKASSA_POOL_SIZE, use_dns_cache=True)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            auth=self.auth,
+            timeout=aiohttp.ClientTimeout(total=YOOKASSA_TIMEOUT, sock_connect=YOOKASSA_CONNECT_TIMEOUT)
+        )
+        logging.info(f"Клиент ЮKassa запущен (до {YOOKASSA_POOL_SIZE} соединений)")
+
+    async def close(self):
+        """Закрывает сессию и все соединения"""
+        if self.closed:
+            return
+        await self._session.close()
+        self._session = None
+        await asyncio.sleep(0)
+        logging.info("Клиент ЮKassa остановлен")
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt))
+
+    async def request(self, method: str, path: str, payload: dict = None, params: dict = None,
+                      idempotency_key: str = None) -> dict:
+        """Запрос к API с повторами, возвращает тело ответа; ошибка API — YooKassaError"""
+        if self.closed:
+            await self.start()
+        headers = {"Idempotence-Key": idempotency_key} if idempotency_key else None
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            self.requests += 1
+            try:
+                async with self._session.request(
+                    method, f"{self.api_url}{path}", json=payload, params=params, headers=headers
+                ) as resp:
+                    status, body = resp.status, await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last:
+                    self.errors += 1
+                    raise
+                logging.warning(f"ЮKassa {method} {path}: {e!r}, повтор {attempt + 1}")
+                delay = self._backoff(attempt)
+            else:
+                data = _parse(body)
+                if status == 202 and not last:
+                    # Запрос принят, но ещё обрабатывается — ЮKassa просит повторить позже
+                    delay = min(_PROCESSING_WAIT_MAX, data.get('retry_after', 1000) / 1000)
+                elif status >= 500 and not last:
+                    logging.warning(f"ЮKassa {method} {path}: статус {status}, повтор {attempt + 1}")
+                    delay = self._backoff(attempt)
+                elif status >= 300:
+                    self.errors += 1
+                    raise YooKassaError(status, data.get('description') or data.get('code') or '')
+                else:
+                    return data
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def create_payment(self, payload: dict, idempotency_key: str) -> GatewayPayment:
+        data = await self.request('POST', '/payments', payload, idempotency_key=idempotency_key)
+        return GatewayPayment.from_json(data)
+
+    async def find_payment(self, payment_id: str) -> GatewayPayment:
+        data = await self.request('GET', f"/payments/{payment_id}")
+        return GatewayPayment.from_json(data)
+
+    async def list_payments(self, created_since_ts: int, cursor: str = None, limit: int = 100):
+        """Страница платежей, созданных не раньше created_since_ts: (платежи, курсор следующей страницы)"""
+        created = datetime.fromtimestamp(created_since_ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        params = {'created_at.gte': created, 'limit': str(min(100, max(1, limit)))}
+        if cursor:
+            params['cursor'] = cursor
+        data = await self.request('GET', '/payments', params=params)
+        return [GatewayPayment.from_json(item) for item in data.get('items', [])], data.get('next_cursor')
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retried': self.retried,
+            'errors': self.errors
+        }
+
+
+_gateway = None
+
+
+async def start_gateway() -> YooKassaGateway:
+    """Создаёт общий клиент ЮKassa (вызывается при старте бота)"""
+    global _gateway
+    if _gateway is None:
+        _gateway = YooKassaGateway()
+    await _gateway.start()
+    return _gateway
+
+
+async def close_gateway():
+    """Закрывает общий клиент (вызывается при остановке бота)"""
+    global _gateway
+    if _gateway is not None:
+        await _gateway.close()
+        _gateway = None
+
+
+async def get_gateway() -> YooKassaGateway:
+    """Общий клиент; при первом обращении создаётся"""
+    if _gateway is None or _gateway.closed:
+        return await start_gateway()
+    return _gateway